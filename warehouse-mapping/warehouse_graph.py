@@ -8,6 +8,11 @@ Bi-directional means that there are no travel conventions for aisles in the ware
 '''
 
 
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -15,14 +20,55 @@ import matplotlib.patches as patches
 from shapely.geometry import LineString, Polygon
 import networkx as nx
 
+try:
+    import shapely
+    from shapely import STRtree
+    # Vectorized geometry functions came with Shapely 2.0
+    VECTORIZED = int(shapely.__version__.split('.')[0]) >= 2
+except ImportError:
+    VECTORIZED = False
 
-def generateadjmat(obstacles_and_dummy_obstacles, allnodes, real_object_corner_indicies):
+try:
+    from scipy.sparse import csgraph, csr_matrix
+except ImportError:
+    csgraph = None
+
+# Node pairs tested at once by the vectorized pruning, bounds its memory use
+BLOCK_PAIRS = 50000
+
+# Relative margin of the crossing test in straddles, far above the
+# rounding error of its cross products
+CROSSING_EPS = 1e-9
+
+# Polygons per edge and round tested by crosses_sides in obstructed_edges
+CROSSING_BATCH = 4
+
+# Matrix entries per row block in generate_weighted_adjmat, bounds its memory use
+BLOCK_ELEMENTS = 1 << 22
+
+# Obstacle index and output file of parallel_visibility_adjmat, set
+# before the workers are forked so that they share it copy-on-write
+_SHARED = {}
+
+
+def generateadjmat(obstacles_and_dummy_obstacles, allnodes, real_object_corner_indicies,
+                   vectorized=None, workers=None, out_file=None):
 
     '''
     # Polygons must follow clockwise coordinate convention
+    With Shapely 2 the obstructed edges are found by visibility_adjmat,
+    which gives the same adjmat in minutes instead of hours. With
+    workers or out_file it is computed on a process pool instead, see
+    parallel_visibility_adjmat.
     :param obstacles_and_dummy_obstacles:
     :param allnodes:
     :param real_object_corner_indicies:
+    :param vectorized: False to test every pair in Python, VECTORIZED if None.
+    :param workers: Number of worker processes.
+    :param out_file: .npy file the pruned adjmat is written to, makes an
+                     interrupted run resumable.
+    :raises: ValueError if workers or out_file is given without Shapely 2
+             or with vectorized False.
     :return:
     '''
 
@@ -33,13 +79,21 @@ def generateadjmat(obstacles_and_dummy_obstacles, allnodes, real_object_corner_i
         polylist.append(Polygon(obstacle))
 
     print('Generating adjmat')
-    matty = np.ndarray((len(allnodes), len(allnodes)), dtype=bool)
+    if vectorized is None:
+        vectorized = VECTORIZED
+    if not vectorized and (workers is not None or out_file is not None):
+        raise ValueError('workers and out_file need the vectorized pruning (Shapely 2)')
+    if vectorized and (workers is not None or out_file is not None):
+        adjmat = parallel_visibility_adjmat(polylist, allnodes, out_file, workers)
+        adjmat = connect_polygon_edges(adjmat, real_object_corner_indicies)
+        return adjmat, polylist
+    if vectorized:
+        adjmat = visibility_adjmat(polylist, allnodes)
+        adjmat = connect_polygon_edges(adjmat, real_object_corner_indicies)
+        return adjmat, polylist
 
     # Initialize adjacency matrix as fully connected
-    for i in range(0, len(allnodes) - 1):
-        for j in range(i, len(allnodes)):
-            matty[i, j] = 1
-            matty[j, i] = 1
+    matty = np.ones((len(allnodes), len(allnodes)), dtype=bool)
 
     # Deny edges in adjacency matrix that are obstructed
     print('Pruning Obstructed Edges')
@@ -58,6 +112,357 @@ def generateadjmat(obstacles_and_dummy_obstacles, allnodes, real_object_corner_i
     return adjmat, polylist
 
 
+def visibility_adjmat(polylist, allnodes, block_pairs=BLOCK_PAIRS):
+    '''
+    Vectorized version of the edge pruning in generateadjmat, needs
+    Shapely 2. An edge is obstructed, as there, if its intersection with
+    some polygon has non-zero length. An STRtree over the polygons finds
+    the polygons near each edge, and only those are tested, see
+    obstructed_edges.
+    :param polylist: Shapely polygons of the obstacles.
+    :param allnodes:
+    :param block_pairs: Node pairs tested at once.
+    :return: adjmat, True for nodes that see each other.
+    '''
+    nodes = np.asarray(allnodes, dtype=float)[:, :2]
+    num_nodes = len(nodes)
+    adjmat = np.ones((num_nodes, num_nodes), dtype=bool)
+    if num_nodes < 2 or len(polylist) == 0:
+        return adjmat
+    tree, polys, sides = obstacle_index(polylist)
+
+    print('Pruning Obstructed Edges')
+    for first_row, last_row in row_blocks(num_nodes, block_pairs):
+        print('Edges for Nodes ', first_row, 'to', last_row - 1, 'of ', num_nodes, ' nodes.')
+        rows, cols = pairs_in_rows(num_nodes, first_row, last_row)
+        blocked = obstructed_edges(tree, polys, sides, nodes[rows], nodes[cols])
+        adjmat[rows[blocked], cols[blocked]] = 0
+        adjmat[cols[blocked], rows[blocked]] = 0
+    return adjmat
+
+
+def parallel_visibility_adjmat(polylist, allnodes, out_file=None, workers=None,
+                               block_pairs=BLOCK_PAIRS):
+    '''
+    visibility_adjmat on a process pool. The upper triangle of adjmat is
+    split into row blocks of about block_pairs node pairs, the workers
+    are forked with the obstacle index in memory and write the edges
+    they find obstructed straight into out_file, a memory-mapped .npy
+    file. Blocks that are done are recorded in out_file + '.progress',
+    so running it again with the same input after an interruption only
+    computes the blocks that are left.
+    :param polylist: Shapely polygons of the obstacles.
+    :param allnodes:
+    :param out_file: .npy file for the result, a temporary file if None.
+    :param workers: Number of worker processes, the number of CPUs if None.
+    :param block_pairs: Node pairs per block.
+    :return: adjmat, True for nodes that see each other.
+    '''
+    nodes = np.asarray(allnodes, dtype=float)[:, :2]
+    num_nodes = len(nodes)
+    if num_nodes < 2 or len(polylist) == 0:
+        return np.ones((num_nodes, num_nodes), dtype=bool)
+    tree, polys, sides = obstacle_index(polylist)
+    blocks = row_blocks(num_nodes, block_pairs)
+    workers = workers or os.cpu_count() or 1
+
+    # Blocks are only reused if nodes, obstacles and blocks are the same
+    digest = hashlib.sha1()
+    digest.update(nodes.tobytes())
+    for wkb in shapely.to_wkb(polys):
+        digest.update(wkb)
+    digest.update(str(block_pairs).encode('utf-8'))
+    fingerprint = digest.hexdigest()
+
+    temporary = out_file is None
+    if temporary:
+        handle, out_file = tempfile.mkstemp(suffix='.npy')
+        os.close(handle)
+    progress_file = out_file + '.progress'
+    try:
+        done = read_progress(progress_file, fingerprint) if os.path.exists(out_file) else None
+        if done is None:
+            adjmat = np.lib.format.open_memmap(out_file, mode='w+', dtype=bool,
+                                               shape=(num_nodes, num_nodes))
+            adjmat[:] = 1
+            adjmat.flush()
+            del adjmat
+            with open(progress_file, 'w') as handle:
+                handle.write(fingerprint + '\n')
+            done = set()
+        pending = [(index, block) for index, block in enumerate(blocks) if index not in done]
+        print('Pruning Obstructed Edges:', len(pending), 'of', len(blocks), 'blocks left,',
+              workers, 'workers')
+
+        _SHARED.update(tree=tree, polys=polys, sides=sides, nodes=nodes, out_file=out_file)
+        time0 = time.time()
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool, \
+                    open(progress_file, 'a') as progress:
+                for count, index in enumerate(pool.imap_unordered(_prune_block, pending), 1):
+                    progress.write('{}\n'.format(index))
+                    progress.flush()
+                    elapsed = time.time() - time0
+                    print('Blocks done: {} of {} ({:.0f}%), {:.0f} s left'.format(
+                        len(blocks) - len(pending) + count, len(blocks),
+                        100.0 * (len(blocks) - len(pending) + count) / len(blocks),
+                        elapsed / count * (len(pending) - count)))
+        finally:
+            _SHARED.clear()
+
+        return np.load(out_file)
+    finally:
+        if temporary:
+            # Also after an error or an interruption, there is nothing to resume
+            for file_name in (out_file, progress_file):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+
+def _prune_block(task):
+    '''
+    Worker of parallel_visibility_adjmat, writes the obstructed edges of
+    one row block into the output file.
+    :param task: (block index, (first row, last row + 1)).
+    :return: The block index.
+    '''
+    index, (first_row, last_row) = task
+    nodes = _SHARED['nodes']
+    rows, cols = pairs_in_rows(len(nodes), first_row, last_row)
+    blocked = obstructed_edges(_SHARED['tree'], _SHARED['polys'], _SHARED['sides'],
+                               nodes[rows], nodes[cols])
+    adjmat = np.load(_SHARED['out_file'], mmap_mode='r+')
+    # Blocks write disjoint cells, rows of the block above the diagonal
+    # and their mirror images below it
+    adjmat[rows[blocked], cols[blocked]] = 0
+    adjmat[cols[blocked], rows[blocked]] = 0
+    adjmat.flush()
+    return index
+
+
+def read_progress(progress_file, fingerprint):
+    '''
+    Reads the blocks recorded as done by parallel_visibility_adjmat.
+    :param progress_file:
+    :param fingerprint: Fingerprint of the input of the current run.
+    :return: Set of block indices, None if the file is missing or is
+             from a run with different input.
+    '''
+    if not os.path.exists(progress_file):
+        return None
+    with open(progress_file, 'r') as handle:
+        lines = handle.read().split('\n')
+    if lines[0] != fingerprint:
+        return None
+    # The last line may be cut short by the interruption
+    return {int(line) for line in lines[1:-1] if line}
+
+
+def obstacle_index(polylist):
+    '''
+    Builds what obstructed_edges needs to know about the obstacles.
+    :param polylist: Shapely polygons of the obstacles.
+    :return: (STRtree, array of prepared polygons, polygon_sides).
+    '''
+    polys = np.asarray(polylist, dtype=object)
+    tree = STRtree(polys)
+    # Crossing a side of a line-like or self-intersecting obstacle does
+    # not mean passing through its interior, those are left to the
+    # intersection test
+    exact_only = (shapely.area(polys) == 0) | ~shapely.is_valid(polys)
+    sides = polygon_sides(polys, exact_only)
+    # Prepared polygons speed up the intersects tests of obstructed_edges
+    shapely.prepare(polys)
+    return tree, polys, sides
+
+
+def row_blocks(num_nodes, block_pairs):
+    '''
+    Splits the rows of the upper triangle of adjmat into blocks of
+    about block_pairs node pairs.
+    :param num_nodes:
+    :param block_pairs:
+    :return: List of (first row, last row + 1).
+    '''
+    blocks = []
+    first_row = 0
+    pairs = 0
+    for row in range(num_nodes - 1):
+        pairs += num_nodes - 1 - row
+        if pairs >= block_pairs:
+            blocks.append((first_row, row + 1))
+            first_row = row + 1
+            pairs = 0
+    if first_row < num_nodes - 1:
+        blocks.append((first_row, num_nodes - 1))
+    return blocks
+
+
+def pairs_in_rows(num_nodes, first_row, last_row):
+    '''
+    Returns the node pairs (i, j), i < j, with first_row <= i < last_row.
+    :param num_nodes:
+    :param first_row:
+    :param last_row:
+    :return: (rows, cols) arrays.
+    '''
+    row_ids = np.arange(first_row, last_row)
+    counts = num_nodes - 1 - row_ids
+    rows = np.repeat(row_ids, counts)
+    # j runs from i + 1 within each row
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, rows + 1 + offsets
+
+
+def polygon_sides(polys, skip=None):
+    '''
+    Collects the sides of the polygon rings, holes included.
+    :param polys: Array of Shapely polygons.
+    :param skip: Optional boolean array, polygons whose sides are left
+                 out, crosses_sides never reports them.
+    :return: (side starts, side ends, first side of each polygon,
+             number of sides of each polygon).
+    '''
+    side_starts = [np.empty((0, 2))]
+    side_ends = [np.empty((0, 2))]
+    num_sides = np.zeros(len(polys), dtype=np.intp)
+    for poly_id, poly in enumerate(polys):
+        if skip is not None and skip[poly_id]:
+            continue
+        for ring in [poly.exterior] + list(poly.interiors):
+            coords = np.asarray(ring.coords, dtype=float)[:, :2]
+            side_starts.append(coords[:-1])
+            side_ends.append(coords[1:])
+            num_sides[poly_id] += len(coords) - 1
+    first_side = np.cumsum(num_sides) - num_sides
+    return np.concatenate(side_starts), np.concatenate(side_ends), first_side, num_sides
+
+
+def straddles(a_x, a_y, b_x, b_y, c_x, c_y, d_x, d_y):
+    '''
+    Tests, element by element, if c and d lie clearly on opposite sides
+    of the line through a and b. Nearly collinear cases count as not
+    straddling.
+    :return: Boolean array.
+    '''
+    ab_x = b_x - a_x
+    ab_y = b_y - a_y
+    ac_x = c_x - a_x
+    ac_y = c_y - a_y
+    ad_x = d_x - a_x
+    ad_y = d_y - a_y
+    cross_c = ab_x * ac_y - ab_y * ac_x
+    cross_d = ab_x * ad_y - ab_y * ad_x
+    scale = CROSSING_EPS * (np.abs(ab_x) + np.abs(ab_y))
+    tol_c = scale * (np.abs(ac_x) + np.abs(ac_y))
+    tol_d = scale * (np.abs(ad_x) + np.abs(ad_y))
+    return ((cross_c > tol_c) & (cross_d < -tol_d)) | ((cross_c < -tol_c) & (cross_d > tol_d))
+
+
+def crosses_sides(sides, starts, ends, line_ids, poly_ids):
+    '''
+    Tests if the edges cross a side of the polygons properly, i.e. away
+    from the corners and not along the side. Such an edge passes through
+    the polygon's interior, so it is obstructed.
+    :param sides: See polygon_sides.
+    :param starts: Start points of the edges.
+    :param ends: End points of the edges.
+    :param line_ids: Edge of each pair to test.
+    :param poly_ids: Polygon of each pair to test.
+    :return: Boolean array, True for the pairs that cross.
+    '''
+    side_starts, side_ends, first_side, num_sides = sides
+    counts = num_sides[poly_ids]
+    pair_ids = np.repeat(np.arange(len(line_ids)), counts)
+    side_ids = np.arange(counts.sum()) + \
+        np.repeat(first_side[poly_ids] - (np.cumsum(counts) - counts), counts)
+    edge_ids = line_ids[pair_ids]
+    # One contiguous array per coordinate, much faster than (n, 2) arrays
+    a_x, a_y = starts[:, 0][edge_ids], starts[:, 1][edge_ids]
+    b_x, b_y = ends[:, 0][edge_ids], ends[:, 1][edge_ids]
+    c_x, c_y = side_starts[:, 0][side_ids], side_starts[:, 1][side_ids]
+    d_x, d_y = side_ends[:, 0][side_ids], side_ends[:, 1][side_ids]
+    crossing = straddles(a_x, a_y, b_x, b_y, c_x, c_y, d_x, d_y) & \
+        straddles(c_x, c_y, d_x, d_y, a_x, a_y, b_x, b_y)
+    return np.bincount(pair_ids[crossing], minlength=len(line_ids)) > 0
+
+
+def ranks(line_ids):
+    '''
+    Numbers the entries of each edge in a sorted array of edge ids,
+    0 for the first entry of an edge, 1 for the next and so on.
+    :param line_ids:
+    :return:
+    '''
+    positions = np.arange(len(line_ids))
+    first = np.ones(len(line_ids), dtype=bool)
+    first[1:] = line_ids[1:] != line_ids[:-1]
+    return positions - np.maximum.accumulate(np.where(first, positions, 0))
+
+
+def obstructed_edges(tree, polys, sides, starts, ends):
+    '''
+    Tests which straight edges are obstructed by the polygons. The tree
+    gives the polygons whose bounding box an edge crosses. Edges that
+    clearly cross a side of a valid polygon with an area are obstructed,
+    see crosses_sides. For
+    the others a cheap intersects test on the prepared polygons drops
+    the polygons the edge misses, and the intersection of the edge with
+    the remaining polygons is computed as in generateadjmat. Both tests
+    are done in rounds, a few polygons per edge and round, and an edge
+    found obstructed is not tested again.
+    :param tree: STRtree over polys.
+    :param polys: Array of prepared Shapely polygons.
+    :param sides: See polygon_sides.
+    :param starts: Start points of the edges, shape (n, 2).
+    :param ends: End points of the edges, shape (n, 2).
+    :return: Boolean array, True for obstructed edges.
+    '''
+    lines = shapely.linestrings(np.stack((starts, ends), axis=1))
+    blocked = np.zeros(len(lines), dtype=bool)
+    line_ids, poly_ids = tree.query(lines)
+    order = np.argsort(line_ids, kind='stable')
+    line_ids = line_ids[order]
+    poly_ids = poly_ids[order]
+
+    # Long edges have many polygons nearby, but usually cross one of the
+    # first few tested
+    tested_lines = []
+    tested_polys = []
+    while len(line_ids):
+        test = ranks(line_ids) < CROSSING_BATCH
+        crossed = crosses_sides(sides, starts, ends, line_ids[test], poly_ids[test])
+        blocked[line_ids[test][crossed]] = True
+        tested_lines.append(line_ids[test])
+        tested_polys.append(poly_ids[test])
+        keep = ~test & ~blocked[line_ids]
+        line_ids = line_ids[keep]
+        poly_ids = poly_ids[keep]
+    if not tested_lines:
+        return blocked
+
+    line_ids = np.concatenate(tested_lines)
+    poly_ids = np.concatenate(tested_polys)
+    open_pairs = ~blocked[line_ids]
+    line_ids = line_ids[open_pairs]
+    poly_ids = poly_ids[open_pairs]
+    hit = shapely.intersects(polys[poly_ids], lines[line_ids])
+    order = np.argsort(line_ids[hit], kind='stable')
+    line_ids = line_ids[hit][order]
+    poly_ids = poly_ids[hit][order]
+
+    while len(line_ids):
+        # The first remaining polygon of every edge
+        first = ranks(line_ids) == 0
+        overlap = shapely.length(shapely.intersection(polys[poly_ids[first]],
+                                                      lines[line_ids[first]]))
+        blocked[line_ids[first][overlap != 0]] = True
+        keep = ~first & ~blocked[line_ids]
+        line_ids = line_ids[keep]
+        poly_ids = poly_ids[keep]
+    return blocked
+
+
 def connect_polygon_edges(adjmat, real_object_corner_indicies):
     '''
 
@@ -76,34 +481,39 @@ def connect_polygon_edges(adjmat, real_object_corner_indicies):
     return adjmat
 
 
-def generate_weighted_adjmat(allnodes, adjmat):
+def generate_weighted_adjmat(allnodes, adjmat, out=None):
     '''
     Get distances for reachable pairs of nodes. simply euclidean given there are no obstructions
+    The matrix is computed in row blocks of about BLOCK_ELEMENTS
+    entries. As before, adjmat is read above the diagonal and the
+    result mirrored below it.
     :param allnodes:
     :param adjmat:
+    :param out: Optional int matrix to fill, e.g. a memory-mapped .npy
+                for warehouses too large for memory.
     :return:
     '''
 
-    dist_matrix = np.ndarray(shape=(len(allnodes), len(allnodes)), dtype=int)
+    coords = np.asarray(allnodes)[:, :2]
+    num_nodes = len(coords)
+    dist_matrix = np.empty((num_nodes, num_nodes), dtype=int) if out is None else out
     print('Generating wadjmat')
-    for i in range(0, len(allnodes) - 1):
-        for j in range(i + 1, len(allnodes)):
-            if adjmat[i, j] == 1:
-                # calculate distance
-                dist_matrix[i, j] = int(np.sqrt(int(allnodes[i][0] - allnodes[j][0]) ** 2 + int(allnodes[i][1] - allnodes[j][1]) ** 2))  # euclidean dist
-                dist_matrix[j, i] = dist_matrix[i, j]
-            else:
-                dist_matrix[i, j] = 0
-                dist_matrix[j, i] = dist_matrix[i, j]
-
-    for i in range(0, len(allnodes)):
-        dist_matrix[i, i] = 0
-
-    # run check to make sure no zero rounding has occured:
-    for i in range(0, len(allnodes) - 1):
-        for j in range(i + 1, len(allnodes)):
-            if adjmat[i, j] == 1:
-                assert (dist_matrix[i, j] > 0)
+    cols = np.arange(num_nodes)
+    zero_rounded = False
+    block_rows = max(1, BLOCK_ELEMENTS // max(num_nodes, 1))
+    for first_row in range(0, num_nodes, block_rows):
+        last_row = min(num_nodes, first_row + block_rows)
+        rows = np.arange(first_row, last_row)
+        above = cols[None, :] > rows[:, None]
+        below = cols[None, :] < rows[:, None]
+        connected = (above & (adjmat[first_row:last_row] == 1)) | \
+            (below & (adjmat[:, first_row:last_row] == 1).T)
+        dist = pair_distances(coords[first_row:last_row], coords)
+
+        # run check to make sure no zero rounding has occured:
+        zero_rounded |= np.any(connected & (dist <= 0))
+        dist_matrix[first_row:last_row] = np.where(connected, dist, 0)
+    assert not zero_rounded
     # print'All int valued distances in wadjmat are greater than 0'
 
     wadjmat = dist_matrix
@@ -112,6 +522,23 @@ def generate_weighted_adjmat(allnodes, adjmat):
     return wadjmat
 
 
+def pair_distances(from_coords, to_coords):
+    '''
+    Distances between all pairs of points, computed as
+    int(np.sqrt(int(dx) ** 2 + int(dy) ** 2)).
+    :param from_coords: Array of shape (m, 2).
+    :param to_coords: Array of shape (n, 2).
+    :return: int matrix of shape (m, n).
+    '''
+    if np.issubdtype(from_coords.dtype, np.integer):
+        deltas = from_coords.astype(np.int64)[:, None, :] - to_coords.astype(np.int64)[None, :, :]
+    else:
+        # int() of the difference truncates towards zero
+        deltas = np.trunc(from_coords[:, None, :] - to_coords[None, :, :]).astype(np.int64)
+    squares = deltas[:, :, 0] ** 2 + deltas[:, :, 1] ** 2
+    return np.sqrt(squares.astype(np.float64)).astype(int)
+
+
 def generate_graph_network(adjmat, wadjmat, allnodes):
 
     '''
@@ -157,6 +584,100 @@ def generate_graph_network(adjmat, wadjmat, allnodes):
     return sp_dist_matrix, shortest_path
 
 
+def generate_graph_arrays(adjmat, wadjmat, method='D'):
+
+    '''
+    Alternative to generate_graph_network that needs SciPy instead of
+    networkx. It computes all shortest paths with scipy.sparse.csgraph
+    and returns the files the service loads directly, without a path
+    dictionary ever being built.
+    :param adjmat:
+    :param wadjmat:
+    :param method: 'D' for Dijkstra, 'FW' for Floyd-Warshall.
+    :raises: ValueError if some nodes cannot reach each other.
+    :return: (distmat, spnodeslist, startendndarray, predecessors), see path_arrays.
+    '''
+
+    print('generate_graph_arrays')
+    distmat, predecessors = shortest_paths(adjmat, wadjmat, method)
+    spnodeslist, startendndarray = path_arrays(predecessors)
+    print('done generate_graph_arrays')
+    return distmat, spnodeslist, startendndarray, predecessors
+
+
+def shortest_paths(adjmat, wadjmat, method='D'):
+    '''
+    All pairs shortest paths on the sparse weighted graph.
+    :param adjmat:
+    :param wadjmat:
+    :param method: 'D' for Dijkstra, 'FW' for Floyd-Warshall.
+    :raises: ValueError if some nodes cannot reach each other.
+    :return: (distmat, predecessors). predecessors[i, j] is the node
+             before j on the shortest path from i to j, -9999 if j == i,
+             int16 up to 32767 nodes and int32 above.
+    '''
+    if csgraph is None:
+        raise ImportError('generate_graph_arrays needs SciPy')
+    num_nodes = len(adjmat)
+    rows, cols = np.nonzero(np.asarray(adjmat, dtype=bool))
+    off_diagonal = rows != cols
+    rows = rows[off_diagonal]
+    cols = cols[off_diagonal]
+    graph = csr_matrix((np.asarray(wadjmat)[rows, cols].astype(float), (rows, cols)),
+                       shape=(num_nodes, num_nodes))
+    dist, predecessors = csgraph.shortest_path(graph, method=method, directed=False,
+                                               return_predecessors=True)
+    unreachable = np.isinf(dist)
+    if unreachable.any():
+        raise ValueError('{} node pairs are not connected, e.g. nodes {}'.format(
+            unreachable.sum() // 2, np.argwhere(unreachable)[0].tolist()))
+    # Sums of integer weights, exact in float64
+    return dist.astype(int), predecessors.astype(np.int16 if num_nodes <= 32767 else np.int32)
+
+
+def path_arrays(predecessors):
+    '''
+    Lists all shortest paths in the format the service loads: the path
+    from node i to node j, both included, is
+    spnodeslist[startendndarray[i, j, 0]:startendndarray[i, j, 1]].
+    Paths are stored row by row.
+    :param predecessors: See shortest_paths.
+    :return: (spnodeslist, startendndarray).
+    '''
+    num_nodes = len(predecessors)
+    sources = np.repeat(np.arange(num_nodes), num_nodes)
+    parents = predecessors.ravel().astype(np.int64)
+    has_parent = parents >= 0
+    # Number of nodes on every path by pointer jumping: after k rounds
+    # ancestor is the 2^k:th node before j, or -1 past the start
+    lengths = has_parent.astype(np.int64)
+    ancestor = np.where(has_parent, parents, -1)
+    active = np.flatnonzero(has_parent)
+    while len(active):
+        jump = sources[active] * num_nodes + ancestor[active]
+        lengths[active] += lengths[jump]
+        ancestor[active] = ancestor[jump]
+        active = active[ancestor[active] >= 0]
+    lengths += 1
+
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    startendndarray = np.stack((starts, ends), axis=1).reshape(num_nodes, num_nodes, 2)
+
+    # Walk all paths backwards at once, from j towards i
+    spnodeslist = np.empty(ends[-1], dtype=np.int32)
+    pairs = np.arange(num_nodes * num_nodes)
+    nodes = np.tile(np.arange(num_nodes), num_nodes)
+    positions = ends - 1
+    while len(pairs):
+        spnodeslist[positions] = nodes
+        more = positions > starts[pairs]
+        pairs = pairs[more]
+        nodes = parents[sources[pairs] * num_nodes + nodes[more]]
+        positions = positions[more] - 1
+    return spnodeslist, startendndarray
+
+
 def visualizeadjmat(adjmat, polylist, allnodes):
     '''
     Visualizes graph result
@@ -7,29 +7,43 @@ flask server
 '''
 
 import os
-import json
+import time
 from flask import Flask, request, Response
-from pydash import get as _get
 
-from model.trivial_instance_solver import TrivialInstanceSolver
+from model.solver_executor import SOLVER_EXECUTOR
 
 from utils.handler import Handler
+from utils.location_index import UnknownLocations
+from utils.coords_format import COORDS_FORMAT_HEADER, parse_coords_format
+from utils.codec import CODEC
+from utils.request_types import OptimizationRequest
 from utils.environment import TE
 from utils.service import SERVICE
+from utils.route_cache import ROUTE_CACHE
 
 # Database management
 from utils.database import TASKS
 from utils.bq import BQ
-
-# Useful request paths
-REQ_PATHS = {
-    'taskId': '_meta.taskId',
-    'warehouseUuid': '_meta.warehouse.uuid',
-    'warehouseTag': '_meta.warehouse.tag'
-}
+from utils.batch_jobs import BATCH_JOBS
 
 APP = Flask(__name__)
 
+# Seconds a pick route may take to solve
+SOLVE_TIMEOUT = float(os.environ.get('TENSHI_SOLVE_TIMEOUT', 5.0))
+
+# Batch workers import this module as __mp_main__ when it is run as a
+# script (python main.py), they must not start pools or warm-up
+if __name__ != '__mp_main__':
+    # Solver processes are forked before any other thread is started.
+    # The batch workers come from a forkserver, the solver pool's
+    # threads are running by then
+    SOLVER_EXECUTOR.start()
+    BATCH_JOBS.start()
+
+    # Start loading warehouse data in the background as soon as the
+    # process starts, instead of waiting for the first probe
+    SERVICE.start_warm_up()
+
 
 @APP.route('/warmup', methods=['GET'])
 def warm_up():
@@ -39,6 +53,33 @@ def warm_up():
     return SERVICE.warm_up()
 
 
+@APP.route('/liveness_check', methods=['GET'])
+def liveness_check():
+    """
+    Liveness probe, OK as long as the process serves requests.
+    """
+    return SERVICE.liveness()
+
+
+@APP.route('/readiness_check', methods=['GET'])
+def readiness_check():
+    """
+    Readiness probe, OK once warm-up is done. Reports warm-up progress per file.
+    """
+    return SERVICE.readiness()
+
+
+@APP.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Counters of the route cache, the BigQuery upload queue and the batch queue.
+    """
+    return Response(CODEC.dumps({'routeCache': ROUTE_CACHE.stats(),
+                                 'telemetry': BQ.stats(),
+                                 'batchWaiting': BATCH_JOBS.waiting()}),
+                    mimetype='application/json')
+
+
 @APP.route('/pickroute', methods=['POST'])
 def optimize_pick_route():
     """
@@ -52,21 +93,41 @@ def optimize_pick_route():
     if not SERVICE.ready():
         return Response('waiting for warm-up', status=503)
 
-    # Read request content
-    req = json.loads(request.get_data(as_text=True))
-    warehouse_tag = str(_get(req, '_meta.warehouse.tag'))
+    # Read and validate request content
+    try:
+        req = OptimizationRequest.decode(request.get_data())
+        coords_format = parse_coords_format(request.headers.get(COORDS_FORMAT_HEADER))
+    except ValueError as exc:
+        print('Error: ' + str(exc))
+        return Response(CODEC.dumps({'error': str(exc)}), status=400)
 
+    warehouse_tag = req.warehouse_tag
     if warehouse_tag.lower() == 'demo':
         warehouse_tag = 'DADC'
 
-    # Perform optimization
-    handler = Handler(req, SERVICE.wh_dict(), warehouse_tag)
-    if len(handler.solve_dict['coords_path_bef_sol']) <= 6:
-        TrivialInstanceSolver(handler.solve_dict)
-        # brute force search (but still very fast since there are very few nodes in this case)
-    else:
-        pass
-        # INSERT SOLVER with input = handler.solve_dict
+    try:
+        warehouse = SERVICE.warehouse(warehouse_tag, req.warehouse_uuid)
+    except KeyError as exc:
+        print('Error: ' + str(exc))
+        return Response(CODEC.dumps({'error': str(exc)}), status=404)
+
+    # Perform optimization, unless the same picks were solved before
+    try:
+        handler = Handler(req, warehouse, warehouse_tag, coords_format)
+    except UnknownLocations as exc:
+        print('Error: ' + str(exc))
+        return Response(CODEC.dumps({'error': str(exc), 'unknownLocations': exc.locations}),
+                        status=400, mimetype='application/json')
+    except KeyError as exc:
+        print('Error: ' + str(exc))
+        return Response(CODEC.dumps({'error': str(exc)}), status=404)
+    if not ROUTE_CACHE.apply(handler.solve_dict):
+        try:
+            SOLVER_EXECUTOR.solve(handler.solve_dict, time.time() + SOLVE_TIMEOUT)
+        except TimeoutError as exc:
+            print('Error: ' + str(exc))
+            return Response(CODEC.dumps({'error': str(exc)}), status=504)
+        ROUTE_CACHE.store(handler.solve_dict)
     client_response, bq_hist, bq_optim = handler.gen_response(handler.solve_dict)
     # HENCE this returns all finished jsons as in Legacy. As much as this as possible of this
     # functionality should be moved to api
@@ -83,7 +144,8 @@ def optimize_pick_route():
 def optimize_single_batch():
     """
     optimize_single_batch
-    :return:
+    Queues the optimization of a task from the tasks table.
+    :return: 202 with the task status, or 503 if the batch queue is full.
     """
     print('/singlebatch')
     if not SERVICE.ready():
@@ -91,53 +153,52 @@ def optimize_single_batch():
 
     # Read request content
     # Source: https://cloud.google.com/tasks/docs/creating-appengine-handlers
-    req = json.loads(request.get_data(as_text=True))
-    # warehouse_uuid = str(_get(req, '_meta.warehouse.uuid'))
-    warehouse_tag = str(_get(req, '_meta.warehouse.tag'))
+    # The payload is read from the tasks table, the body only refers to it
+    try:
+        req = OptimizationRequest.decode(request.get_data(), require_task_id=True,
+                                         require_data=False)
+        coords_format = parse_coords_format(request.headers.get(COORDS_FORMAT_HEADER))
+    except ValueError as exc:
+        print('Error: ' + str(exc))
+        return CODEC.dumps({
+            'error': str(exc)
+        })
 
+    warehouse_tag = req.warehouse_tag
     if warehouse_tag.lower() == 'demo':
         warehouse_tag = 'DADC'
 
     # Get task ID
-    task_id = _get(req, '_meta.taskId')
-    if task_id is None:
-        print('Error: Task ID is invalid: ' + str(task_id))
-        return json.dumps({
-            'error': 'Task ID is invalid: ' + str(task_id)
-        })
+    task_id = req.task_id
     if not TASKS.has_task(task_id):
         print('Error: No task with task ID: ' + task_id)
-        return json.dumps({
+        return CODEC.dumps({
             'error': 'No task with task ID: ' + task_id
         })
 
+    # Optimization runs in the background, poll /singlebatch/<task ID> for the result
+    if not BATCH_JOBS.submit(task_id, warehouse_tag, req.warehouse_uuid, coords_format):
+        print('Error: batch queue is full, task ' + task_id + ' refused')
+        return Response(CODEC.dumps({'error': 'Batch queue is full'}), status=503,
+                        headers={'Retry-After': '30'}, mimetype='application/json')
+    return Response(CODEC.dumps({'taskId': task_id, 'status': 'waiting'}), status=202,
+                    mimetype='application/json')
+
+
+@APP.route('/singlebatch/<task_id>', methods=['GET'])
+def single_batch_status(task_id):
+    """
+    Polling endpoint for batch tasks.
+    :param task_id:
+    :return: Status of the task, and its result once it is done or failed.
+    """
     try:
-        # Read payload and update tasks table
-        data = TASKS.get_payload(task_id)
-        TASKS.set_status(task_id, 'running')
-
-        handler = Handler(data, SERVICE.wh_dict(), warehouse_tag)
-        # INSERT SOLVER HERE e.g. SingleBatchOptimizer(handler.solve_dict)
-        # client_response, _, bq_optim = handler.gen_response(handler.solve_dict, warehouse_uuid)
-        client_response, _, bq_optim = handler.gen_response(handler.solve_dict)
-        BQ.batching(bq_optim)
-
-        # Update tasks table
-        TASKS.set_result(task_id, client_response)
-        TASKS.set_status(task_id, 'done')
-
-        # Return results
-        return client_response
-    except Exception as exc:
-        # If optimization failed, put error message in the results field and set status to failed
-        TASKS.set_result(task_id, str(exc))
-        TASKS.set_status(task_id, 'failed')
-
-        # Return empty string
-        print('Error: ' + str(exc))
-        return json.dumps({
-            'error': str(exc)
-        })
+        status, result = TASKS.get_task(task_id)
+    except KeyError as exc:
+        return Response(CODEC.dumps({'error': str(exc)}), status=404,
+                        mimetype='application/json')
+    return Response(CODEC.dumps({'taskId': task_id, 'status': status, 'result': result}),
+                    status=200, mimetype='application/json')
 
 
 if __name__ == '__main__':
@@ -145,5 +206,4 @@ if __name__ == '__main__':
     print('starting...')
     PORT = os.environ.get('PORT', 8080)
     if not TE.is_prod():
-        SERVICE.warm_up()
         APP.run(host='localhost', port=PORT, debug=True)
@@ -0,0 +1,157 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+DistanceMatrix
+
+distmat is symmetric and its distances are small integers (mm, cm or
+dm), yet it is usually loaded as a dense matrix of int64. DistanceMatrix
+holds only the upper triangle, diagonal included, packed row by row in
+the narrowest unsigned dtype the distances fit in. With uint16 that is
+8 times less memory than the dense int64 matrix, 4 times with uint32.
+'''
+
+import numpy as np
+
+
+class DistanceMatrix:
+    """
+    Symmetric distance matrix stored as its packed upper triangle.
+    Lookups work like on the dense matrix: d[i, j] for one pair and
+    d[rows, cols] elementwise for arrays of rows and columns.
+
+    :class: DistanceMatrix
+    """
+    __slots__ = ('packed', 'num_nodes')
+
+    # Unsigned dtypes tried in order by from_dense
+    DTYPES = (np.uint16, np.uint32, np.uint64)
+
+    def __init__(self, packed, num_nodes):
+        """
+        Constructor.
+
+        :param packed: Upper triangle of the matrix, row by row, see index().
+        :param num_nodes: Number of rows (and columns) of the matrix.
+        """
+        if len(packed) != num_nodes * (num_nodes + 1) // 2:
+            raise ValueError('{} values do not make the upper triangle of {} nodes'.format(
+                len(packed), num_nodes))
+        self.packed = packed.view()
+        self.packed.setflags(write=False)
+        self.num_nodes = num_nodes
+
+    @staticmethod
+    def from_dense(distmat):
+        """
+        Packs a dense distance matrix. It is read one row at a time,
+        once to check it and find the dtype and once to pack it, so a
+        memory-mapped matrix is never loaded all at once.
+
+        :param distmat: Symmetric matrix of non-negative integer distances.
+        :raises: ValueError if distmat is not symmetric or has distances
+                 that are negative or not integers.
+        :return: DistanceMatrix in the narrowest dtype holding the distances.
+        """
+        num_nodes = len(distmat)
+        largest = 0
+        for row in range(num_nodes):
+            values = np.asarray(distmat[row, row:])
+            if not np.array_equal(values, np.asarray(distmat[row:, row])):
+                raise ValueError('distmat is not symmetric in row {}'.format(row))
+            if values.min() < 0:
+                raise ValueError('distmat has negative distances in row {}'.format(row))
+            if values.dtype.kind == 'f' and not np.array_equal(values, np.floor(values)):
+                raise ValueError('distmat has distances that are not integers in row {}'.format(row))
+            largest = max(largest, int(values.max()))
+
+        dtype = next(dtype for dtype in DistanceMatrix.DTYPES if largest <= np.iinfo(dtype).max)
+        packed = np.empty(num_nodes * (num_nodes + 1) // 2, dtype=dtype)
+        start = 0
+        for row in range(num_nodes):
+            packed[start:start + num_nodes - row] = distmat[row, row:]
+            start += num_nodes - row
+        return DistanceMatrix(packed, num_nodes)
+
+    @property
+    def dtype(self):
+        """
+        dtype of the distances.
+        """
+        return self.packed.dtype
+
+    @property
+    def shape(self):
+        """
+        Shape of the dense matrix.
+        """
+        return self.num_nodes, self.num_nodes
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the distances.
+        """
+        return self.packed.nbytes
+
+    def __len__(self):
+        return self.num_nodes
+
+    def index(self, rows, cols):
+        """
+        Positions of (rows, cols) in packed. Works elementwise, and with
+        broadcasting, on arrays.
+
+        :param rows:
+        :param cols:
+        :return:
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        upper = np.minimum(rows, cols)
+        return upper * self.num_nodes - (upper * (upper + 1)) // 2 + np.maximum(rows, cols)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        return self.packed[self.index(rows, cols)]
+
+    def submatrix(self, nodes):
+        """
+        Dense distance matrix of some nodes, in the same order.
+
+        :param nodes: Node indices.
+        :return: Array of shape (len(nodes), len(nodes)).
+        """
+        nodes = np.asarray(nodes, dtype=np.int64).flatten()
+        # Row i, column j is in the row of node i unless node j comes
+        # first, then it is mirrored from row j
+        row_starts = nodes * self.num_nodes - (nodes * (nodes + 1)) // 2
+        positions = row_starts[:, None] + nodes[None, :]
+        lower = nodes[:, None] > nodes[None, :]
+        positions[lower] = positions.T[lower]
+        return self.packed[positions]
+
+
+def as_matrix(distmat):
+    """
+    Returns distmat as something that supports distmat[rows, cols]
+    lookups: a DistanceMatrix as it is, anything else as an array.
+
+    :param distmat: DistanceMatrix or dense distance matrix.
+    :return:
+    """
+    return distmat if isinstance(distmat, DistanceMatrix) else np.asarray(distmat)
+
+
+def submatrix(distmat, nodes):
+    """
+    Dense distance matrix of a request's nodes.
+
+    :param distmat: DistanceMatrix or dense distance matrix.
+    :param nodes: Node indices.
+    :return: Array of shape (len(nodes), len(nodes)).
+    """
+    if isinstance(distmat, DistanceMatrix):
+        return distmat.submatrix(nodes)
+    return np.asarray(distmat)[np.ix_(nodes, nodes)]
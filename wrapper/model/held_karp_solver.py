@@ -0,0 +1,122 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+HeldKarpSolver
+'''
+
+import time
+import numpy as np
+
+from model.trivial_instance_solver import TrivialInstanceSolver
+from model.distance_matrix import submatrix
+
+
+class HeldKarpSolver:
+    """
+    Exact solver for medium sized pick routes. Held-Karp dynamic
+    programming over subsets of picks (bitmasks), giving the optimal
+    open path from start depot to end depot.
+    """
+
+    # Memory and time grow as 2^n * n, 16 picks solve in tens of ms
+    MAX_PICKS = 16
+
+    # int32 cost of subset/end pick combinations not reached yet
+    UNREACHED = 2 ** 30
+
+    # num_picks -> list of (pick, masks, prev_masks) ordered by subset size
+    _transitions = {}
+
+    def __init__(self, solve_dict):
+        time0 = time.time()
+        metric = solve_dict['metric']
+        dist_adj_mat = solve_dict['distmat']
+        node_seq_bef_sol = solve_dict['node_seq_bef_sol']
+        self.lg_sol_fitness = TrivialInstanceSolver.getdist(dist_adj_mat, node_seq_bef_sol, metric)
+        self.solver_sol, self.node_seq_aft_sol = \
+            HeldKarpSolver.solve_instance(node_seq_bef_sol, dist_adj_mat)
+        self.solver_sol_fitness = TrivialInstanceSolver.getdist(dist_adj_mat, self.node_seq_aft_sol, metric)
+        self.solve_dict = solve_dict
+        self.solve_dict['lg_sol_fitness'] = self.lg_sol_fitness
+        self.solve_dict['solver_sol'] = self.solver_sol
+        self.solve_dict['solver_sol_fitness'] = self.solver_sol_fitness
+        self.solve_dict['node_seq_aft_sol'] = self.node_seq_aft_sol
+        self.solve_dict['time_to_optimize'] = time.time()-time0
+
+    @staticmethod
+    def transitions(num_picks):
+        """
+        Returns, and caches, the DP transitions for num_picks picks. For
+        every subset size and every pick j it holds the subsets of that
+        size containing j together with the same subsets without j.
+
+        :param num_picks:
+        :return:
+        """
+        if num_picks not in HeldKarpSolver._transitions:
+            masks = np.arange(1 << num_picks)
+            popcount = np.zeros(len(masks), dtype=np.int64)
+            for pick in range(num_picks):
+                popcount += (masks >> pick) & 1
+            layers = []
+            for size in range(2, num_picks + 1):
+                layer = masks[popcount == size]
+                for pick in range(num_picks):
+                    with_pick = layer[(layer >> pick) & 1 == 1]
+                    layers.append((pick, with_pick, with_pick ^ (1 << pick)))
+            HeldKarpSolver._transitions[num_picks] = layers
+        return HeldKarpSolver._transitions[num_picks]
+
+    @staticmethod
+    def solve_instance(locs, distmat):
+        """
+        Solves the route given by locs, which INCLUDES START AND END
+        depots, to optimality.
+
+        :param locs: Node sequence before optimization.
+        :param distmat: Distance matrix of the warehouse, dense or a DistanceMatrix.
+        :return: (solver_sol, node_seq_aft_sol) where solver_sol[k] is
+                 the position in locs of the k:th visited node.
+        """
+        nodes = np.asarray(locs).flatten()
+        num_picks = len(nodes) - 2
+        if num_picks > HeldKarpSolver.MAX_PICKS:
+            raise ValueError('Too many picks for Held-Karp: ' + str(num_picks))
+        if num_picks < 2:
+            return list(range(len(nodes))), list(nodes.tolist())
+
+        submat = submatrix(distmat, nodes)
+        if submat.dtype.kind == 'f':
+            dtype, unreached = np.float64, np.inf
+        elif int(submat.max()) * len(nodes) < HeldKarpSolver.UNREACHED:
+            # int32 halves the memory traffic of the DP
+            dtype, unreached = np.int32, HeldKarpSolver.UNREACHED
+        else:
+            dtype, unreached = np.int64, np.iinfo(np.int64).max // 2
+        submat = submat.astype(dtype)
+        pick_dists = submat[1:-1, 1:-1]
+
+        # cost[mask, j]: shortest path from start depot through the picks
+        # in mask, ending at pick j
+        full = (1 << num_picks) - 1
+        cost = np.full((full + 1, num_picks), unreached, dtype=dtype)
+        picks = np.arange(num_picks)
+        cost[1 << picks, picks] = submat[0, 1:-1]
+
+        for pick, masks, prev_masks in HeldKarpSolver.transitions(num_picks):
+            cost[masks, pick] = (cost[prev_masks] + pick_dists[:, pick]).min(axis=1)
+
+        # Walk back from the end depot, redoing the argmin of each step
+        # instead of keeping a parent table
+        last = int(np.argmin(cost[full] + submat[1:-1, -1]))
+        order = [last + 1]
+        mask = full ^ (1 << last)
+        while mask:
+            last = int(np.argmin(cost[mask] + pick_dists[:, last]))
+            order.append(last + 1)
+            mask ^= 1 << last
+        tour = [0] + order[::-1] + [len(nodes) - 1]
+
+        return tour, list(nodes[tour].tolist())
@@ -0,0 +1,198 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+HeuristicSolver
+'''
+
+import time
+import numpy as np
+
+from model.trivial_instance_solver import TrivialInstanceSolver
+from model.distance_matrix import submatrix
+
+
+class HeuristicSolver:
+    """
+    Solves open pick routes (fixed start and end depot) of any size with
+    nearest neighbour construction followed by 2-opt and Or-opt local
+    search. The warehouse graph is bi-directional so distmat is assumed
+    to be symmetric.
+    """
+
+    # Seconds, the whole solve including construction
+    DEFAULT_TIME_BUDGET = 0.15
+
+    # Longest segment moved by Or-opt
+    OR_OPT_MAX_SEGMENT = 3
+
+    def __init__(self, solve_dict, time_budget=DEFAULT_TIME_BUDGET):
+        time0 = time.time()
+        deadline = time0 + time_budget
+        metric = solve_dict['metric']
+        dist_adj_mat = solve_dict['distmat']
+        node_seq_bef_sol = solve_dict['node_seq_bef_sol']
+        self.lg_sol_fitness = TrivialInstanceSolver.getdist(dist_adj_mat, node_seq_bef_sol, metric)
+        self.solver_sol, self.node_seq_aft_sol = \
+            HeuristicSolver.solve_instance(node_seq_bef_sol, dist_adj_mat, deadline)
+        self.solver_sol_fitness = TrivialInstanceSolver.getdist(dist_adj_mat, self.node_seq_aft_sol, metric)
+        self.solve_dict = solve_dict
+        self.solve_dict['lg_sol_fitness'] = self.lg_sol_fitness
+        self.solve_dict['solver_sol'] = self.solver_sol
+        self.solve_dict['solver_sol_fitness'] = self.solver_sol_fitness
+        self.solve_dict['node_seq_aft_sol'] = self.node_seq_aft_sol
+        self.solve_dict['time_to_optimize'] = time.time()-time0
+
+    @staticmethod
+    def solve_instance(locs, distmat, deadline):
+        """
+        Solves the route given by locs, which INCLUDES START AND END
+        depots. The search works on positions in locs rather than on
+        node indices, so duplicate pick locations are handled without
+        any remapping.
+
+        :param locs: Node sequence before optimization.
+        :param distmat: Distance matrix of the warehouse, dense or a DistanceMatrix.
+        :param deadline: time.time() value at which the search stops.
+        :return: (solver_sol, node_seq_aft_sol) where solver_sol[k] is
+                 the position in locs of the k:th visited node.
+        """
+        nodes = np.asarray(locs).flatten()
+        submat = submatrix(distmat, nodes)
+        if submat.dtype.kind in 'ub':
+            # deltas below are signed
+            submat = submat.astype(np.int64)
+
+        tour = HeuristicSolver.nearest_neighbour(submat)
+        improved = True
+        while improved and time.time() < deadline:
+            improved = HeuristicSolver.two_opt(submat, tour, deadline)
+            improved = HeuristicSolver.or_opt(submat, tour, deadline) or improved
+
+        return list(tour.tolist()), list(nodes[tour].tolist())
+
+    @staticmethod
+    def nearest_neighbour(submat):
+        """
+        Greedy construction from the start depot (position 0) that always
+        walks to the closest unvisited pick and finally to the end depot
+        (last position).
+
+        :param submat: Distance matrix of the request's nodes.
+        :return: Tour as an array of positions.
+        """
+        num_nodes = len(submat)
+        tour = np.arange(num_nodes)
+        if num_nodes <= 3:
+            return tour
+
+        unvisited = np.ones(num_nodes, dtype=bool)
+        unvisited[0] = False
+        unvisited[-1] = False
+        current = 0
+        for k in range(1, num_nodes - 1):
+            candidates = np.flatnonzero(unvisited)
+            current = candidates[np.argmin(submat[current, candidates])]
+            tour[k] = current
+            unvisited[current] = False
+        return tour
+
+    @staticmethod
+    def two_opt(submat, tour, deadline):
+        """
+        Best improvement 2-opt. Reverses tour[i+1:j+1] in place as long
+        as it shortens the route. The depots at both ends never move.
+
+        :param submat: Distance matrix of the request's nodes.
+        :param tour: Tour as an array of positions, modified in place.
+        :param deadline: time.time() value at which the search stops.
+        :return: True if the tour was improved.
+        """
+        num_nodes = len(tour)
+        if num_nodes < 4:
+            return False
+
+        improved = False
+        upper = np.triu(np.ones((num_nodes - 1, num_nodes - 1), dtype=bool), 1)
+        while time.time() < deadline:
+            heads = tour[:-1]
+            tails = tour[1:]
+            edge_len = submat[heads, tails]
+            # delta[i, j] for removing edges (i, i+1), (j, j+1) and
+            # adding (i, j), (i+1, j+1)
+            delta = submat[heads[:, None], heads[None, :]] + \
+                submat[tails[:, None], tails[None, :]] - \
+                edge_len[:, None] - edge_len[None, :]
+            delta[~upper] = 0
+            best = np.argmin(delta)
+            i, j = divmod(int(best), num_nodes - 1)
+            if delta[i, j] >= 0:
+                break
+            tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1].copy()
+            improved = True
+        return improved
+
+    @staticmethod
+    def or_opt(submat, tour, deadline):
+        """
+        Or-opt. Moves segments of up to OR_OPT_MAX_SEGMENT picks, possibly
+        reversed, to the best position elsewhere in the tour. Applies the
+        best move found per segment length until no move improves.
+
+        :param submat: Distance matrix of the request's nodes.
+        :param tour: Tour as an array of positions, modified in place.
+        :param deadline: time.time() value at which the search stops.
+        :return: True if the tour was improved.
+        """
+        num_nodes = len(tour)
+        improved = False
+        moved = True
+        while moved and time.time() < deadline:
+            moved = False
+            for seg_len in range(1, HeuristicSolver.OR_OPT_MAX_SEGMENT + 1):
+                # segments tour[s:s+seg_len] with 1 <= s and s+seg_len <= num_nodes-1
+                num_segs = num_nodes - 1 - seg_len
+                if num_segs < 1 or num_nodes - seg_len < 3:
+                    break
+                starts = np.arange(1, num_segs + 1)
+                firsts = tour[starts]
+                lasts = tour[starts + seg_len - 1]
+                prevs = tour[starts - 1]
+                nexts = tour[starts + seg_len]
+                gain = submat[prevs, firsts] + submat[lasts, nexts] - submat[prevs, nexts]
+
+                # insertion between tour[k] and tour[k+1]
+                heads = tour[:-1]
+                tails = tour[1:]
+                edge_len = submat[heads, tails]
+                forward = submat[heads[None, :], firsts[:, None]] + \
+                    submat[lasts[:, None], tails[None, :]] - edge_len[None, :]
+                backward = submat[heads[None, :], lasts[:, None]] + \
+                    submat[firsts[:, None], tails[None, :]] - edge_len[None, :]
+                cost = np.minimum(forward, backward) - gain[:, None]
+
+                # the insertion edge must lie outside the segment and its
+                # neighbouring edges, i.e. k < s-1 or k > s+seg_len-1
+                edges = np.arange(num_nodes - 1)
+                valid = (edges[None, :] < starts[:, None] - 1) | \
+                    (edges[None, :] > starts[:, None] + seg_len - 1)
+                cost = np.where(valid, cost, 0)
+                best = np.argmin(cost)
+                seg, k = divmod(int(best), num_nodes - 1)
+                if cost[seg, k] >= 0:
+                    continue
+
+                start = int(starts[seg])
+                segment = tour[start:start + seg_len].copy()
+                if backward[seg, k] < forward[seg, k]:
+                    segment = segment[::-1]
+                rest = np.concatenate((tour[:start], tour[start + seg_len:]))
+                # position of edge k in rest
+                insert_at = k + 1 if k < start else k + 1 - seg_len
+                tour[:] = np.concatenate((rest[:insert_at], segment, rest[insert_at:]))
+                moved = True
+                improved = True
+                if time.time() >= deadline:
+                    break
+        return improved
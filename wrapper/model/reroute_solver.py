@@ -0,0 +1,85 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+RerouteSolver
+'''
+
+import time
+import numpy as np
+
+from model.trivial_instance_solver import TrivialInstanceSolver
+from model.held_karp_solver import HeldKarpSolver
+from model.heuristic_solver import HeuristicSolver
+from model.distance_matrix import submatrix
+
+
+class RerouteSolver:
+    """
+    Re-optimizes a pick round for a picker that left the planned route.
+    The request holds the remaining picks in the previously optimized
+    order, with the picker's current location as start node. That order
+    is the starting solution. Only the head of the route depends on
+    where the picker is now, so the first picks are re-solved exactly
+    with both ends of the head fixed, and 2-opt/Or-opt then repair what
+    else got worse. The result is never longer than following the
+    previous order.
+    """
+
+    # Seconds, a reroute should be answered in a few milliseconds
+    DEFAULT_TIME_BUDGET = 0.02
+
+    # Picks at the head of the route that are re-solved exactly
+    REPAIR_WINDOW = 8
+
+    def __init__(self, solve_dict, time_budget=DEFAULT_TIME_BUDGET):
+        time0 = time.time()
+        deadline = time0 + time_budget
+        metric = solve_dict['metric']
+        dist_adj_mat = solve_dict['distmat']
+        node_seq_bef_sol = solve_dict['node_seq_bef_sol']
+        self.lg_sol_fitness = TrivialInstanceSolver.getdist(dist_adj_mat, node_seq_bef_sol, metric)
+        self.solver_sol, self.node_seq_aft_sol = \
+            RerouteSolver.solve_instance(node_seq_bef_sol, dist_adj_mat, deadline)
+        self.solver_sol_fitness = TrivialInstanceSolver.getdist(dist_adj_mat, self.node_seq_aft_sol, metric)
+        self.solve_dict = solve_dict
+        self.solve_dict['lg_sol_fitness'] = self.lg_sol_fitness
+        self.solve_dict['solver_sol'] = self.solver_sol
+        self.solve_dict['solver_sol_fitness'] = self.solver_sol_fitness
+        self.solve_dict['node_seq_aft_sol'] = self.node_seq_aft_sol
+        self.solve_dict['time_to_optimize'] = time.time()-time0
+
+    @staticmethod
+    def solve_instance(locs, distmat, deadline):
+        """
+        Repairs the route given by locs, which INCLUDES the current
+        location as start and the end depot, starting from the order of
+        locs.
+
+        :param locs: Node sequence before optimization, the previous order.
+        :param distmat: Distance matrix of the warehouse, dense or a DistanceMatrix.
+        :param deadline: time.time() value at which the local search stops.
+        :return: (solver_sol, node_seq_aft_sol) where solver_sol[k] is
+                 the position in locs of the k:th visited node.
+        """
+        nodes = np.asarray(locs).flatten()
+        submat = submatrix(distmat, nodes)
+        if submat.dtype.kind in 'ub':
+            # deltas of the local search are signed
+            submat = submat.astype(np.int64)
+
+        tour = np.arange(len(nodes))
+        window = min(RerouteSolver.REPAIR_WINDOW, len(nodes) - 2)
+        if window >= 2:
+            # Tour positions double as node indices of submat, from the
+            # current location through the window to the pick after it
+            _, head = HeldKarpSolver.solve_instance(tour[:window + 2], submat)
+            tour[:window + 2] = head
+
+        improved = True
+        while improved and time.time() < deadline:
+            improved = HeuristicSolver.two_opt(submat, tour, deadline)
+            improved = HeuristicSolver.or_opt(submat, tour, deadline) or improved
+
+        return list(tour.tolist()), list(nodes[tour].tolist())
@@ -0,0 +1,228 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+SolverExecutor
+
+Runs solvers in a pool of worker processes, so that solves do not
+share the GIL of the request threads. The pool is forked when the
+executor is started, before any warehouse data is loaded. Workers
+memory-map distmat from the warehouse store themselves (see
+utils/wh_store.py), so a request only sends its node sequence and gets
+the solution back, the page cache holds one copy of distmat for all
+processes. Warehouses without a store are solved in the calling
+thread.
+
+Every solve has a deadline. The heuristic solver gets the time left
+as its time budget, a solve that is still waiting for a worker at its
+deadline is cancelled, and the caller gets a TimeoutError if the
+result is not there by the deadline.
+'''
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from model.trivial_instance_solver import TrivialInstanceSolver
+from model.held_karp_solver import HeldKarpSolver
+from model.heuristic_solver import HeuristicSolver
+from model.reroute_solver import RerouteSolver
+from utils.wh_store import has_store, read_manifest, load_array
+
+# Keys a solver fills in solve_dict
+RESULT_KEYS = (
+    'lg_sol_fitness',
+    'solver_sol',
+    'solver_sol_fitness',
+    'node_seq_aft_sol',
+    'time_to_optimize'
+)
+
+# Seconds, default time from the start of a solve to its deadline
+DEFAULT_TIMEOUT = 5.0
+
+# Seconds, time allowed for sending the result back after the deadline
+GRACE = 0.5
+
+# distmat of every store attached in this worker process, by
+# (data path, store version)
+_DISTMATS = {}
+
+
+def solve(solve_dict, time_budget=HeuristicSolver.DEFAULT_TIME_BUDGET):
+    """
+    Picks a solver for the size of the route and runs it in this
+    process. Start and end depot are not picks. Reroutes repair the
+    order they were sent in, see RerouteSolver.
+
+    :param solve_dict: Needs 'metric', 'distmat', 'node_seq_bef_sol' and
+                       optionally 'is_reroute_req', gets the RESULT_KEYS.
+    :param time_budget: Time budget of the heuristic solver in seconds.
+    """
+    num_nodes = len(solve_dict['node_seq_bef_sol'])
+    if num_nodes <= 6:
+        # brute force search (but still very fast since there are very few nodes in this case)
+        TrivialInstanceSolver(solve_dict)
+    elif solve_dict.get('is_reroute_req'):
+        RerouteSolver(solve_dict, min(RerouteSolver.DEFAULT_TIME_BUDGET, time_budget))
+    elif num_nodes - 2 <= HeldKarpSolver.MAX_PICKS:
+        # exact
+        HeldKarpSolver(solve_dict)
+    else:
+        HeuristicSolver(solve_dict, time_budget)
+
+
+def _attach(data_path, data_version):
+    """
+    Returns the memory-mapped distmat of a store, mapping it on first use
+    of every version. Older versions of the same store are dropped.
+
+    :return: The distmat, None if the store on disk is not data_version.
+    """
+    key = (data_path, data_version)
+    if key not in _DISTMATS:
+        manifest = read_manifest(data_path)
+        if manifest.get('version') != data_version:
+            return None
+        for old_key in [old_key for old_key in _DISTMATS if old_key[0] == data_path]:
+            del _DISTMATS[old_key]
+        entry = manifest['files']['distmat']
+        _DISTMATS[key] = load_array('{}/{}'.format(data_path, entry['file']), entry)
+    return _DISTMATS[key]
+
+
+def _solve_in_worker(data_path, data_version, metric, node_seq_bef_sol, is_reroute_req,
+                     deadline):
+    """
+    Solves a route in a worker process.
+
+    :raises: TimeoutError if the deadline passed before the solve started.
+    :return: Dictionary with the RESULT_KEYS, None if the store was
+             replaced by another version on disk.
+    """
+    time_left = deadline - time.time()
+    if time_left <= 0:
+        raise TimeoutError('Deadline passed before the solve started')
+    distmat = _attach(data_path, data_version)
+    if distmat is None:
+        return None
+    solve_dict = {
+        'metric': metric,
+        'distmat': distmat,
+        'node_seq_bef_sol': node_seq_bef_sol,
+        'is_reroute_req': is_reroute_req
+    }
+    solve(solve_dict, min(HeuristicSolver.DEFAULT_TIME_BUDGET, time_left))
+    return {key: solve_dict[key] for key in RESULT_KEYS}
+
+
+def _worker_ready():
+    """
+    No-op submitted to every worker on start, returns its pid.
+    """
+    return os.getpid()
+
+
+class SolverExecutor:
+    """
+    Process pool running solvers.
+
+    :class: SolverExecutor
+    """
+    def __init__(self, workers=None):
+        """
+        Constructor, the pool is created by start().
+
+        :param workers: Number of worker processes, TENSHI_SOLVER_WORKERS
+                        or half of the CPUs (at least one) if None, the
+                        batch pool gets the others. 0 solves every route
+                        in the calling thread.
+        """
+        if workers is None:
+            workers = os.environ.get('TENSHI_SOLVER_WORKERS')
+        self._workers = max(1, (os.cpu_count() or 1) // 2) if workers is None else int(workers)
+        self._pool = None
+
+    @property
+    def workers(self):
+        """
+        Number of worker processes, 0 if routes are solved in the
+        calling thread.
+        """
+        return self._workers
+
+    def start(self):
+        """
+        Forks the worker processes. Call it before other threads are
+        started, forking copies no threads, so locks held by them at the
+        time of the fork would never be released in the workers.
+        :return: The pids of the workers that answered the start-up no-op.
+        """
+        if self._workers <= 0 or self._pool is not None:
+            return []
+        self._pool = ProcessPoolExecutor(max_workers=self._workers,
+                                         mp_context=multiprocessing.get_context('fork'))
+        return sorted({future.result() for future in
+                       [self._pool.submit(_worker_ready) for _ in range(self._workers)]})
+
+    def shutdown(self):
+        """
+        Stops the worker processes once they are done with their solves.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def solve(self, solve_dict, deadline=None):
+        """
+        Solves the route of solve_dict and fills in the RESULT_KEYS.
+
+        :param solve_dict: solve_dict of the request.
+        :param deadline: Time (time.time()) the solution is needed by,
+                         DEFAULT_TIMEOUT from now if None.
+        :raises: TimeoutError if there is no solution by the deadline.
+        """
+        if deadline is None:
+            deadline = time.time() + DEFAULT_TIMEOUT
+        data_path = solve_dict.get('data_path')
+        if self._pool is None or data_path is None or not has_store(data_path):
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                raise TimeoutError('Deadline passed before the solve started')
+            solve(solve_dict, min(HeuristicSolver.DEFAULT_TIME_BUDGET, time_left))
+            return
+
+        node_seq_bef_sol = [int(node) for node in solve_dict['node_seq_bef_sol']]
+        try:
+            future = self._pool.submit(_solve_in_worker, data_path,
+                                       solve_dict.get('data_version'), solve_dict['metric'],
+                                       node_seq_bef_sol, solve_dict.get('is_reroute_req'),
+                                       deadline)
+            results = future.result(timeout=max(0.0, deadline - time.time()) + GRACE)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError('No solution by the deadline')
+        except BrokenProcessPool:
+            # A worker died. Forking a new pool now would copy the request
+            # threads' locks, so solve in the calling thread from now on.
+            print('SolverExecutor: worker pool broken, solving in request threads')
+            self.shutdown()
+            solve(solve_dict, min(HeuristicSolver.DEFAULT_TIME_BUDGET,
+                                  max(0.0, deadline - time.time())))
+            return
+        if results is None:
+            # The store is being replaced, solve_dict still has the
+            # distmat of its version
+            solve(solve_dict, min(HeuristicSolver.DEFAULT_TIME_BUDGET,
+                                  max(0.0, deadline - time.time())))
+            return
+        for key in RESULT_KEYS:
+            solve_dict[key] = results[key]
+
+
+# Singleton
+SOLVER_EXECUTOR = SolverExecutor()
@@ -10,6 +10,8 @@ import itertools
 import time
 import numpy as np
 
+from model.distance_matrix import as_matrix, submatrix
+
 
 class TrivialInstanceSolver:
     """
@@ -22,6 +24,9 @@ class TrivialInstanceSolver:
         'dm': 10.0
     }
 
+    # num_nodes -> all candidate routes, see routes()
+    _routes = {}
+
     def __init__(self, solve_dict):
         time0 = time.time()
         metric = solve_dict['metric']
@@ -39,45 +44,49 @@ class TrivialInstanceSolver:
         self.solve_dict['node_seq_aft_sol'] = self.node_seq_aft_sol
         self.solve_dict['time_to_optimize'] = time.time()-time0
 
+    @staticmethod
+    def routes(num_nodes):
+        """
+        Returns, and caches, every candidate route over num_nodes
+        positions as one array, one route per row, all starting at
+        position 0 (start depot) and ending at position num_nodes-1
+        (end depot). Rows follow itertools.permutations order.
+        :param num_nodes:
+        :return:
+        """
+        if num_nodes not in TrivialInstanceSolver._routes:
+            num_picks = num_nodes - 2
+            perms = list(itertools.permutations(range(1, num_picks + 1)))
+            perms = np.asarray(perms, dtype=np.intp).reshape(len(perms), num_picks)
+            routes = np.empty((len(perms), num_nodes), dtype=np.intp)
+            routes[:, 0] = 0
+            routes[:, 1:-1] = perms
+            routes[:, -1] = num_nodes - 1
+            TrivialInstanceSolver._routes[num_nodes] = routes
+        return TrivialInstanceSolver._routes[num_nodes]
+
     @staticmethod
     def solve_trivial_instance(locs, distmat):
 
         """
         #needed for when Concorde would otherwise fail - 4 items to pick
         #input locs INCLUDES START AND END depots
+        All candidate routes are scored at once on the request's
+        submatrix of distmat.
         :param locs:
         :param distmat:
-        :return:
+        :return: (solver_sol, node_seq_aft_sol) where solver_sol[k] is
+                 the position in locs of the k:th visited node.
         """
 
-        locs = locs.copy()
-        origlocs = np.asarray(locs.copy()).flatten()
-        end_depot_node_idx = locs[-1]
-        del locs[-1]
-        listofpermutations = list(itertools.permutations(locs[1:len(locs)]))
-        distlist = []
-        for perm in listofpermutations:
-            permwithstartandend = [0]+list(perm)+[end_depot_node_idx]
-            thisdist = 0
-            for i in range(0, len(permwithstartandend)-1):
-                thisdist += distmat[permwithstartandend[i]][permwithstartandend[i+1]]
-            distlist.append(thisdist)
-        distlist = np.asarray(distlist).flatten()
-        mindist = np.min(distlist)
-        index = np.argwhere(distlist == mindist).flatten()[0]
-        nodelabelsol = np.asarray([0] + list(listofpermutations[index]) + [end_depot_node_idx]).flatten()
-        unqs = np.unique(nodelabelsol)
-        unqsdicts = {}
-        for i in unqs.flatten():
-            unqsdicts[i] = {}
-            unqsdicts[i]['old'] = np.argwhere(origlocs == i).flatten()
-            unqsdicts[i]['new'] = np.argwhere(nodelabelsol == i).flatten()
-
-        nodeordersol = list(nodelabelsol).copy()
-        for i in list(unqsdicts.keys()):
-            for j in range(len(unqsdicts[i]['old'])):
-                nodeordersol[unqsdicts[i]['old'][j]] = unqsdicts[i]['new'][j]
-        return nodeordersol, nodelabelsol
+        nodes = np.asarray(locs).flatten()
+        if len(nodes) < 2:
+            return list(range(len(nodes))), list(nodes.tolist())
+        submat = submatrix(distmat, nodes)
+        routes = TrivialInstanceSolver.routes(len(nodes))
+        distlist = submat[routes[:, :-1], routes[:, 1:]].sum(axis=1)
+        nodeordersol = routes[np.argmin(distlist)]
+        return list(nodeordersol.tolist()), list(nodes[nodeordersol].tolist())
 
     @staticmethod
     def getdist(dist_adj_mat, indicies, metric):
@@ -98,9 +107,8 @@ class TrivialInstanceSolver:
 
         scale = TrivialInstanceSolver.SCALE_FACTORS[metric]
 
-        a_sol_distance = 0
-        for i in range(0, len(indicies)-1):
-            a_sol_distance = a_sol_distance + dist_adj_mat[indicies[i]][indicies[i+1]]
+        indicies = np.asarray(indicies).flatten()
+        a_sol_distance = as_matrix(dist_adj_mat)[indicies[:-1], indicies[1:]].sum()
         #print('Optimal Solution Distance in Meters', a_sol_distance/divisor_For_Meters)
 
         # TODO Remove this once passed tested
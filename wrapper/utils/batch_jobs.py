@@ -0,0 +1,224 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Batch job scheduler.
+
+/singlebatch only queues its task and returns. A dispatcher thread
+takes queued tasks, reads their payload, marks them running and runs
+the optimization in a process pool. When the optimization is done the
+task gets its result and status done, or its error and status failed,
+in the tasks table. Clients poll /singlebatch/<task id> for the result.
+
+At most as many tasks as there are worker processes run at once,
+waiting tasks are kept in a bounded queue and submit() refuses tasks
+when it is full.
+
+The worker processes are started by start() when the app is imported.
+They come from a forkserver, not from forking the app: the solver
+pool's threads are already running by then, and a fork would copy the
+locks they hold. The service loads the warehouse of a task before
+submitting it, and the workers read the files it downloaded,
+memory-mapped read only, and never download anything themselves.
+By default the batch pool gets the CPUs the solver pool leaves.
+'''
+
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from model.solver_executor import SOLVER_EXECUTOR
+from .bq import BQ
+from .codec import CODEC
+from .database import TASKS
+from .registry import REGISTRY
+from .request_types import OptimizationRequest
+
+
+def run_batch_job(payload, warehouse_tag, warehouse_uuid, coords_format):
+    """
+    Runs a batch optimization. Called in a worker process.
+
+    :param payload: Validated request payload of the task, an OptimizationRequest.
+    :param warehouse_tag:
+    :param warehouse_uuid:
+    :param coords_format: See coords_format.py.
+    :return: Tuple (client response, BigQuery row).
+    """
+    # Imported here, the scheduler itself does not need warehouse data
+    from .handler import Handler
+
+    handler = Handler(payload, REGISTRY.get(warehouse_tag, warehouse_uuid), warehouse_tag,
+                      coords_format)
+    # INSERT SOLVER HERE e.g. SingleBatchOptimizer(handler.solve_dict)
+    client_response, _, bq_optim = handler.gen_response(handler.solve_dict)
+    return client_response, bq_optim
+
+
+def _init_worker():
+    """
+    Initializer of the worker processes. Reads the registry manifest,
+    warehouse data is read from local files only.
+    """
+    try:
+        REGISTRY.load()
+    except (ValueError, IOError) as exc:
+        print('Error: batch worker could not load the registry: {}'.format(exc))
+    REGISTRY.use_local_data()
+
+
+def _worker_ready():
+    """
+    No-op submitted to every worker on start, returns its pid.
+    """
+    return os.getpid()
+
+
+class BatchJobs:
+    """
+    Bounded queue of batch tasks run in a process pool.
+
+    :class: BatchJobs
+    """
+    def __init__(self, workers=None, max_queue=None, executor=None, on_done=None):
+        """
+        Constructor. The worker processes are started by start(), the
+        dispatcher on the first submit.
+
+        :param workers: Number of worker processes, TENSHI_BATCH_WORKERS or
+                        the CPUs not used by the solver pool (at least
+                        one) if None.
+        :param max_queue: Maximum number of waiting tasks, TENSHI_BATCH_QUEUE
+                          or 64 if None.
+        :param executor: Executor to run jobs in instead of a process pool.
+        :param on_done: Optional callback, called as on_done(task_id, bq_row)
+                        when a task is done.
+        """
+        self._workers = int(workers or os.environ.get('TENSHI_BATCH_WORKERS') or
+                            max(1, (os.cpu_count() or 1) - SOLVER_EXECUTOR.workers))
+        self._queue = queue.Queue(maxsize=int(max_queue or
+                                              os.environ.get('TENSHI_BATCH_QUEUE', 64)))
+        self._executor = executor
+        self._on_done = on_done
+        self._running = threading.BoundedSemaphore(self._workers)
+        self._lock = threading.Lock()
+        self._dispatcher = None
+
+    def start(self):
+        """
+        Starts the worker processes, so the first task does not wait for
+        them.
+        :return: The pids of the workers that answered the start-up no-op.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return []
+            self._executor = self._new_executor()
+        return sorted({future.result() for future in
+                       [self._executor.submit(_worker_ready) for _ in range(self._workers)]})
+
+    def _new_executor(self):
+        """
+        Creates the process pool. Its workers come from a forkserver,
+        other threads may be running when it is created.
+        """
+        return ProcessPoolExecutor(max_workers=self._workers,
+                                   mp_context=multiprocessing.get_context('forkserver'),
+                                   initializer=_init_worker)
+
+    def submit(self, task_id, warehouse_tag, warehouse_uuid, coords_format):
+        """
+        Queues a task. Never blocks.
+
+        :param task_id: ID of a task in the tasks table.
+        :param warehouse_tag:
+        :param warehouse_uuid:
+        :param coords_format: See coords_format.py.
+        :return: True if the task was queued, False if the queue is full.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((task_id, warehouse_tag, warehouse_uuid, coords_format))
+        except queue.Full:
+            return False
+        return True
+
+    def waiting(self):
+        """
+        Returns the number of tasks waiting for a worker.
+        :return:
+        """
+        return self._queue.qsize()
+
+    def _start(self):
+        """
+        Starts the dispatcher, and the pool if start() was not called,
+        unless they are already started.
+        """
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            if self._executor is None:
+                self._executor = self._new_executor()
+            self._dispatcher = threading.Thread(target=self._dispatch, name='batch-jobs',
+                                                daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        """
+        Dispatcher loop, runs a waiting task whenever a worker is free.
+        """
+        while True:
+            # Wait for a free worker first, so waiting tasks stay in the queue
+            self._running.acquire()
+            task_id, warehouse_tag, warehouse_uuid, coords_format = self._queue.get()
+            try:
+                payload = OptimizationRequest.from_dict(TASKS.get_payload(task_id))
+                # Downloads the warehouse data for the workers if needed
+                REGISTRY.get(warehouse_tag, warehouse_uuid)
+                TASKS.set_status(task_id, 'running')
+                future = self._executor.submit(run_batch_job, payload, warehouse_tag,
+                                               warehouse_uuid, coords_format)
+            except Exception as exc:
+                self._running.release()
+                self._finish(task_id, None, exc)
+                continue
+            future.add_done_callback(
+                lambda future, task_id=task_id: self._done(task_id, future))
+
+    def _done(self, task_id, future):
+        """
+        Completion callback of a task.
+        """
+        self._running.release()
+        try:
+            client_response, bq_row = future.result()
+        except Exception as exc:
+            self._finish(task_id, None, exc)
+            return
+        self._finish(task_id, client_response, None)
+        if self._on_done is not None:
+            self._on_done(task_id, bq_row)
+
+    @staticmethod
+    def _finish(task_id, client_response, exc):
+        """
+        Stores the result or the error of a task.
+        """
+        try:
+            if exc is None:
+                result = client_response if isinstance(client_response, str) \
+                    else CODEC.dumps(client_response)
+                TASKS.finish(task_id, 'done', result)
+            else:
+                # If optimization failed, put error message in the results field
+                print('Error: task {} failed: {}'.format(task_id, exc))
+                TASKS.finish(task_id, 'failed', str(exc))
+        except Exception as store_exc:
+            print('Error: could not store result of task {}: {}'.format(task_id, store_exc))
+
+
+# Singleton
+BATCH_JOBS = BatchJobs(on_done=lambda task_id, bq_row: BQ.batching(bq_row))
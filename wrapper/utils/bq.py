@@ -4,31 +4,53 @@
 #
 '''
 BigQuery uploads
+
+If the environment variable TENSHI_TELEMETRY_SPOOL names a folder, rows
+are spooled to disk there until the worker has accepted them (see
+spool.py), so they survive restarts and worker outages.
+TENSHI_TELEMETRY_SPOOL_MB caps the disk use of the spool.
 '''
 
+import atexit
 import base64
-from threading import Thread
 from os import environ
-import requests
 from utils.environment import TE
+from utils.codec import CODEC
+from utils.telemetry import TelemetrySink
+from utils.spool import Spool
 
 class BQ:
     """
-    Class implementing BigQuery uploads.
+    Class implementing BigQuery uploads. Rows are queued and posted to
+    the worker, one row per post, by a background thread, see telemetry.py.
 
     :class: BQ
     """
     BASE_URL = 'https://.../{}/{}'
     print(environ.get('TENSHI_WORKER_URL'))
 
-    def __init__(self):
+    def __init__(self, base_url=None, spool_dir=None, **sink_options):
         """
         Constructor. Sets data set based on current  environment.
+
+        :param base_url: Worker URL with placeholders for data set and table,
+                         BASE_URL if None.
+        :param spool_dir: Folder to spool rows in, TENSHI_TELEMETRY_SPOOL if None.
+                          Rows are only kept in memory if neither is set.
+        :param sink_options: Options of the TelemetrySink, e.g. batch_size.
         """
         # self._data_set = 'test'
         self._data_set = 'stage'
         if TE.is_prod():
             self._data_set = 'stage'
+        self._base_url = base_url or BQ.BASE_URL
+        spool_dir = spool_dir or environ.get('TENSHI_TELEMETRY_SPOOL')
+        if spool_dir and 'spool' not in sink_options:
+            spool_mb = float(environ.get('TENSHI_TELEMETRY_SPOOL_MB', 512))
+            sink_options['spool'] = Spool(spool_dir, max_bytes=int(spool_mb * 1024 * 1024))
+        self._sink = TelemetrySink(BQ._wrap_data, **sink_options)
+        # Post what is still queued when the instance shuts down
+        atexit.register(self._sink.stop, 10.0)
 
     @staticmethod
     def _wrap_data(data_str):
@@ -45,27 +67,16 @@ class BQ:
             }
         }
 
-    @staticmethod
-    def _post(url, data_str):
+    def _enqueue(self, table, data):
         """
-        Posts data to the worker.
+        Queues data for the worker. Never blocks.
 
-        :param url: URL to post data to.
-        :param data_str: The data to post as a stringified JSON.
+        :param table: Table to send data to.
+        :param data: Payload as a stringified JSON, or an object to encode.
+        :return: True if the data was queued.
         """
-        response = requests.post(url, json=BQ._wrap_data(data_str))
-        print(response.content)
-
-    @staticmethod
-    def _async_post(url, data_str):
-        """
-        Posts data to the worker asynchronously.
-
-        :param url: URL to post data to.
-        :param data_str: The data to post as a stringified JSON.
-        :return:
-        """
-        Thread(target=BQ._post(url, data_str)).start()
+        data_str = data if isinstance(data, str) else CODEC.dumps(data)
+        return self._sink.enqueue(self._base_url.format(self._data_set, table), data_str)
 
     def pro(self, data_str):
         """
@@ -73,8 +84,7 @@ class BQ:
 
         :param data_str: Payload to send as a stringified JSON.
         """
-        print('Sending data to /pro')
-        BQ._async_post((BQ.BASE_URL.format(self._data_set, 'pickroute')), data_str)
+        return self._enqueue('pickroute', data_str)
 
     def batching(self, data_str):
         """
@@ -83,8 +93,15 @@ class BQ:
         :param data_str: Payload to send as a stringified JSON.
         :return:
         """
-        print('Sending data to /batching')
-        BQ._async_post(BQ.BASE_URL.format(self._data_set, 'singlebatch'), data_str)
+        return self._enqueue('singlebatch', data_str)
+
+    def stats(self):
+        """
+        Returns the counters of the upload queue and the spool backlog,
+        see TelemetrySink.stats().
+        :return:
+        """
+        return self._sink.stats()
 
 
 # It's a singleton, of course :)
@@ -9,53 +9,72 @@ get_wh_dict() is the function that conducts the warmup.
 
 import os
 import pickle
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
+from .wh_store import DATA_FILES, MANIFEST, has_store, read_manifest, load_wh_dict
 
+# Link in client_data_dir to the folder of the version in use
+CURRENT = 'current'
 
-def get_wh_dict(bucket_name):
+
+def _no_progress(file_name, status):
+    """
+    Default progress callback of get_wh_dict, does nothing.
+    """
+
+
+def get_wh_dict(bucket_name, client_data_dir='client-data', progress=None, download=True):
     """
     Example of warmup (loading warehouse specific files into RAM)
     get_wh_dict
+    If the data folder holds a memory-mapped store (see wh_store.py)
+    its arrays are mapped instead of unpickled. In production all files
+    are downloaded in parallel into a new folder per version, see
+    _download_version, so files that processes are mapping are never
+    changed.
     :param bucket_name:
+    :param client_data_dir: Local folder to download files to in production.
+    :param progress: Optional callback, called as progress(file_name, status)
+                     when a file is 'downloading', 'downloaded', 'loading'
+                     and 'loaded'.
+    :param download: False to only read files already in client_data_dir
+                     in production, see Registry.use_local_data.
     :return:
     """
-    data_files = [
-        'allcoords',
-        'keydict',
-        'distmat',
-        'spnodeslist',
-        'startendndarray'
-    ]
+    data_files = DATA_FILES
+    progress = progress or _no_progress
 
     file_map = {}
     try:
         # Map up files. Download files if in production
-        client_data_dir = 'client-data'
-        bucket_data_path = 'optimizer-data'
-        data_path = '{}/{}'.format(os.getcwd(), client_data_dir)
-
-        if os.environ.get('TENSHI_ENVIRONMENT') == 'production':
+        if os.environ.get('TENSHI_ENVIRONMENT') == 'production' and not download:
+            # Read the version the service downloaded last
+            data_path = os.path.realpath('{}/{}'.format(client_data_dir, CURRENT))
+            print('client data path (no download): ' + data_path)
+        elif os.environ.get('TENSHI_ENVIRONMENT') == 'production':
+            data_path, data_files = _download_version(bucket_name, client_data_dir, progress)
             print('client data path: ' + data_path)
-            storage_client = storage.Client()
-            bucket = storage_client.get_bucket(bucket_name)
-            for file_name in data_files:
-                file = '{}/{}'.format(bucket_data_path, file_name)
-                print('Downloading {} from {}'.format(file, bucket_name))
-                blob = bucket.blob(file)
-                target_file = '{}/{}'.format(client_data_dir, file_name)
-                blob.download_to_filename(target_file)
         else:
             # print('Using dict data from local folder {}'.format(bucket_name))
             data_path = bucket_name
 
+        if has_store(data_path):
+            return load_wh_dict(data_path, progress)
+
         # Pickle data from files to file_map
         for file_name in data_files:
             file = '{}/{}'.format(data_path, file_name)
             print('Loading {}'.format(file))
+            progress(file_name, 'loading')
             with open(file, 'rb') as handle:
                 file_map[file] = {}
                 file_map[file] = pickle.load(handle, encoding='latin1')
                 print('Loaded {} : {}'.format(file, file_map[file]))
+            progress(file_name, 'loaded')
 
     except Exception as exc:
         print('Error {}'.format(exc))
@@ -63,3 +82,75 @@ def get_wh_dict(bucket_name):
         file_map = None
 
     return file_map
+
+
+def _download_version(bucket_name, client_data_dir, progress):
+    """
+    Downloads the data files of a bucket into a hidden folder, renames
+    it to the store version (pickles-<time> without a store) and then
+    points client_data_dir/current to it with one atomic rename. A
+    version folder is never written to after that, and a failed
+    download leaves current as it was. The current and the previous
+    version are kept, older ones are deleted.
+
+    :return: Tuple (path of the version folder, names of the data files).
+    """
+    bucket_data_path = 'optimizer-data'
+    os.makedirs(client_data_dir, exist_ok=True)
+    storage_client = storage.Client()
+    bucket = storage_client.get_bucket(bucket_name)
+    work_dir = tempfile.mkdtemp(prefix='.download-', dir=client_data_dir)
+    try:
+        data_files = DATA_FILES
+        version = None
+        try:
+            file = '{}/{}'.format(bucket_data_path, MANIFEST)
+            bucket.blob(file).download_to_filename('{}/{}'.format(work_dir, MANIFEST))
+            manifest = read_manifest(work_dir)
+            data_files = [entry['file'] for entry in manifest['files'].values()]
+            version = manifest['version']
+        except NotFound:
+            print('No {} in {}, using pickled files'.format(MANIFEST, bucket_name))
+        version_dir = '{}/{}'.format(client_data_dir, version or
+                                     'pickles-{}'.format(int(time.time() * 1000)))
+
+        if version is not None and has_store(version_dir):
+            print('Version {} of {} is already downloaded'.format(version, bucket_name))
+        else:
+            def fetch(file_name):
+                file = '{}/{}'.format(bucket_data_path, file_name)
+                print('Downloading {} from {}'.format(file, bucket_name))
+                progress(file_name, 'downloading')
+                blob = bucket.blob(file)
+                blob.download_to_filename('{}/{}'.format(work_dir, file_name))
+                progress(file_name, 'downloaded')
+
+            with ThreadPoolExecutor(max_workers=len(data_files)) as pool:
+                # list() re-raises download errors here
+                list(pool.map(fetch, data_files))
+            try:
+                os.rename(work_dir, version_dir)
+            except OSError:
+                # Another process downloaded the same version first
+                if not has_store(version_dir):
+                    raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    current = '{}/{}'.format(client_data_dir, CURRENT)
+    previous = os.path.realpath(current) if os.path.islink(current) else None
+    link = '{}.{}'.format(current, os.getpid())
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, current)
+
+    keep = {os.path.realpath(version_dir), previous}
+    for name in os.listdir(client_data_dir):
+        path = os.path.realpath('{}/{}'.format(client_data_dir, name))
+        # Hidden folders are downloads in progress, links point to versions
+        if not name.startswith('.') and not os.path.islink('{}/{}'.format(client_data_dir, name)) \
+                and os.path.isdir(path) and path not in keep:
+            print('Deleting old warehouse data {}'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+    return os.path.realpath(version_dir), data_files
@@ -0,0 +1,108 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+JSON codec used for request bodies, responses and task payloads.
+
+Uses orjson if it is installed, then msgspec, and falls back to the
+json module otherwise. NumPy arrays and scalars are encoded by all
+backends, so responses can hold them directly without converting them
+to lists first.
+'''
+
+import json
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class Codec:
+    """
+    Class encoding and decoding JSON with the fastest available backend.
+
+    :class: Codec
+    """
+    BACKENDS = ('orjson', 'msgspec', 'json')
+
+    def __init__(self, backend=None):
+        """
+        Constructor, picks the backend.
+
+        :param backend: One of BACKENDS, the fastest installed one if None.
+        :raises: ValueError if the backend is unknown or not installed.
+        """
+        if backend is None:
+            backend = 'orjson' if orjson is not None else \
+                'msgspec' if msgspec is not None else 'json'
+        if backend not in Codec.BACKENDS or \
+                (backend == 'orjson' and orjson is None) or \
+                (backend == 'msgspec' and msgspec is None):
+            raise ValueError('JSON backend not available: ' + str(backend))
+        self.backend = backend
+        if backend == 'msgspec':
+            self._encoder = msgspec.json.Encoder(enc_hook=Codec.default)
+            self._decoder = msgspec.json.Decoder()
+
+    @staticmethod
+    def default(obj):
+        """
+        Converts objects the backends do not encode natively.
+
+        :param obj:
+        :raises: TypeError if the object cannot be encoded.
+        :return: A JSON serializable equivalent of the object.
+        """
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, (set, tuple)):
+            return list(obj)
+        raise TypeError('Object of type {} is not JSON serializable'.format(
+            type(obj).__name__))
+
+    def loads(self, data):
+        """
+        Decodes JSON.
+
+        :param data: JSON as bytes or str.
+        :raises: ValueError if the data is not valid JSON.
+        :return: The decoded object.
+        """
+        if self.backend == 'orjson':
+            return orjson.loads(data)
+        if self.backend == 'msgspec':
+            try:
+                return self._decoder.decode(data)
+            except msgspec.DecodeError as exc:
+                raise ValueError(str(exc))
+        return json.loads(data)
+
+    def dumps(self, obj):
+        """
+        Encodes an object as JSON.
+
+        :param obj:
+        :return: JSON as a str.
+        """
+        if self.backend == 'orjson':
+            # Arrays orjson cannot serialize (strings, non-contiguous) go to default
+            return orjson.dumps(obj, default=Codec.default,
+                                option=orjson.OPT_SERIALIZE_NUMPY |
+                                orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        if self.backend == 'msgspec':
+            return self._encoder.encode(obj).decode('utf-8')
+        return json.dumps(obj, default=Codec.default)
+
+
+# Singleton
+CODEC = Codec()
@@ -0,0 +1,71 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Encodings of the coordinate lists in webAppData (fullPathCoords and
+pickNodeCoords).
+
+The default 'verbose' format is a list of {'x': str, 'y': str}, one per
+point. Clients can ask for a compact format with the request header
+X-Coords-Format:
+
+    columns: {'x': [x0, x1, ...], 'y': [y0, y1, ...]} as integers.
+    delta:   as columns, but every value after the first is the
+             difference to the previous one. Decode with a cumulative sum.
+    base64:  {'dtype': '<i4', 'data': ...}, the points as interleaved
+             x, y little-endian int32, base64 encoded.
+
+Compact formats carry integer coordinates (see
+WarehouseContext.coords_uint32) and webAppData gets a 'coordsFormat'
+field naming the format.
+'''
+
+import base64
+import numpy as np
+
+COORDS_FORMAT_HEADER = 'X-Coords-Format'
+
+VERBOSE = 'verbose'
+COORDS_FORMATS = (VERBOSE, 'columns', 'delta', 'base64')
+
+
+def parse_coords_format(value):
+    """
+    Parses the value of the X-Coords-Format header.
+
+    :param value: Header value, None if the header is missing.
+    :raises: ValueError if the format is unknown.
+    :return: One of COORDS_FORMATS.
+    """
+    if value is None or not value.strip():
+        return VERBOSE
+    coords_format = value.strip().lower()
+    if coords_format not in COORDS_FORMATS:
+        raise ValueError('Unknown coordinate format: {}, expected one of {}'.format(
+            value, ', '.join(COORDS_FORMATS)))
+    return coords_format
+
+
+def encode_coords(coords, coords_format=VERBOSE):
+    """
+    Encodes a list of points.
+
+    :param coords: Array of shape (n, 2).
+    :param coords_format: One of COORDS_FORMATS.
+    :return: JSON serializable encoding of the points.
+    """
+    coords = np.asarray(coords)
+    if coords_format == VERBOSE:
+        return [{'x': str(x), 'y': str(y)} for x, y in coords.tolist()]
+
+    coords = coords.astype(np.int64).reshape(-1, 2)
+    if coords_format == 'columns':
+        return {'x': coords[:, 0].tolist(), 'y': coords[:, 1].tolist()}
+    if coords_format == 'delta':
+        deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+        return {'x': deltas[:, 0].tolist(), 'y': deltas[:, 1].tolist()}
+    if coords_format == 'base64':
+        data = coords.astype('<i4').tobytes()
+        return {'dtype': '<i4', 'data': base64.b64encode(data).decode('ascii')}
+    raise ValueError('Unknown coordinate format: {}'.format(coords_format))
@@ -4,12 +4,101 @@
 #
 '''
 Tasks
+
+Connections to the task database come from a bounded pool. A thread
+holds a connection only for the duration of one operation, connections
+are checked before reuse and replaced when they are broken. Setting
+the environment variable TENSHI_TASKS_SQLITE to a file name makes the
+tasks table live in SQLite instead of MySQL, e.g. for local testing.
 '''
 import os
-import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
 import pymysql
 from .db_config import CONFIG
+from .codec import CODEC
+
+# Schema of the tasks table, created when SQLite is used
+SQLITE_SCHEMA = '''CREATE TABLE IF NOT EXISTS tasks (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       uuid TEXT NOT NULL UNIQUE,
+                       type TEXT,
+                       warehouse_id TEXT,
+                       payload TEXT,
+                       status TEXT,
+                       result TEXT)'''
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections.
+
+    :class: ConnectionPool
+    """
+    def __init__(self, connect, size, ping=None, timeout=30.0):
+        """
+        Constructor. Connections are opened when they are first needed.
+
+        :param connect: Function opening a new connection.
+        :param size: Maximum number of open connections.
+        :param ping: Function checking an idle connection before it is reused,
+                     raising an exception if the connection is broken.
+        :param timeout: Maximum time in seconds to wait for a free connection.
+        """
+        self._connect = connect
+        self._ping = ping
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the calling thread. If the block
+        raises, the connection is closed instead of returned to the pool.
+
+        :raises: IOError if no connection is free within the timeout.
+        """
+        if not self._slots.acquire(timeout=self._timeout):
+            raise IOError('No free database connection')
+        connection = None
+        try:
+            connection = self._checkout()
+            yield connection
+            self._idle.put(connection)
+        except BaseException:
+            ConnectionPool._close(connection)
+            raise
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        """
+        Returns an idle connection that passes the ping, or a new one.
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            try:
+                if self._ping is not None:
+                    self._ping(connection)
+                return connection
+            except Exception as exc:
+                print('Tasks: dropping broken connection: {}'.format(exc))
+                ConnectionPool._close(connection)
 
+    @staticmethod
+    def _close(connection):
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            pass
 
 
 class Tasks:
@@ -29,21 +118,94 @@ class Tasks:
 
     :class: Tasks
     """
-    def __init__(self):
+    def __init__(self, sqlite_file=None, pool_size=8):
         """
-        Constructor for the Tasks class. Sets up connection and cursor to the SQL database.
+        Constructor for the Tasks class. Sets up the connection pool,
+        connections are opened on first use.
+
+        :param sqlite_file: SQLite database to use instead of MySQL,
+                            TENSHI_TASKS_SQLITE if None.
+        :param pool_size: Maximum number of open connections.
         """
+        sqlite_file = sqlite_file or os.environ.get('TENSHI_TASKS_SQLITE')
+        if sqlite_file:
+            self._sqlite = True
+            self._pool = ConnectionPool(lambda: Tasks._connect_sqlite(sqlite_file), pool_size)
+        else:
+            self._sqlite = False
+            self._pool = ConnectionPool(Tasks._connect_mysql, pool_size,
+                                        ping=lambda connection: connection.ping(reconnect=True))
+
+    @staticmethod
+    def _connect_mysql():
+        """
+        Opens a MySQL connection. Rows matched, not rows changed, are
+        reported as affected, so that an UPDATE setting a value it
+        already has still finds its task.
+        """
+        options = {
+            'db': CONFIG['db'],
+            'user': CONFIG['user'],
+            'passwd': CONFIG['passwd'],
+            'client_flag': pymysql.constants.CLIENT.FOUND_ROWS
+        }
         if os.environ.get('TENSHI_ENVIRONMENT') == 'production':
-            self._db = pymysql.connect(unix_socket=CONFIG['unix_socket'],
-                                       db=CONFIG['db'],
-                                       user=CONFIG['user'],
-                                       passwd=CONFIG['passwd'])
+            return pymysql.connect(unix_socket=CONFIG['unix_socket'], **options)
+        return pymysql.connect(host=CONFIG['host'], **options)
+
+    @staticmethod
+    def _connect_sqlite(sqlite_file):
+        """
+        Opens a SQLite connection, creating the tasks table if needed.
+        """
+        connection = sqlite3.connect(sqlite_file, timeout=30.0, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(SQLITE_SCHEMA)
+        connection.commit()
+        return connection
+
+    def _execute(self, query, params, fetch=False, idempotent=None):
+        """
+        Runs one statement, and commits it unless it is a query. A
+        statement that fails because the connection broke is retried
+        once on a new connection if it is idempotent, or if it failed
+        before it was sent. An INSERT that may have been applied is
+        never run twice.
+
+        :param query: SQL with %s placeholders.
+        :param params: Parameters of the statement.
+        :param fetch: True to return the rows of a query.
+        :param idempotent: True if running the statement twice does no
+                           harm, defaults to fetch.
+        :return: The rows if fetch is True, the number of affected rows otherwise.
+        """
+        if idempotent is None:
+            idempotent = fetch
+        if self._sqlite:
+            query = query.replace('%s', '?')
+            retry_errors = (sqlite3.OperationalError, )
         else:
-            self._db = pymysql.connect(host=CONFIG['host'],
-                                       db=CONFIG['db'],
-                                       user=CONFIG['user'],
-                                       passwd=CONFIG['passwd'])
-        self._cursor = self._db.cursor()
+            retry_errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+        for attempt in range(2):
+            sent = False
+            try:
+                with self._pool.connection() as connection:
+                    cursor = connection.cursor()
+                    try:
+                        sent = True
+                        cursor.execute(query, params)
+                        if fetch:
+                            return cursor.fetchall()
+                        connection.commit()
+                        return cursor.rowcount
+                    finally:
+                        cursor.close()
+            except retry_errors as exc:
+                if attempt > 0 or (sent and not idempotent):
+                    raise
+                print('Tasks: retrying after database error: {}'.format(exc))
+        return None
 
     def has_task(self, task_id):
         """
@@ -52,8 +214,8 @@ class Tasks:
         :param task_id: Task ID to check existence for.
         :return: True if task exists, false otherwise.
         """
-        self._cursor.execute('SELECT id FROM tasks WHERE uuid = %s', (task_id, ))
-        return len(self._cursor.fetchall()) > 0
+        return len(self._execute('SELECT id FROM tasks WHERE uuid = %s', (task_id, ),
+                                 fetch=True)) > 0
 
     def insert_task(self, task):
         """
@@ -61,10 +223,9 @@ class Tasks:
         :param task:
         :return:
         """
-        self._cursor.execute('''INSERT INTO tasks (uuid, type, warehouse_id, payload, status)
-                                VALUES (%s, %s, %s, %s, 'waiting')''',
-                             (task['uuid'], task['type'], task['warehouse_id'], task['payload']))
-        self._db.commit()
+        self._execute('''INSERT INTO tasks (uuid, type, warehouse_id, payload, status)
+                         VALUES (%s, %s, %s, %s, 'waiting')''',
+                      (task['uuid'], task['type'], task['warehouse_id'], task['payload']))
 
     def get_payload(self, task_id):
         """
@@ -75,8 +236,8 @@ class Tasks:
         :raises: KeyError if the task ID belongs to zero or multiple tasks.
         :return: The payload to the task identified by the task ID as a dictionary.
         """
-        self._cursor.execute('SELECT payload FROM tasks WHERE uuid = %s', (task_id,))
-        task_payloads = [row for row in self._cursor]
+        task_payloads = self._execute('SELECT payload FROM tasks WHERE uuid = %s', (task_id,),
+                                      fetch=True)
 
         # Check if there are zero or multiple tasks
         if not task_payloads:
@@ -85,7 +246,21 @@ class Tasks:
             raise KeyError('Multiple tasks with task ID: ' + task_id)
 
         # Return payload
-        return json.loads(task_payloads[0][0])
+        return CODEC.loads(task_payloads[0][0])
+
+    def get_task(self, task_id):
+        """
+        Retrieves the status and the result of a task.
+
+        :param task_id: Task ID to look up.
+        :raises: KeyError if there is no task with the specified task ID.
+        :return: Tuple (status, result).
+        """
+        rows = self._execute('SELECT status, result FROM tasks WHERE uuid = %s', (task_id, ),
+                             fetch=True)
+        if not rows:
+            raise KeyError('No task with task ID: ' + task_id)
+        return rows[0][0], rows[0][1]
 
     def set_status(self, task_id, status):
         """
@@ -100,31 +275,40 @@ class Tasks:
         if status not in Tasks.STATUSES:
             raise ValueError('Invalid status: ' + status)
 
-        # Check if task ID exists
-        if not self.has_task(task_id):
+        if not self._execute('UPDATE tasks SET status = %s WHERE uuid = %s', (status, task_id),
+                             idempotent=True):
             raise KeyError('No task with task ID: ' + task_id)
-
-        # Check if task exists
-        self._cursor.execute('UPDATE tasks SET status = %s WHERE uuid = %s', (status, task_id))
-        self._db.commit()
         print('Tasks: status is updated to {} for task {}'.format(status, task_id))
 
     def set_result(self, task_id, result):
         """
-        Updates the task status for a specific task.
+        Updates the result for a specific task.
 
-        :param task_id: Task ID to update status for.
+        :param task_id: Task ID to update result for.
         :param result: The result as a stringified JSON.
-        :raises: ValueError if status is invalid.
         :raises: KeyError if there is no task with the specified task ID.
         """
-        # Check if status is valid
-        if not self.has_task(task_id):
+        if not self._execute('UPDATE tasks SET result = %s WHERE uuid = %s', (result, task_id),
+                             idempotent=True):
             raise KeyError('No task with task ID: ' + task_id)
 
-        # Check if task exists
-        self._cursor.execute('UPDATE tasks SET result = %s WHERE uuid = %s', (result, task_id))
-        self._db.commit()
+    def finish(self, task_id, status, result):
+        """
+        Updates the status and the result of a task in one statement.
+
+        :param task_id: Task ID to update.
+        :param status: The new status, usually 'done' or 'failed'.
+        :param result: The result as a stringified JSON.
+        :raises: ValueError if status is invalid.
+        :raises: KeyError if there is no task with the specified task ID.
+        """
+        if status not in Tasks.STATUSES:
+            raise ValueError('Invalid status: ' + status)
+
+        if not self._execute('UPDATE tasks SET status = %s, result = %s WHERE uuid = %s',
+                             (status, result, task_id), idempotent=True):
+            raise KeyError('No task with task ID: ' + task_id)
+        print('Tasks: status is updated to {} for task {}'.format(status, task_id))
 
 
 # Tasks is a singleton
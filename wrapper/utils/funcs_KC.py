@@ -6,6 +6,9 @@
 get_node_from_keydict
 '''
 
+from utils.location_index import LocationIndex
+
+
 def get_node_from_keydict(section, rack, tier, keydict_kc):
 
     """
@@ -20,3 +23,41 @@ def get_node_from_keydict(section, rack, tier, keydict_kc):
     key = section + '_' + rack + '_' + tier
     idx = keydict_kc[key]
     return idx
+
+
+def build_location_index(keydict_kc):
+
+    """
+    Builds the index used by get_nodes_from_index, once per warehouse.
+    A key is indexed under every way it splits into section, rack and
+    tier, so exactly the keys get_node_from_keydict builds are found
+    even when a field contains '_'.
+    :param keydict_kc:
+    :return:
+    """
+
+    locations = []
+    nodes = []
+    for key, node in keydict_kc.items():
+        parts = str(key).split('_')
+        for first in range(1, len(parts) - 1):
+            for second in range(first + 1, len(parts)):
+                locations.append(('_'.join(parts[:first]), '_'.join(parts[first:second]),
+                                  '_'.join(parts[second:])))
+                nodes.append(node)
+    return LocationIndex(locations, nodes)
+
+
+def get_nodes_from_index(sections, racks, tiers, location_index):
+
+    """
+    Batch version of get_node_from_keydict for all picks of a request.
+    :param sections:
+    :param racks:
+    :param tiers:
+    :param location_index:
+    :raises: UnknownLocations listing all unknown locations.
+    :return: Array of node indices.
+    """
+
+    return location_index.lookup(sections, racks, tiers)
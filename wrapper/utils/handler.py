@@ -8,10 +8,13 @@ not directly related to optimization.
 '''
 
 import datetime
-import importlib
 import uuid
 import numpy as np
-from utils.sol_to_xy import sol_to_xy
+from utils.sol_to_xy import sol_to_xy_array
+from utils.route_geometry import expand_legs, leg_nodes
+from utils.warehouse import SolveState
+from utils.coords_format import VERBOSE, encode_coords
+from utils.location_index import UnknownLocations
 
 
 class Handler:
@@ -20,14 +23,20 @@ class Handler:
     Handler
     """
 
-    def __init__(self, request, wh_dict, request_source):
-        self.req_resp_dict = request
-        self.solve_dict = self.init_solve_dict(wh_dict, request_source)
+    def __init__(self, request, warehouse, request_source, coords_format=VERBOSE):
+        self.request = request
+        self.req_resp_dict = request.body
+        # encoding of the webAppData coordinate lists, see coords_format.py
+        self.coords_format = coords_format
+        self.solve_dict = self.init_solve_dict(warehouse, request_source)
 
-        if request_source == 'KC':
-            module = importlib.import_module('utils.funcs_KC')
+        if warehouse.funcs is None:
+            raise KeyError('No key lookup module for warehouse: ' + warehouse.name)
+        module = warehouse.funcs
 
         self.get_node_from_keydict = getattr(module, 'get_node_from_keydict')
+        self.get_nodes_from_index = getattr(module, 'get_nodes_from_index', None)
+        self.location_index = warehouse.location_index
 
         if self.req_resp_dict['requestType'] == "PICK_ROUTE_OPTIMIZATION":
             self.solve_dict['isSingleBatchReq'] = False
@@ -52,22 +61,13 @@ class Handler:
                 self.req_resp_dict['requestData']['pickLocations']['rackLocationIdentifier_1']
             ).flatten()
 
-            nodelist = []
-            for i in range(len(self.rack)):
-                nodelist.append(
-                    self.get_node_from_keydict(self.section[i],
-                                               self.rack[i],
-                                               self.tier[i],
-                                               self.solve_dict['keydict'])
-                )
-            self.nodelist = [self.solve_dict['start_depot_idx']] + \
+            self.solve_dict['is_reroute_req'] = int(request.is_reroute)
+            nodelist = self.get_nodes(self.section, self.rack, self.tier)
+            self.nodelist = [self.get_start_node()] + \
                 nodelist + \
                 [self.solve_dict['end_depot_idx']]
             self.solve_dict['node_seq_bef_sol'] = self.nodelist.copy()
-            self.solve_dict['is_reroute_req'] = \
-                int(self.req_resp_dict['requestData']['isReroute'])
-            self.solve_dict['is_clockwise_req'] = \
-                int(self.req_resp_dict['requestData']['isClockwise'])
+            self.solve_dict['is_clockwise_req'] = int(request.is_clockwise)
 
             coords_path_bef_sol = [self.solve_dict['allcoords'][i] \
                                    for i in self.solve_dict['node_seq_bef_sol']]
@@ -80,8 +80,7 @@ class Handler:
             #    not int(self.req_resp_dict['isPickRoundOptimizationRequest']):
             self.solve_dict['isSingleBatchReq'] = True
             self.solve_dict['isPickRoundOptimRequest'] = False
-            self.solve_dict['BatchSize'] = \
-                int(self.req_resp_dict['requestData']['maxNumBoxesToBatch'])
+            self.solve_dict['BatchSize'] = request.max_boxes_to_batch
             #returns the box queue dict, with all  forced boxes represented as a single box
             self.solve_dict['boxqueuedict'], self.solve_dict['ForceBatchBoxes'] = \
                 self.gen_box_dict_for_batching()
@@ -93,65 +92,23 @@ class Handler:
         self.rack_location_id1_seq = None
 
     @staticmethod
-    def init_solve_dict(wh_dict, request_source):
+    def init_solve_dict(warehouse, request_source):
 
         """
-        This function initializes solve_dict which is a dict that
-        contains everything the optimizer classes need. Has same dict
-        structure for both pickroute and batch optimization. It's
-        loading the files in wh_dict into solve_dict, as well as
-        initing other variables.
+        This function initializes solve_dict which contains everything
+        the optimizer classes need. Has same structure for both pickroute
+        and batch optimization. Warehouse fields (distmat, keydict,
+        metric, depots, ...) are looked up in the shared warehouse
+        context, only request fields are set here.
 
-        :param wh_dict:
+        :param warehouse: WarehouseContext of the requested warehouse.
         :param request_source:
-        :return:
+        :return: SolveState for the request.
         """
 
-        solve_dict = {
-            ####Warehouse Specific Attributes ###
-            'warehouse_funcs': None,
-            'request_source': None,
-            'metric': None,
-            'start_depot_idx': None,
-            'end_depot_idx': None,
-            'distmat': None,
-            'keydict': None,
-            'allcoords': None,
-            ########
-            #### Request Specific Info #####
-            'uuid': None,
-            'is_reroute_req': None,
-            'is_clockwise_req': None,
-            'node_seq_bef_sol': None,
-            ###############################
-            ##### originally Solve Output ###
-            'lg_sol_fitness': None,
-            'solver_sol': None,
-            'solver_sol_fitness': None,
-            'node_seq_aft_sol': None,
-            'time_to_optimize': None,
-            'time_of_req': None,
-            ######################################
-            ###To Distinguish Batch From PickRun Optimization Posts
-            'isSingleBatchReq': None,
-            'isPickRoundOptimRequest': None,
-            'boxqueuedict': None,
-            'forced_boxesToRestore': None,
-            'batchSize': None
-        }
-
-        #### possible values for measurement_metrics are: 'mm','cm','dm'
-        #### i.e. what measurement unit was used during map measurements
-        measurement_metrics = {'DADC': 'cm', 'CAG': 'mm', 'KC': 'cm'}
-        depot_specs = {'CAG': {'start_depot_idx': 0, 'end_depot_idx': 0},
-                       'DADC': {'start_depot_idx': 0, 'end_depot_idx': 1},
-                       'KC': {'start_depot_idx': 0, 'end_depot_idx': 0}}
+        solve_dict = SolveState(warehouse)
         solve_dict['jobId'] = str(uuid.uuid4())
         solve_dict['uuid'] = str(uuid.uuid4())
-        start_idx = depot_specs[request_source]['start_depot_idx']
-        end_idx = depot_specs[request_source]['end_depot_idx']
-        solve_dict['start_depot_idx'] = start_idx
-        solve_dict['end_depot_idx'] = end_idx
         solve_dict['time_of_req'] = str(datetime.datetime.utcnow())
         # IF DEMO TIMESTAMP IS TO BE USED:
         # requestRecieved = \
@@ -162,12 +119,6 @@ class Handler:
         #                                     random.randint(1, 59), random.randint(1, 999999)))
         solve_dict['request_source'] = request_source  # TEMP, should not be needed
 
-        for wh_data_key in list(wh_dict.keys()):  # populates solve_dict with files from wh_dict
-            wh_data_key_short = wh_data_key.rsplit('/', 1)[-1]
-            # ^-- TEMP, having full path in solve_dict causes problems later on in legacy functions.
-            solve_dict[wh_data_key_short] = wh_dict[wh_data_key]
-        solve_dict['metric'] = measurement_metrics[request_source]
-
         return solve_dict
 
     def gen_box_dict_for_batching(self):
@@ -177,30 +128,31 @@ class Handler:
         :return:
         """
 
-        enf_w_con = self.req_resp_dict['requestData']['enf_w_con']
-        enf_v_con = self.req_resp_dict['requestData']['enf_v_con']
+        enf_w_con = self.request.enforce_weight
+        enf_v_con = self.request.enforce_volume
 
         boxqueuedict = {}  # datastructure used for batching
         if enf_w_con:
             boxqueuedict['enf_w_con'] = True
-            boxqueuedict['maxBatchWeight'] = \
-                float(self.req_resp_dict['requestData']['maxBatchWeight'])
+            boxqueuedict['maxBatchWeight'] = self.request.max_batch_weight
             box_w_array = []
         else:
             boxqueuedict['enf_w_con'] = False
 
         if enf_v_con:
             boxqueuedict['enf_v_con'] = True
-            boxqueuedict['maxBatchVolume'] = \
-                float(self.req_resp_dict['requestData']['maxBatchVolume'])
+            boxqueuedict['maxBatchVolume'] = self.request.max_batch_volume
             box_v_array = []
         else:
             boxqueuedict['enf_v_con'] = False
 
 
-        arr_of_b = []  # to be converted to np array (of np arrays containg graph node indices)
         #b_d_d_t_a = []
         box_id_s_array = []
+        sections = []
+        racks = []
+        tiers = []
+        items_per_box = []
 
         forced_boxes = self.req_resp_dict['requestData']['forceBatchBoxes']
         for b_dict in self.req_resp_dict['requestData']['availableBoxes']:
@@ -208,17 +160,17 @@ class Handler:
                 box_w_array.append(float(b_dict['boxWeight']))
             if enf_v_con:
                 box_v_array.append(float(b_dict['boxVolume']))
-            this_box_i_n_a = []
 
             box_id_s_array.append(b_dict['boxIdentifier'])
-            for item_idx in range(len(b_dict['boxItemInfo']['materialHandlingSection'])):
-                this_box_i_n_a.append(
-                    self.get_node_from_keydict(
-                        b_dict['boxItemInfo']['materialHandlingSection'][item_idx],
-                        b_dict['boxItemInfo']['rackIdentifier'][item_idx],
-                        b_dict['boxItemInfo']['rackLocationIdentifier_1'][item_idx],
-                        self.solve_dict['keydict']))
-            arr_of_b.append(np.asarray(this_box_i_n_a))
+            sections += list(b_dict['boxItemInfo']['materialHandlingSection'])
+            racks += list(b_dict['boxItemInfo']['rackIdentifier'])
+            tiers += list(b_dict['boxItemInfo']['rackLocationIdentifier_1'])
+            items_per_box.append(len(b_dict['boxItemInfo']['materialHandlingSection']))
+
+        # all box items are looked up in one go, then split per box
+        all_nodes = np.asarray(self.get_nodes(sections, racks, tiers), dtype=int)
+        # to be converted to np array (of np arrays containg graph node indices)
+        arr_of_b = np.split(all_nodes, np.cumsum(items_per_box)[:-1]) if items_per_box else []
         arr_of_b = np.asarray(arr_of_b)
 
         boxqueuedict['boxnodelists'] = arr_of_b
@@ -242,6 +194,48 @@ class Handler:
 
         return boxqueuedict, {} #do not remove this second return val, which is an empty dict.
 
+    def get_start_node(self):
+
+        """
+        Returns the node the route starts from, the start depot, or the
+        picker's current location (rerouteStartLocation) for a reroute.
+        :raises: UnknownLocations if the location is unknown.
+        :return: Node index.
+        """
+
+        if not self.solve_dict['is_reroute_req']:
+            return self.solve_dict['start_depot_idx']
+        location = self.req_resp_dict['requestData']['rerouteStartLocation']
+        return int(self.get_nodes(np.asarray(location['materialHandlingSection']).flatten(),
+                                  np.asarray(location['rackIdentifier']).flatten(),
+                                  np.asarray(location['rackLocationIdentifier_1']).flatten())[0])
+
+    def get_nodes(self, sections, racks, tiers):
+
+        """
+        Maps pick locations to node indices, using the warehouse location
+        index when the key lookup module supports batch lookups.
+        :param sections:
+        :param racks:
+        :param tiers:
+        :raises: UnknownLocations listing all unknown locations.
+        :return: List of node indices.
+        """
+
+        if self.get_nodes_from_index is not None and self.location_index is not None:
+            return self.get_nodes_from_index(sections, racks, tiers, self.location_index).tolist()
+        nodes = []
+        unknown = []
+        for i in range(len(racks)):
+            try:
+                nodes.append(self.get_node_from_keydict(sections[i], racks[i], tiers[i],
+                                                        self.solve_dict['keydict']))
+            except KeyError:
+                unknown.append('_'.join(str(field) for field in (sections[i], racks[i], tiers[i])))
+        if unknown:
+            raise UnknownLocations(unknown)
+        return nodes
+
     @staticmethod
     def condence_forced_boxes(forcebatchboxes, boxqueuedict):
 
@@ -338,22 +332,20 @@ class Handler:
 
         """
         get_index_flattened_arr
+        Index of (row, column), row <= column, in the row-major flattened
+        upper triangle (diagonal included) of a length x length matrix.
+        Closed form, also works elementwise on index arrays.
         :param row:
         :param column:
         :param length:
         :return:
         """
 
-        idxcount = 0
-        for index in range(0, length):
-            idxcount += (length - index)
-            if row == index:
-                idx = idxcount - (length - column)
-                break
-        return idx
+        return row * length - (row * (row + 1)) // 2 + column
 
     @staticmethod
-    def get_spnodepath(from_node, to_node, spnodelist, startendarray, length):
+    def get_spnodepath(from_node, to_node, spnodelist, startendarray, length,
+                       predecessors=None):
 
         """
         get_spnodepath
@@ -362,10 +354,16 @@ class Handler:
         :param spnodelist:
         :param startendarray:
         :param length:
+        :param predecessors: Predecessor matrix, used instead of spnodelist
+                             and startendarray if given.
         :return:
         """
         ifrom = from_node
         jto = to_node
+        if predecessors is not None:
+            # the path of the lower node, like the upper triangle below
+            path = leg_nodes(predecessors, min(ifrom, jto), max(ifrom, jto))
+            return list(np.flip(path) if ifrom > jto else path)
         if ifrom > jto:
             idx = Handler.get_index_flattened_arr(jto, ifrom, length)
             path = spnodelist[startendarray[idx, 0]:startendarray[idx, 1]].astype(np.int64).flatten()
@@ -377,33 +375,62 @@ class Handler:
         return list(path)
 
     @staticmethod
-    def get_full_path(node_seq_aft_sol, spnodelist, startendarray, end_depot_node_idx, length):
+    def get_full_path(node_seq_aft_sol, spnodelist, startendarray, end_depot_node_idx, length,
+                      predecessors=None):
 
         """
         get_full_path
+        All legs of the route are resolved with one gather from
+        spnodelist. Each leg's last node is dropped since it is the
+        first node of the next leg (legs of a single node are kept).
         :param node_seq_aft_sol:
         :param spnodelist:
         :param startendarray:
         :param end_depot_node_idx:
         :param length:
+        :param predecessors: Predecessor matrix, used instead of spnodelist
+                             and startendarray if given.
         :return:
         """
 
-        pathappend = []
-        for i in range(0, len(node_seq_aft_sol) - 1):
-            from_node = node_seq_aft_sol[i]
-            to_node = node_seq_aft_sol[i + 1]
-            path_seg_to_append = Handler.get_spnodepath(from_node,
-                                                        to_node,
-                                                        spnodelist,
-                                                        startendarray,
-                                                        length)
-            if len(path_seg_to_append) > 1:
-                pathappend = pathappend + path_seg_to_append[0:len(path_seg_to_append) - 1]
-            else:
-                pathappend = pathappend + path_seg_to_append[:]
-        pathappend = pathappend + [end_depot_node_idx]  ## End depot Specific to warehouse
-        return pathappend
+        nodes = np.asarray(node_seq_aft_sol, dtype=np.int64).flatten()
+        from_nodes = nodes[:-1]
+        to_nodes = nodes[1:]
+        reverse = from_nodes > to_nodes
+        if predecessors is not None:
+            spnodelist, legs = expand_legs(predecessors,
+                                           np.minimum(from_nodes, to_nodes),
+                                           np.maximum(from_nodes, to_nodes))
+            starts = legs[:, 0]
+            ends = legs[:, 1]
+        else:
+            idx = Handler.get_index_flattened_arr(np.minimum(from_nodes, to_nodes),
+                                                  np.maximum(from_nodes, to_nodes),
+                                                  length)
+            starts = np.asarray(startendarray[idx, 0], dtype=np.int64)
+            ends = np.asarray(startendarray[idx, 1], dtype=np.int64)
+        seg_lens = ends - starts
+
+        # k:th node of every leg, walking legs stored the other way round backwards
+        leg = np.repeat(np.arange(len(seg_lens)), seg_lens)
+        k = np.arange(len(leg)) - np.repeat(np.cumsum(seg_lens) - seg_lens, seg_lens)
+        pos = np.where(reverse[leg], ends[leg] - 1 - k, starts[leg] + k)
+        keep = (k < seg_lens[leg] - 1) | (seg_lens[leg] == 1)
+
+        pathappend = spnodelist[pos[keep]].astype(np.int64)
+        return np.concatenate((pathappend, [end_depot_node_idx])).tolist()  ## End depot Specific to warehouse
+
+    def pick_node_coords(self, solve_dict):
+        """
+        Returns the coordinates of all nodes to look pick node coordinates
+        up in. The verbose format keeps the original allcoords values,
+        compact formats use the integer coordinates of the full paths.
+        :param solve_dict:
+        :return: Array of shape (number of nodes, 2).
+        """
+        if self.coords_format == VERBOSE:
+            return np.asarray(solve_dict['allcoords'])
+        return solve_dict['coords_uint32']
 
     def gen_response(self, solve_dict):
 
@@ -424,9 +451,9 @@ class Handler:
             solver_output_index_ordering = solve_dict['solver_sol'].copy()
             args_to_sort = solver_output_index_ordering[1:-1]  # strip sol of depot and
             args_to_sort = np.asarray([x - 1 for x in args_to_sort]).flatten()  # decrement by 1
-            self.section = list(self.section[args_to_sort].flatten())
-            self.rack = list(self.rack[args_to_sort].flatten())
-            self.tier = list(self.tier[args_to_sort].flatten())
+            self.section = self.section[args_to_sort]
+            self.rack = self.rack[args_to_sort]
+            self.tier = self.tier[args_to_sort]
             self.req_resp_dict['responseData'] = {}
 
             self.req_resp_dict['responseData'] = {'returnPickerHints': None,
@@ -455,12 +482,12 @@ class Handler:
             self.req_resp_dict['responseData']['optimalRouteDistance'] = str(solve_dict['solver_sol_fitness'])
             self.req_resp_dict['responseData']['originalRouteDistance'] = str(solve_dict['lg_sol_fitness'])
             self.req_resp_dict['responseData']['distanceSavedMeters'] = str(solve_dict['lg_sol_fitness']-solve_dict['solver_sol_fitness'])
-            self.req_resp_dict['responseData']['pickLocations']['assignment_identifier'] = list(self.assignment_id[args_to_sort].flatten())
-            self.req_resp_dict['responseData']['pickLocations']['original_sorting_number'] = list(self.original_sorting_number[args_to_sort].flatten())
-            self.req_resp_dict['responseData']['pickLocations']['optimizedSortingNumber'] = list(self.original_sorting_number.flatten())
-            self.req_resp_dict['responseData']['pickLocations']['materialHandlingSection'] = list(self.section)
-            self.req_resp_dict['responseData']['pickLocations']['rackIdentifier'] = list(self.rack)
-            self.req_resp_dict['responseData']['pickLocations']['rackLocationIdentifier_1'] = list(self.tier)
+            self.req_resp_dict['responseData']['pickLocations']['assignment_identifier'] = self.assignment_id[args_to_sort]
+            self.req_resp_dict['responseData']['pickLocations']['original_sorting_number'] = self.original_sorting_number[args_to_sort]
+            self.req_resp_dict['responseData']['pickLocations']['optimizedSortingNumber'] = self.original_sorting_number
+            self.req_resp_dict['responseData']['pickLocations']['materialHandlingSection'] = self.section
+            self.req_resp_dict['responseData']['pickLocations']['rackIdentifier'] = self.rack
+            self.req_resp_dict['responseData']['pickLocations']['rackLocationIdentifier_1'] = self.tier
             self.req_resp_dict['jobId'] = solve_dict['jobId']
             ##see below for time tracking entries to json
             # self.req_resp_dict['responseData']['requestReceivedAtDateTime'] = \
@@ -471,38 +498,27 @@ class Handler:
             #WEBAPPINFO
 
             #66 HERE
-            bef_full_path_coords = sol_to_xy("",
-                                             solve_dict['coords_path_bef_sol'],
-                                             solve_dict['node_seq_bef_sol'],
-                                             list(range(0, len(solve_dict['solver_sol']))),
-                                             solve_dict['node_seq_aft_sol'],
-                                             solve_dict['startendndarray'],
-                                             solve_dict['spnodeslist'],
-                                             np.asarray(solve_dict['allcoords'], dtype=np.uint32))
-
-            aft_full_path_coords = sol_to_xy("",
-                                             solve_dict['coords_path_bef_sol'],
-                                             solve_dict['node_seq_bef_sol'],
-                                             solve_dict['solver_sol'],
-                                             solve_dict['node_seq_aft_sol'],
-                                             solve_dict['startendndarray'],
-                                             solve_dict['spnodeslist'],
-                                             np.asarray(solve_dict['allcoords'], dtype=np.uint32))
-
-            node_seq_coords_bef = []
-            node_seq_coords_aft = []
+            bef_full_path_coords = sol_to_xy_array("",
+                                                   solve_dict['node_seq_bef_sol'],
+                                                   list(range(0, len(solve_dict['solver_sol']))),
+                                                   solve_dict['node_seq_aft_sol'],
+                                                   solve_dict['startendndarray'],
+                                                   solve_dict['spnodeslist'],
+                                                   solve_dict['coords_uint32'],
+                                                   solve_dict['predecessors'])
+
+            aft_full_path_coords = sol_to_xy_array("",
+                                                   solve_dict['node_seq_bef_sol'],
+                                                   solve_dict['solver_sol'],
+                                                   solve_dict['node_seq_aft_sol'],
+                                                   solve_dict['startendndarray'],
+                                                   solve_dict['spnodeslist'],
+                                                   solve_dict['coords_uint32'],
+                                                   solve_dict['predecessors'])
+
             seqbef = solve_dict['node_seq_bef_sol']
             seqaft = solve_dict['node_seq_aft_sol']
-
-            for _, val in enumerate(seqbef):
-                node_seq_coords_bef.append(
-                    [str(solve_dict['allcoords'][val][0]),
-                     str(solve_dict['allcoords'][val][1])])
-
-            for _, val in enumerate(seqaft):
-                node_seq_coords_aft.append(
-                    [str(solve_dict['allcoords'][val][0]),
-                     str(solve_dict['allcoords'][val][1])])
+            pick_node_coords = self.pick_node_coords(solve_dict)
 
 
             #TODO: PickRoute webAppData for dashboard
@@ -530,15 +546,10 @@ class Handler:
             for_web_app['pickRunID'] = self.req_resp_dict['responseData']['pickRoundIdentifier']
             for_web_app['bef_optimization']['timeStamps'] = []
 
-            pncoords = []
-
-            for r in range(0, len(node_seq_coords_bef)):
-                dicto = {'x': str(node_seq_coords_bef[r][0]), 'y': str(node_seq_coords_bef[r][1])}
-                pncoords.append(dicto)
-
-            for_web_app['bef_optimization']['pickNodeCoords'] = pncoords
-
-            for_web_app['bef_optimization']['fullPathCoords'] = bef_full_path_coords
+            for_web_app['bef_optimization']['pickNodeCoords'] = \
+                encode_coords(pick_node_coords[seqbef], self.coords_format)
+            for_web_app['bef_optimization']['fullPathCoords'] = \
+                encode_coords(bef_full_path_coords, self.coords_format)
             for_web_app['bef_optimization']['user'] = self.req_resp_dict['responseData']['userIdentifier']
             for_web_app['bef_optimization']['totalDistanceMeters'] = self.req_resp_dict['responseData'][
                 'originalRouteDistance']
@@ -546,13 +557,10 @@ class Handler:
             for_web_app['bef_optimization']['metersPerPick'] = str(solve_dict['lg_sol_fitness'] / (float(len(solve_dict['node_seq_bef_sol']) - 2.0)))
             for_web_app['aft_optimization']['timeStamps'] = []
 
-            pncoords = []
-            for r in range(0, len(node_seq_coords_aft)):
-                dicto = {'x': str(node_seq_coords_aft[r][0]), 'y': str(node_seq_coords_aft[r][1])}
-                pncoords.append(dicto)
-
-            for_web_app['aft_optimization']['pickNodeCoords'] = pncoords
-            for_web_app['aft_optimization']['fullPathCoords'] = aft_full_path_coords
+            for_web_app['aft_optimization']['pickNodeCoords'] = \
+                encode_coords(pick_node_coords[seqaft], self.coords_format)
+            for_web_app['aft_optimization']['fullPathCoords'] = \
+                encode_coords(aft_full_path_coords, self.coords_format)
             for_web_app['aft_optimization']['user'] = self.req_resp_dict['responseData']['userIdentifier']
             for_web_app['aft_optimization']['totalDistanceMeters'] = self.req_resp_dict['responseData']['optimalRouteDistance']
             for_web_app['aft_optimization']['avgVelocityMetersPerSecond'] = None
@@ -569,10 +577,13 @@ class Handler:
             self.req_resp_dict['responseData']['responseTimeTakenSeconds'] = str(respGenTimeTaken)
             for_web_app['responseGeneratedAtDateTime'] = str(respGenTime)
             for_web_app['responseTimeTaken'] = str(respGenTimeTaken)
+            if self.coords_format != VERBOSE:
+                for_web_app['coordsFormat'] = self.coords_format
             self.req_resp_dict['webAppData'] = for_web_app
 
             # Reroute check
             if int(self.req_resp_dict['requestData']['isReroute']):
+                self.req_resp_dict['responseData']['rerouteStartLocation'] = {}
                 self.req_resp_dict['responseData']['rerouteStartLocation']['materialHandlingSection'] = list(self.req_resp_dict['requestData']['rerouteStartLocation']['materialHandlingSection'])
                 self.req_resp_dict['responseData']['rerouteStartLocation']['rackIdentifier'] = list(self.req_resp_dict['requestData']['rerouteStartLocation']['rackIdentifier'])
                 self.req_resp_dict['responseData']['rerouteStartLocation']['rackLocationIdentifier_1'] = list(self.req_resp_dict['requestData']['rerouteStartLocation']['rackLocationIdentifier_1'])
@@ -602,11 +613,11 @@ class Handler:
 
             self.req_resp_dict["jobId"] = self.solve_dict['jobId']
             self.req_resp_dict['responseData']['boxesInBatch'] = self.solve_dict['SingleBatchOutput']['BoxesInBatch']
-            self.req_resp_dict['responseData']['batchAsPickRoute']['boxIdentifier'] = list(self.box_id_seq)
-            self.req_resp_dict['responseData']['batchAsPickRoute']['assignment_identifier'] = list(self.assignment_id_seq)
-            self.req_resp_dict['responseData']['batchAsPickRoute']['materialHandlingSection'] = list(self.material_handling_section_seq)
-            self.req_resp_dict['responseData']['batchAsPickRoute']['rackIdentifier'] = list(self.rack_id_seq)
-            self.req_resp_dict['responseData']['batchAsPickRoute']['rackLocationIdentifier_1'] = list(self.rack_location_id1_seq)
+            self.req_resp_dict['responseData']['batchAsPickRoute']['boxIdentifier'] = self.box_id_seq
+            self.req_resp_dict['responseData']['batchAsPickRoute']['assignment_identifier'] = self.assignment_id_seq
+            self.req_resp_dict['responseData']['batchAsPickRoute']['materialHandlingSection'] = self.material_handling_section_seq
+            self.req_resp_dict['responseData']['batchAsPickRoute']['rackIdentifier'] = self.rack_id_seq
+            self.req_resp_dict['responseData']['batchAsPickRoute']['rackLocationIdentifier_1'] = self.rack_location_id1_seq
             self.req_resp_dict['responseData']['batchAsPickRoute']['rackLocationIdentifier_2'] = [] #doesnt exist for DADC
 
 
@@ -663,19 +674,9 @@ class Handler:
 
             for_web_app['aft_optimization']['timeStamps'] = []
 
-            node_seq_coords_aft = []
             seqaft = self.solve_dict['node_seq_aft_sol']
-
-            for _, val in seqaft:
-                node_seq_coords_aft.append([str(solve_dict['allcoords'][val][0]),
-                                            str(solve_dict['allcoords'][val][1])])
-
-            pncoords = []
-            for r in range(0, len(node_seq_coords_aft)):
-                dicto = {'x': str(node_seq_coords_aft[r][0]), 'y': str(node_seq_coords_aft[r][1])}
-                pncoords.append(dicto)
-
-            for_web_app['aft_optimization']['pickNodeCoords'] = pncoords
+            for_web_app['aft_optimization']['pickNodeCoords'] = \
+                encode_coords(self.pick_node_coords(solve_dict)[seqaft], self.coords_format)
 
             solve_dict['solver_sol'] = list(range(0, len(solve_dict['node_seq_aft_sol'])))
             coords_path_aft_sol = \
@@ -686,16 +687,17 @@ class Handler:
             # to around 2500).
             solve_dict['coords_path_aft_sol'] = coords_path_aft_sol
             solve_dict['node_seq_bef_sol'] = solve_dict['node_seq_aft_sol']
-            aft_full_path_coords = sol_to_xy("",
-                                             solve_dict['coords_path_aft_sol'],
-                                             solve_dict['node_seq_bef_sol'],
-                                             solve_dict['solver_sol'],
-                                             solve_dict['node_seq_aft_sol'],
-                                             solve_dict['startendndarray'],
-                                             solve_dict['spnodeslist'],
-                                             np.asarray(solve_dict['allcoords'], dtype=np.int16))
-
-            for_web_app['aft_optimization']['fullPathCoords'] = aft_full_path_coords
+            aft_full_path_coords = sol_to_xy_array("",
+                                                   solve_dict['node_seq_bef_sol'],
+                                                   solve_dict['solver_sol'],
+                                                   solve_dict['node_seq_aft_sol'],
+                                                   solve_dict['startendndarray'],
+                                                   solve_dict['spnodeslist'],
+                                                   solve_dict['coords_uint32'],
+                                                   solve_dict['predecessors'])
+
+            for_web_app['aft_optimization']['fullPathCoords'] = \
+                encode_coords(aft_full_path_coords, self.coords_format)
             for_web_app['aft_optimization']['user'] = None #self.req_resp_dict['responseData']['userIdentifier']
             for_web_app['aft_optimization']['totalDistanceMeters'] = self.solve_dict['SingleBatchOutput']['TotalDistanceofOptimalRouteForOptimizedBatch'] #str(solve_dict['solver_sol_fitness'])#self.req_resp_dict['responseData']['optimalRouteDistance']
             for_web_app['aft_optimization']['avgVelocityMetersPerSecond'] = None
@@ -715,6 +717,8 @@ class Handler:
             # str(self.calculate_efficiency_gain_DADC(notOptimMetersPerPick, optimMetersPerPick))
             for_web_app['estPercentageEfficiencyGain'] = None
             # print('est % eff gain',for_web_app['estPercentageEfficiencyGain'])
+            if self.coords_format != VERBOSE:
+                for_web_app['coordsFormat'] = self.coords_format
             self.req_resp_dict['webAppData'] = for_web_app
 
         # # JOHAN'S QUICK FIX PART
@@ -0,0 +1,93 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+LocationIndex
+'''
+
+import numpy as np
+
+
+class UnknownLocations(KeyError):
+    """
+    Raised when pick locations of a request are not in the warehouse.
+    locations lists all of them.
+
+    :class: UnknownLocations
+    """
+    def __init__(self, locations):
+        self.locations = list(locations)
+        super().__init__('Unknown pick locations: ' + ', '.join(self.locations))
+
+    def __str__(self):
+        return self.args[0]
+
+
+class LocationIndex:
+    """
+    Index of pick locations, built once per warehouse, that maps a whole
+    request's locations to node indices without a dictionary lookup per
+    pick. A location is a tuple of fields (e.g. section, rack, tier).
+    Every field value is coded as its position among the sorted values
+    of that field, and the codes are combined into one int64 key, so a
+    lookup is a few searchsorted calls and builds no strings.
+
+    :class: LocationIndex
+    """
+    def __init__(self, locations, nodes, separator='_'):
+        """
+        Builds the index.
+
+        :param locations: List of location tuples, all of the same length.
+        :param nodes: Node index of each location.
+        :param separator: Joins the fields of unknown locations in errors.
+        """
+        columns = [np.asarray(column).astype(str) for column in zip(*locations)]
+        self._separator = separator
+        # Sorted distinct values of every field
+        self._values = [np.unique(column) for column in columns]
+        if np.prod([float(len(values)) for values in self._values]) >= 2 ** 63:
+            raise ValueError('Too many distinct location fields for an int64 key')
+        keys = self._combine([np.searchsorted(values, column)
+                              for values, column in zip(self._values, columns)],
+                             len(locations))
+        order = np.argsort(keys)
+        self._keys = keys[order]
+        self._nodes = np.asarray(nodes, dtype=np.int64)[order]
+
+    def _combine(self, codes, count):
+        """
+        Combines the codes of every field into one key per location.
+        """
+        keys = np.zeros(count, dtype=np.int64)
+        for values, code in zip(self._values, codes):
+            keys = keys * len(values) + code
+        return keys
+
+    def lookup(self, *columns):
+        """
+        Looks up node indices for arrays of location fields.
+
+        :param columns: One array per field, e.g. sections, racks, tiers.
+        :raises: UnknownLocations listing every location that is not in the index.
+        :return: Array of node indices, in the order of the locations.
+        """
+        columns = [np.asarray(column).astype(str).ravel() for column in columns]
+        count = len(columns[0]) if columns else 0
+        found = np.full(count, len(columns) == len(self._values) and len(self._keys) > 0)
+        codes = []
+        for values, column in zip(self._values, columns):
+            code = np.minimum(np.searchsorted(values, column), len(values) - 1)
+            found &= values[code] == column
+            codes.append(code)
+        pos = np.zeros(count, dtype=np.int64)
+        if found.any():
+            keys = self._combine(codes, count)
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            found &= self._keys[pos] == keys
+        if not found.all():
+            unknown = [self._separator.join(fields)
+                       for fields in zip(*(column[~found].tolist() for column in columns))]
+            raise UnknownLocations(unknown)
+        return self._nodes[pos]
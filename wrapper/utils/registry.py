@@ -0,0 +1,275 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Registry of the warehouses served by this instance.
+
+The registry manifest is a JSON file, pointed out by the environment
+variable TENSHI_WAREHOUSE_REGISTRY, on the form
+
+    {
+        "memory_budget_mb": 4096,
+        "warehouses": {
+            "KC": {
+                "uuid": "...",
+                "bucket": "...",
+                "metric": "cm",
+                "start_depot_idx": 0,
+                "end_depot_idx": 0,
+                "funcs_module": "utils.funcs_KC",
+                "preload": true
+            }
+        }
+    }
+
+Warehouse data is loaded on first request and kept resident until the
+total size of resident warehouses exceeds the memory budget, at which
+point the least recently used warehouses are evicted. Arrays
+memory-mapped from a warehouse store are not charged to the budget,
+they live in the page cache shared by all processes. The environment
+variable TENSHI_WAREHOUSE_MEMORY_MB overrides the budget of the
+manifest. Without a manifest, KC, the only warehouse that used to be
+hard-coded in Handler with a key lookup module, is served from
+TENSHI_CLIENT_BUCKET.
+'''
+
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from model.distance_matrix import DistanceMatrix
+from .client_storage import get_wh_dict
+from .wh_store import file_size, pack_distmat
+from .warehouse import WarehouseContext
+
+# Used when there is no registry manifest. DADC (cm, depots 0 and 1) and
+# CAG (mm, depots 0 and 0) have no key lookup module and can only be
+# served through a manifest that names one.
+LEGACY_WAREHOUSES = {
+    'KC': {'metric': 'cm', 'start_depot_idx': 0, 'end_depot_idx': 0,
+           'funcs_module': 'utils.funcs_KC'}
+}
+
+
+class Registry:
+    """
+    Class keeping track of warehouse specifications and of which
+    warehouses are resident in memory.
+
+    :class: Registry
+    """
+    def __init__(self):
+        """
+        Constructor, the registry is empty until load() is called.
+        """
+        self._specs = {}
+        self._aliases = {}
+        self._memory_budget = None
+
+        # bucket -> {'wh_dict', 'nbytes', 'contexts'}, least recently used
+        # first. Warehouses sharing a bucket share its data.
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._load_listeners = []
+        # False in worker processes, see use_local_data()
+        self._download = True
+
+    def load(self):
+        """
+        Reads the registry manifest. Warehouses without a funcs_module
+        are left out.
+
+        :raises: ValueError if neither a manifest nor a client bucket is configured.
+        """
+        manifest_file = os.environ.get('TENSHI_WAREHOUSE_REGISTRY')
+        if manifest_file is not None:
+            with open(manifest_file, 'r') as handle:
+                manifest = json.load(handle)
+        else:
+            bucket_name = os.environ.get('TENSHI_CLIENT_BUCKET')
+            if bucket_name is None:
+                raise ValueError('Missing environment variable TENSHI_CLIENT_BUCKET')
+            manifest = {'warehouses': {}}
+            for name, spec in LEGACY_WAREHOUSES.items():
+                manifest['warehouses'][name] = dict(spec, bucket=bucket_name)
+            # All legacy warehouses share one bucket, preloading one is enough
+            manifest['warehouses']['KC']['preload'] = True
+
+        memory_budget_mb = os.environ.get('TENSHI_WAREHOUSE_MEMORY_MB',
+                                          manifest.get('memory_budget_mb'))
+        with self._lock:
+            self._memory_budget = None if memory_budget_mb is None \
+                else int(float(memory_budget_mb) * 1024 * 1024)
+            self._specs = {}
+            self._aliases = {}
+            for name, spec in manifest['warehouses'].items():
+                if not spec.get('funcs_module'):
+                    # Handler cannot map its pick locations to nodes
+                    print('Registry: warehouse {} has no funcs_module, not served'.format(name))
+                    continue
+                self._specs[name] = dict(spec, name=name)
+                self._aliases[name] = name
+                if spec.get('uuid'):
+                    self._aliases[spec['uuid']] = name
+
+    def use_local_data(self):
+        """
+        Makes get() read warehouse data from the local folders the
+        service downloaded it to, without downloading anything. Used in
+        worker processes, the service keeps the files up to date.
+        """
+        self._download = False
+
+    def add_load_listener(self, listener):
+        """
+        Registers a function to call whenever warehouse data has been
+        loaded, e.g. to drop results computed from older data.
+
+        :param listener: Called as listener(bucket_name).
+        """
+        self._load_listeners.append(listener)
+
+    def names(self):
+        """
+        Returns the names of all registered warehouses.
+        :return:
+        """
+        return list(self._specs.keys())
+
+    def preload_names(self):
+        """
+        Returns the names of the warehouses to load during warm-up.
+        :return:
+        """
+        return [name for name, spec in self._specs.items() if spec.get('preload')]
+
+    def resolve(self, *keys):
+        """
+        Resolves a warehouse tag or UUID to a warehouse name. The first
+        key that is registered wins.
+
+        :param keys: Tags and/or UUIDs to try.
+        :raises: KeyError if none of the keys is registered.
+        :return: The warehouse name.
+        """
+        for key in keys:
+            if key is not None and str(key) in self._aliases:
+                return self._aliases[str(key)]
+        raise KeyError('Unknown warehouse: ' + ', '.join(str(key) for key in keys))
+
+    def get(self, *keys, progress=None):
+        """
+        Returns a warehouse with its data resident, loading the data
+        first if needed.
+
+        :param keys: Tags and/or UUIDs identifying the warehouse.
+        :param progress: Optional callback, called as progress(bucket, file_name, status),
+                         see client_storage.get_wh_dict.
+        :raises: KeyError if the warehouse is unknown.
+        :raises: IOError if the warehouse data could not be loaded.
+        :return: The WarehouseContext of the warehouse.
+        """
+        name = self.resolve(*keys)
+        spec = self._specs[name]
+        bucket_name = spec['bucket']
+        with self._lock:
+            if bucket_name in self._resident:
+                self._resident.move_to_end(bucket_name)
+                return self._context(name, bucket_name)
+            load_lock = self._load_locks.setdefault(bucket_name, threading.Lock())
+
+        # Only one thread loads a given bucket, the others wait for it
+        with load_lock:
+            with self._lock:
+                if bucket_name in self._resident:
+                    self._resident.move_to_end(bucket_name)
+                    return self._context(name, bucket_name)
+            client_data_dir = '{}/{}'.format('client-data', bucket_name)
+            if progress is None:
+                wh_dict = get_wh_dict(bucket_name, client_data_dir, download=self._download)
+            else:
+                wh_dict = get_wh_dict(bucket_name, client_data_dir,
+                                      lambda file_name, status:
+                                      progress(bucket_name, file_name, status),
+                                      download=self._download)
+            if wh_dict is None:
+                raise IOError('Failed to load warehouse data for ' + name)
+            pack_distmat(wh_dict)
+            with self._lock:
+                self._resident[bucket_name] = {'wh_dict': wh_dict,
+                                               'nbytes': Registry.size_of(wh_dict),
+                                               'contexts': {}}
+                self._evict(keep=bucket_name)
+                context = self._context(name, bucket_name)
+            for listener in self._load_listeners:
+                listener(bucket_name)
+            return context
+
+    def _context(self, name, bucket_name):
+        """
+        Returns the WarehouseContext of a warehouse whose data is
+        resident, building it on first use. Must be called with the lock
+        held.
+        """
+        contexts = self._resident[bucket_name]['contexts']
+        if name not in contexts:
+            contexts[name] = WarehouseContext(self._specs[name],
+                                              self._resident[bucket_name]['wh_dict'])
+        return contexts[name]
+
+    def resident(self):
+        """
+        Returns the buckets and sizes of resident warehouse data, least
+        recently used first.
+        :return:
+        """
+        with self._lock:
+            return [(bucket_name, data['nbytes']) for bucket_name, data in self._resident.items()]
+
+    def _evict(self, keep):
+        """
+        Evicts least recently used warehouse data until the resident set
+        fits in the memory budget. Must be called with the lock held.
+
+        :param keep: Bucket whose data must stay resident.
+        """
+        if self._memory_budget is None:
+            return
+        total = sum(data['nbytes'] for data in self._resident.values())
+        for bucket_name in list(self._resident.keys()):
+            if total <= self._memory_budget:
+                break
+            if bucket_name == keep:
+                continue
+            total -= self._resident.pop(bucket_name)['nbytes']
+            print('Registry: evicted warehouse data from {}'.format(bucket_name))
+
+    @staticmethod
+    def size_of(wh_dict):
+        """
+        Estimates the memory held by a warehouse dictionary. Memory-mapped
+        arrays are not counted, they are in the page cache and shared by
+        all processes. Unpickled objects are counted as the size of their
+        file.
+
+        :param wh_dict:
+        :return: Size in bytes.
+        """
+        size = 0
+        for key, value in wh_dict.items():
+            if isinstance(value, DistanceMatrix):
+                value = value.packed
+            if isinstance(value, np.memmap):
+                continue
+            if isinstance(value, np.ndarray):
+                size += value.nbytes
+            else:
+                size += file_size(key)
+        return size
+
+
+# Singleton
+REGISTRY = Registry()
@@ -0,0 +1,323 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Typed request structs.
+
+Request bodies are decoded with the codec and validated against a
+schema in one step, so a malformed request is rejected with every
+problem listed before any warehouse data is touched. Flags and numbers
+are parsed strictly, so Handler gets no value it cannot convert, and
+the request level ones are kept as typed attributes. The body is kept
+as well, since Handler fills the response into it.
+'''
+
+from .codec import CODEC
+
+PICK_ROUTE_OPTIMIZATION = 'PICK_ROUTE_OPTIMIZATION'
+BATCH_OPTIMIZATION = 'BATCH_OPTIMIZATION'
+
+# Fields of a pick location list, they must all be of the same length
+PICK_LOCATION_FIELDS = ('assignment_identifier',
+                        'original_sorting_number',
+                        'materialHandlingSection',
+                        'rackIdentifier',
+                        'rackLocationIdentifier_1')
+
+# Fields of the picker's location in a reroute request, one entry each
+REROUTE_LOCATION_FIELDS = ('materialHandlingSection',
+                           'rackIdentifier',
+                           'rackLocationIdentifier_1')
+
+# Fields that are only echoed into the response, they must be present
+ANY = (object, )
+
+
+def _integer(value):
+    """
+    Parses an int field. Strings must hold a plain decimal number.
+    """
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    raise ValueError('must be an integer')
+
+
+def _flag(value):
+    """
+    Parses a 0/1 flag such as isReroute, an int, a bool or "0"/"1".
+    """
+    try:
+        value = _integer(value)
+    except ValueError:
+        value = None
+    if value not in (0, 1):
+        raise ValueError('must be 0 or 1')
+    return bool(value)
+
+
+def _number(value):
+    """
+    Parses a number field such as maxBatchWeight.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError('must be a number')
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError('must be a number')
+
+
+# Dotted path -> accepted types or parser, per request type
+SCHEMAS = {
+    PICK_ROUTE_OPTIMIZATION: (
+        [('requestData', (dict, )),
+         ('requestData.isReroute', _flag),
+         ('requestData.isClockwise', _flag),
+         ('requestData.returnPickerHints', (int, str)),
+         ('requestData.userIdentifier', ANY),
+         ('requestData.pickRoundIdentifier', ANY),
+         ('requestData.mobileUnitIdentifier', ANY),
+         ('requestData.pickLocations', (dict, )),
+         ('requestData.pickLocations.rackLocationIdentifier_2', (list, ))] +
+        [('requestData.pickLocations.' + field, (list, )) for field in PICK_LOCATION_FIELDS]
+    ),
+    BATCH_OPTIMIZATION: [
+        ('requestData', (dict, )),
+        ('requestData.maxNumBoxesToBatch', _integer),
+        ('requestData.enf_w_con', _flag),
+        ('requestData.enf_v_con', _flag),
+        ('requestData.forceBatchBoxes', (list, )),
+        ('requestData.availableBoxes', (list, ))
+    ]
+}
+
+# Fields of the item locations of a box, they must all be of the same length
+BOX_ITEM_FIELDS = ('materialHandlingSection',
+                   'rackIdentifier',
+                   'rackLocationIdentifier_1')
+
+# Fields of a box in availableBoxes
+BOX_FIELDS = [('boxIdentifier', ANY),
+              ('boxItemInfo', (dict, ))] + \
+    [('boxItemInfo.' + field, (list, )) for field in BOX_ITEM_FIELDS]
+
+_MISSING = object()
+
+
+def _lookup(body, path):
+    """
+    Looks up a dotted path in nested dictionaries.
+    """
+    value = body
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def _check(body, schema, prefix=''):
+    """
+    Checks body against a schema.
+
+    :return: Tuple (dictionary from path to parsed value, list of problems).
+    """
+    values = {}
+    errors = []
+    for path, kind in schema:
+        value = _lookup(body, path)
+        if value is _MISSING:
+            errors.append(prefix + path + ' is missing')
+        elif isinstance(kind, tuple):
+            if isinstance(value, kind):
+                values[path] = value
+            else:
+                errors.append('{}{} must be {}'.format(
+                    prefix, path, ' or '.join(type_.__name__ for type_ in kind)))
+        else:
+            try:
+                values[path] = kind(value)
+            except ValueError as exc:
+                errors.append('{}{} {}'.format(prefix, path, exc))
+    return values, errors
+
+
+class OptimizationRequest:
+    """
+    A decoded and validated optimization request. The fields Handler
+    needs are parsed into typed attributes, None if they do not apply
+    to the request type. body is the request as it was sent, Handler
+    fills the response into it.
+
+    :class: OptimizationRequest
+    """
+    __slots__ = ('task_id', 'warehouse_uuid', 'warehouse_tag', 'request_type', 'body',
+                 'is_reroute', 'is_clockwise', 'max_boxes_to_batch', 'enforce_weight',
+                 'enforce_volume', 'max_batch_weight', 'max_batch_volume')
+
+    def __init__(self, body, task_id, warehouse_uuid, warehouse_tag, request_type, values=None):
+        values = values or {}
+        self.body = body
+        self.task_id = task_id
+        self.warehouse_uuid = warehouse_uuid
+        self.warehouse_tag = warehouse_tag
+        self.request_type = request_type
+        self.is_reroute = values.get('requestData.isReroute')
+        self.is_clockwise = values.get('requestData.isClockwise')
+        self.max_boxes_to_batch = values.get('requestData.maxNumBoxesToBatch')
+        self.enforce_weight = values.get('requestData.enf_w_con')
+        self.enforce_volume = values.get('requestData.enf_v_con')
+        self.max_batch_weight = values.get('requestData.maxBatchWeight')
+        self.max_batch_volume = values.get('requestData.maxBatchVolume')
+
+    @staticmethod
+    def decode(data, require_task_id=False, require_data=True):
+        """
+        Decodes and validates a request body.
+
+        :param data: The request body as JSON bytes or str.
+        :param require_task_id: If _meta.taskId must be set.
+        :param require_data: If requestType and requestData must be set and
+                             valid, False for bodies that refer to a task payload.
+        :raises: ValueError listing all problems if the request is invalid.
+        :return: OptimizationRequest.
+        """
+        try:
+            body = CODEC.loads(data)
+        except ValueError as exc:
+            raise ValueError('Invalid JSON: ' + str(exc))
+        return OptimizationRequest.from_dict(body, require_task_id, require_data)
+
+    @staticmethod
+    def from_dict(body, require_task_id=False, require_data=True):
+        """
+        Validates a decoded request body, see decode().
+
+        :param body:
+        :param require_task_id:
+        :param require_data:
+        :raises: ValueError listing all problems if the request is invalid.
+        :return: OptimizationRequest.
+        """
+        if not isinstance(body, dict):
+            raise ValueError('Invalid request: body is not a JSON object')
+
+        errors = []
+        task_id = _lookup(body, '_meta.taskId')
+        if task_id is _MISSING or task_id is None:
+            task_id = None
+            if require_task_id:
+                errors.append('_meta.taskId is missing')
+        warehouse_uuid = _lookup(body, '_meta.warehouse.uuid')
+        warehouse_tag = _lookup(body, '_meta.warehouse.tag')
+
+        request_type = body.get('requestType')
+        values = {}
+        if require_data:
+            values, data_errors = OptimizationRequest.parse(body, request_type)
+            errors += data_errors
+
+        if errors:
+            raise ValueError('Invalid request: ' + '; '.join(errors))
+        return OptimizationRequest(body,
+                                   None if task_id is None else str(task_id),
+                                   None if warehouse_uuid is _MISSING else warehouse_uuid,
+                                   str(None if warehouse_tag is _MISSING else warehouse_tag),
+                                   request_type,
+                                   values)
+
+    @staticmethod
+    def validate(body, request_type):
+        """
+        Checks a request body against the schema of its request type.
+
+        :param body:
+        :param request_type:
+        :return: List of problems, empty if the body is valid.
+        """
+        return OptimizationRequest.parse(body, request_type)[1]
+
+    @staticmethod
+    def parse(body, request_type):
+        """
+        Checks a request body against the schema of its request type and
+        parses its typed fields.
+
+        :param body:
+        :param request_type:
+        :return: Tuple (dictionary from dotted path to parsed value,
+                 list of problems, empty if the body is valid).
+        """
+        if request_type not in SCHEMAS:
+            return {}, ['unknown requestType: ' + str(request_type)]
+
+        values, errors = _check(body, SCHEMAS[request_type])
+        if errors:
+            return values, errors
+
+        if request_type == PICK_ROUTE_OPTIMIZATION:
+            pick_locations = body['requestData']['pickLocations']
+            lengths = {len(pick_locations[field]) for field in PICK_LOCATION_FIELDS}
+            if len(lengths) > 1:
+                errors.append('requestData.pickLocations lists differ in length')
+            if values['requestData.isReroute']:
+                errors += OptimizationRequest.validate_reroute(body)
+        elif request_type == BATCH_OPTIMIZATION:
+            limits = []
+            if values['requestData.enf_w_con']:
+                limits.append(('requestData.maxBatchWeight', _number))
+            if values['requestData.enf_v_con']:
+                limits.append(('requestData.maxBatchVolume', _number))
+            limit_values, errors = _check(body, limits)
+            values.update(limit_values)
+            errors += OptimizationRequest.validate_boxes(body, values)
+        return values, errors
+
+    @staticmethod
+    def validate_reroute(body):
+        """
+        Checks the picker's location of a reroute request.
+
+        :param body:
+        :return: List of problems, empty if the location is valid.
+        """
+        location = _lookup(body, 'requestData.rerouteStartLocation')
+        if not isinstance(location, dict):
+            return ['requestData.rerouteStartLocation is missing']
+        errors = []
+        for field in REROUTE_LOCATION_FIELDS:
+            if not isinstance(location.get(field), list) or len(location[field]) != 1:
+                errors.append('requestData.rerouteStartLocation.{} must be a list of one '
+                              'location'.format(field))
+        return errors
+
+    @staticmethod
+    def validate_boxes(body, values):
+        """
+        Checks the boxes of a batch request.
+
+        :param body:
+        :param values: Parsed fields of the request, see parse().
+        :return: List of problems, empty if the boxes are valid.
+        """
+        schema = list(BOX_FIELDS)
+        if values['requestData.enf_w_con']:
+            schema.append(('boxWeight', _number))
+        if values['requestData.enf_v_con']:
+            schema.append(('boxVolume', _number))
+        errors = []
+        for i, box in enumerate(body['requestData']['availableBoxes']):
+            prefix = 'requestData.availableBoxes[{}].'.format(i)
+            if not isinstance(box, dict):
+                errors.append(prefix[:-1] + ' must be dict')
+                continue
+            box_errors = _check(box, schema, prefix)[1]
+            if not box_errors:
+                info = box['boxItemInfo']
+                if len({len(info[field]) for field in BOX_ITEM_FIELDS}) > 1:
+                    box_errors.append(prefix + 'boxItemInfo lists differ in length')
+            errors += box_errors
+        return errors
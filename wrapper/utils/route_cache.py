@@ -0,0 +1,158 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Route result cache.
+
+The same pick rounds are often optimized more than once (retries,
+reroutes, the WMS sending a round again). The optimal route only
+depends on the warehouse data, the depots, the set of pick nodes and
+the clockwise/reroute flags, not on the order the picks were sent in,
+so solutions are cached under
+
+    (warehouse, data version, start depot, end depot,
+     sorted pick nodes, clockwise, reroute)
+
+Reroutes repair the order they were sent in (see RerouteSolver), so
+their picks are kept in that order in the key.
+
+in a bounded LRU whose entries expire after a TTL. All entries are
+dropped whenever warehouse data is loaded.
+'''
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from model.trivial_instance_solver import TrivialInstanceSolver
+from .registry import REGISTRY
+
+
+class RouteCache:
+    """
+    LRU cache of solved routes.
+
+    :class: RouteCache
+    """
+    def __init__(self, max_entries=None, ttl=None):
+        """
+        Constructor.
+
+        :param max_entries: Maximum number of routes, TENSHI_ROUTE_CACHE_SIZE
+                            or 10000 if None. 0 disables the cache.
+        :param ttl: Seconds a route is kept, TENSHI_ROUTE_CACHE_TTL or 3600 if None.
+        """
+        self._max_entries = int(max_entries if max_entries is not None else
+                                os.environ.get('TENSHI_ROUTE_CACHE_SIZE', 10000))
+        self._ttl = float(ttl if ttl is not None else
+                          os.environ.get('TENSHI_ROUTE_CACHE_TTL', 3600))
+        self._lock = threading.Lock()
+
+        # key -> (expiry time, node_seq_aft_sol, solver_sol_fitness)
+        self._entries = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0,
+                          'invalidations': 0}
+
+    @staticmethod
+    def key(solve_dict):
+        """
+        Returns the cache key of the route of a request.
+
+        :param solve_dict:
+        :return:
+        """
+        nodes = [int(node) for node in solve_dict['node_seq_bef_sol']]
+        is_reroute_req = int(solve_dict['is_reroute_req'] or 0)
+        return (solve_dict['name'],
+                solve_dict['data_version'],
+                nodes[0],
+                nodes[-1],
+                tuple(nodes[1:-1] if is_reroute_req else sorted(nodes[1:-1])),
+                int(solve_dict['is_clockwise_req'] or 0),
+                is_reroute_req)
+
+    def apply(self, solve_dict):
+        """
+        Fills in the solver results of solve_dict from a cached route.
+
+        :param solve_dict:
+        :return: True on a hit, False if the route must be solved.
+        """
+        if self._max_entries <= 0:
+            return False
+        time0 = time.time()
+        key = RouteCache.key(solve_dict)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self._counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self._counters['misses'] += 1
+                return False
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+        _, node_seq_aft_sol, solver_sol_fitness = entry
+
+        # solver_sol holds positions in this request's node_seq_bef_sol,
+        # picks of the same node are matched in order
+        node_seq_bef_sol = [int(node) for node in solve_dict['node_seq_bef_sol']]
+        positions = {}
+        for position in range(len(node_seq_bef_sol) - 2, 0, -1):
+            positions.setdefault(node_seq_bef_sol[position], []).append(position)
+        solver_sol = [0] + [positions[node].pop() for node in node_seq_aft_sol[1:-1]] + \
+            [len(node_seq_bef_sol) - 1]
+
+        solve_dict['lg_sol_fitness'] = TrivialInstanceSolver.getdist(
+            solve_dict['distmat'], node_seq_bef_sol, solve_dict['metric'])
+        solve_dict['solver_sol'] = solver_sol
+        solve_dict['solver_sol_fitness'] = solver_sol_fitness
+        solve_dict['node_seq_aft_sol'] = list(node_seq_aft_sol)
+        solve_dict['time_to_optimize'] = time.time() - time0
+        return True
+
+    def store(self, solve_dict):
+        """
+        Caches the solved route of solve_dict.
+
+        :param solve_dict:
+        """
+        if self._max_entries <= 0:
+            return
+        key = RouteCache.key(solve_dict)
+        entry = (time.monotonic() + self._ttl,
+                 tuple(int(node) for node in solve_dict['node_seq_aft_sol']),
+                 solve_dict['solver_sol_fitness'])
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, *_):
+        """
+        Drops all cached routes. Called when warehouse data is loaded.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        """
+        Returns the counters and the number of cached routes.
+
+        :return: Dictionary with 'hits', 'misses', 'evictions',
+                 'expired', 'invalidations' and 'entries'.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        return stats
+
+
+# Singleton
+ROUTE_CACHE = RouteCache()
+REGISTRY.add_load_listener(ROUTE_CACHE.invalidate)
@@ -0,0 +1,148 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Route geometry from a predecessor matrix.
+
+spnodeslist and startendndarray list every node of the shortest path
+of every node pair, which makes them by far the largest warehouse
+files. A warehouse store can ship the predecessor matrix of the
+shortest paths instead: predecessors[i, j] is the node before j on the
+path from i to j (negative if j == i), int16 for up to 32767 nodes. The
+nodes of a leg are found by walking that row back from j to i, which
+gives the same path as the one listed in spnodeslist for (i, j).
+
+The walk is compiled with numba when it is installed and done on all
+legs of a route at once with NumPy otherwise.
+'''
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# predecessors value of the start node of a path
+NO_PREDECESSOR = -9999
+
+
+def compact_dtype(num_nodes):
+    """
+    Returns the smallest dtype holding the predecessors of num_nodes nodes.
+
+    :param num_nodes:
+    :return: np.int16 or np.int32.
+    """
+    return np.int16 if num_nodes <= np.iinfo(np.int16).max else np.int32
+
+
+def expand_legs(predecessors, sources, targets):
+    """
+    Lists the nodes of the shortest path of every leg, both ends
+    included, in the same format as spnodeslist and startendndarray.
+
+    :param predecessors: Predecessor matrix of the warehouse.
+    :param sources: First node of every leg.
+    :param targets: Last node of every leg.
+    :raises: ValueError if a target cannot be reached from its source.
+    :return: (nodes, legs), the path of leg k is
+             nodes[legs[k, 0]:legs[k, 1]].
+    """
+    predecessors = np.asarray(predecessors)
+    sources = np.asarray(sources, dtype=np.int64).flatten()
+    targets = np.asarray(targets, dtype=np.int64).flatten()
+    if njit is None:
+        return _expand_numpy(predecessors, sources, targets)
+    nodes, legs = _expand_jit(predecessors, sources, targets)
+    if len(legs) and legs[-1, 1] < 0:
+        # the kernel marks a leg without a path, see _expand_kernel
+        _no_path(sources, targets, -legs[-1, 1] - 1)
+    return nodes, legs
+
+
+def leg_nodes(predecessors, from_node, to_node):
+    """
+    Nodes of the shortest path from from_node to to_node, both included.
+
+    :param predecessors:
+    :param from_node:
+    :param to_node:
+    :return: Array of node indices.
+    """
+    nodes, _ = expand_legs(predecessors, [from_node], [to_node])
+    return nodes
+
+
+def _no_path(sources, targets, leg):
+    """
+    Raises the error of a leg whose target cannot be reached.
+    """
+    raise ValueError('No path from node {} to node {}'.format(sources[leg], targets[leg]))
+
+
+def _expand_numpy(predecessors, sources, targets):
+    """
+    Walks all legs back from their targets at once, one step per round.
+    """
+    flat = predecessors.reshape(-1)
+    rows = sources * len(predecessors)
+    legs = np.arange(len(sources))
+    current = targets
+    leg_parts = [legs]
+    node_parts = [current]
+    while len(legs):
+        more = current != sources[legs]
+        legs = legs[more]
+        current = flat[rows[legs] + current[more]]
+        if len(current) and current.min() < 0:
+            _no_path(sources, targets, legs[np.argmax(current < 0)])
+        leg_parts.append(legs)
+        node_parts.append(current)
+
+    leg_of = np.concatenate(leg_parts)
+    # round k found the k:th node of a leg counted from its target
+    steps = np.repeat(np.arange(len(leg_parts)), [len(part) for part in leg_parts])
+    lengths = np.bincount(leg_of, minlength=len(sources))
+    ends = np.cumsum(lengths)
+    nodes = np.empty(ends[-1] if len(ends) else 0, dtype=np.int64)
+    nodes[ends[leg_of] - 1 - steps] = np.concatenate(node_parts)
+    return nodes, np.stack((ends - lengths, ends), axis=1)
+
+
+def _expand_kernel(predecessors, sources, targets):
+    """
+    Walks the legs one by one, first to size them, then to fill them in.
+    Plain Python, compiled with numba when it is installed. A leg
+    without a path is returned as -(leg + 1) in the last end.
+    """
+    num_legs = len(sources)
+    legs = np.empty((num_legs, 2), dtype=np.int64)
+    total = 0
+    for leg in range(num_legs):
+        node = targets[leg]
+        count = 1
+        while node != sources[leg]:
+            node = predecessors[sources[leg], node]
+            if node < 0:
+                legs[num_legs - 1, 1] = -leg - 1
+                return np.empty(0, dtype=np.int64), legs
+            count += 1
+        legs[leg, 0] = total
+        total += count
+        legs[leg, 1] = total
+
+    nodes = np.empty(total, dtype=np.int64)
+    for leg in range(num_legs):
+        position = legs[leg, 1] - 1
+        node = targets[leg]
+        nodes[position] = node
+        while node != sources[leg]:
+            node = predecessors[sources[leg], node]
+            position -= 1
+            nodes[position] = node
+    return nodes, legs
+
+
+_expand_jit = None if njit is None else njit(cache=True, nogil=True)(_expand_kernel)
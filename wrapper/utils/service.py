@@ -6,10 +6,10 @@
 Service
 '''
 
-import os
+import json
 import threading
 from flask import Response
-from .client_storage import get_wh_dict
+from .registry import REGISTRY
 
 
 class Service:
@@ -34,24 +34,47 @@ class Service:
         """
         # Warm up state
         self._state = Service.STATES['started']
+        self._lock = threading.Lock()
 
-        # Warehouse dictionary
-        self._wh_dict = None
+        # '<bucket>/<file>' -> last reported status, see client_storage.get_wh_dict
+        self._progress = {}
+
+    def _report_progress(self, bucket_name, file_name, status):
+        """
+        Progress callback for files loaded during warm-up.
+        """
+        with self._lock:
+            self._progress['{}/{}'.format(bucket_name, file_name)] = status
 
     def _load_wh_dict(self):
         """
-        Loads warehouse dictionary as part of the warm up.
+        Loads the warehouse registry and the warehouses marked for
+        preloading as part of the warm up. Other warehouses are loaded
+        on their first request.
         """
-        bucket_name = os.environ.get('TENSHI_CLIENT_BUCKET')
-        if bucket_name is None:
-            print('Missing environment variable TENSHI_CLIENT_BUCKET')
+        try:
+            REGISTRY.load()
+            for name in REGISTRY.preload_names():
+                REGISTRY.get(name, progress=self._report_progress)
+        except Exception as exc:
+            # Any error ends warm-up, the thread must not die in 'warm_up'
+            print('Error: warm-up failed: {!r}'.format(exc))
             self._state = Service.STATES['failed']
             return
-        self._wh_dict = get_wh_dict(bucket_name)
-        if self._wh_dict is None:
-            self._state = Service.STATES['failed']
-        else:
-            self._state = Service.STATES['ready']
+        self._state = Service.STATES['ready']
+
+    def start_warm_up(self):
+        """
+        Starts warm-up in a background thread unless it is already
+        started. Never blocks.
+        :return: True if warm-up was started by this call.
+        """
+        with self._lock:
+            if self._state != Service.STATES['started']:
+                return False
+            self._state = Service.STATES['warm_up']
+        threading.Thread(target=self._load_wh_dict, name='warm-up', daemon=True).start()
+        return True
 
     def ready(self):
         """
@@ -68,22 +91,32 @@ class Service:
         """
         return self._state
 
-    def wh_dict(self):
+    def progress(self):
+        """
+        Returns the status of every file loaded during warm-up.
+        :return: Dictionary from '<bucket>/<file>' to status.
+        """
+        with self._lock:
+            return dict(self._progress)
+
+    @staticmethod
+    def warehouse(*keys):
         """
-        Returns the current warehouse dictionary.
-        :return: Dictionary containing warehouse information.
+        Returns a warehouse from the registry, loading its data if it is
+        not resident.
+        :param keys: Tags and/or UUIDs identifying the warehouse.
+        :raises: KeyError if the warehouse is unknown.
+        :return: The WarehouseContext of the warehouse.
         """
-        return self._wh_dict
+        return REGISTRY.get(*keys)
 
     def warm_up(self):
         """
         Runs warm-up depending on current warm-up state.
         :return: Response corresponding to the warm-up state.
         """
-        if self._state == Service.STATES['started']:
+        if self.start_warm_up():
             # Service is just starting, go to warm up
-            self._state = Service.STATES['warm_up']
-            threading.Thread(target=self._load_wh_dict()).start()
             return Response('starting warm-up', status=503)
 
         if self._state == Service.STATES['warm_up']:
@@ -97,6 +130,26 @@ class Service:
         # Warm-pu failed
         return Response('warm-up failed', status=503)
 
+    @staticmethod
+    def liveness():
+        """
+        Liveness probe. The process answers, so it is alive, also while
+        warming up.
+        :return: Response with status 200.
+        """
+        return Response('alive', status=200)
+
+    def readiness(self):
+        """
+        Readiness probe. Starts warm-up if it has not been started.
+        :return: Response with status 200 if ready, 503 otherwise. The
+                 body holds the state and the per file progress.
+        """
+        self.start_warm_up()
+        body = json.dumps({'state': self._state, 'files': self.progress()})
+        return Response(body, status=200 if self.ready() else 503,
+                        mimetype='application/json')
+
 
 # It's a singleton
 SERVICE = Service()
@@ -18,6 +18,10 @@
 # See how these are loaded/created in ControllerMW -> load_data()
 '''
 
+import numpy as np
+from .route_geometry import expand_legs
+
+
 def sol_to_xy(name,
               coords_path_bef_sol,
               indicies_bef_sol,
@@ -25,85 +29,98 @@ def sol_to_xy(name,
               ind_aft_sol,
               startendndarray,
               spnodeslist,
-              coords_all):
+              coords_all,
+              predecessors=None):
     """
     sol_to_xy
     :param name:
-    :param coords_path_bef_sol:
+    :param coords_path_bef_sol: Not used, kept for compatibility.
     :param indicies_bef_sol:
     :param sol_list:
     :param ind_aft_sol:
     :param startendndarray:
     :param spnodeslist:
     :param coords_all:
-    :return:
+    :param predecessors: Predecessor matrix, used instead of startendndarray
+                         and spnodeslist if given, see route_geometry.py.
+    :return: List of {'x': str, 'y': str}, one per full path coordinate.
     """
 
-    def get_fullpath_coords():
-        """
-        get_fullpath_coords
-        :return:
-        """
-        fullpath_coords = []  # for debugging
-        fullpath_coords_flat = []
-
-        for i in range(0, len(sol) - 1):  # gen fullpath of the sol nodes
-
-            sol_from = sol[i]
-            sol_to = sol[i + 1]
-
-            ind_from = indicies_bef_sol[sol_from]
-            ind_to = indicies_bef_sol[sol_to]
-
-            nodes_path_start = (startendndarray[:, :, 0][ind_from][ind_to])
-            nodes_path_end = (startendndarray[:, :, 1][ind_from][ind_to])
-
-            indicies_path_coords = spnodeslist[nodes_path_start:nodes_path_end]
-
-            nodes_path_coords = coords_all[indicies_path_coords, :]
-
-            nodes_path_coords = nodes_path_coords.tolist()  # it is saved as npy
-
-            if len(nodes_path_coords) < 2:
-                # print("INSIDE POSSIBLY REDUNDANT IF (its for safety")
-                node_to_coords = coords_path_bef_sol[sol_to]
-                fullpath_coords.append([node_to_coords])  # as list because else adds a list
-            else:  # adds whole path as list
-                if fullpath_coords_flat:
-                    # cannot do this until fullpath has got its first path
-                    prev = fullpath_coords_flat[-1]
-                    this = nodes_path_coords[0]
-
-                    # check that nodes are linked
-                    if (prev[0] != this[0]) or (prev[1] != this[1]):  # x and y
-                        # raise ValueError("joErr nodes not linked!")
-                        wrong_node0 = ias[i - 1]
-                        wrong_node1 = ias[i]
-                        # print("temp")
-                        print("joWarn: nodes not linked in " + name + "! Wrong nodes: " +
-                              str(wrong_node0) + "   " + str(wrong_node1) +
-                              "        x0: " + str(prev[0]) +
-                              " y0: " + str(prev[1]) +
-                              "    x1: " + str(this[0]) +
-                              " y1: " + str(this[1]))
-
-                fullpath_coords.append(nodes_path_coords)  #
-                fullpath_coords_flat.extend(nodes_path_coords[1:])
-
-        # append info of first node
-        fullpath_coords_flat = [fullpath_coords[0][0]] + fullpath_coords_flat
-
-        return fullpath_coords_flat
-
-    sol = sol_list
-    ias = ind_aft_sol
-    name = name
-
-    path_coords = get_fullpath_coords()
-
-    full_path_coords_pp = []  # post processed
-    for row in path_coords:
-        dicto = {'x': str(row[0]), 'y': str(row[1])}
-        full_path_coords_pp.append(dicto)
+    path_coords = sol_to_xy_array(name,
+                                  indicies_bef_sol,
+                                  sol_list,
+                                  ind_aft_sol,
+                                  startendndarray,
+                                  spnodeslist,
+                                  coords_all,
+                                  predecessors)
+
+    return [{'x': str(x), 'y': str(y)} for x, y in path_coords.tolist()]
+
+
+def sol_to_xy_array(name,
+                    indicies_bef_sol,
+                    sol_list,
+                    ind_aft_sol,
+                    startendndarray,
+                    spnodeslist,
+                    coords_all,
+                    predecessors=None):
+    """
+    Vectorized full path generation. All legs are looked up in
+    startendndarray at once, their node ranges in spnodeslist are
+    gathered and concatenated, dropping the first node of every leg
+    since it is the last node of the previous one. With a predecessor
+    matrix the legs are expanded first, into the same format.
+    :param name:
+    :param indicies_bef_sol:
+    :param sol_list:
+    :param ind_aft_sol:
+    :param startendndarray:
+    :param spnodeslist:
+    :param coords_all: Coordinates of all nodes, already cast to the output dtype.
+    :param predecessors: Predecessor matrix, used instead of startendndarray
+                         and spnodeslist if given, see route_geometry.py.
+    :return: Array of shape (n, 2) with the full path coordinates.
+    """
 
-    return full_path_coords_pp
+    sol = np.asarray(sol_list, dtype=np.int64).flatten()
+    inds = np.asarray(indicies_bef_sol, dtype=np.int64).flatten()[sol]
+    if len(inds) < 2:
+        return coords_all[inds, :]
+
+    if predecessors is not None:
+        spnodeslist, legs = expand_legs(predecessors, inds[:-1], inds[1:])
+    else:
+        legs = np.asarray(startendndarray[inds[:-1], inds[1:]], dtype=np.int64)
+    starts = legs[:, 0]
+    ends = legs[:, 1]
+    # legs shorter than 2 nodes (same node twice) add nothing to the path
+    long_legs = ends - starts >= 2
+    starts = starts[long_legs]
+    ends = ends[long_legs]
+
+    # first node of the path
+    first = spnodeslist[starts[0]] if long_legs[0] else inds[1]
+
+    # check that consecutive legs are linked
+    linked = np.all(coords_all[spnodeslist[starts[1:]]] == coords_all[spnodeslist[ends[:-1] - 1]],
+                    axis=1)
+    for bad in np.flatnonzero(~linked):
+        leg = np.flatnonzero(long_legs)[bad + 1]
+        prev = coords_all[spnodeslist[ends[bad] - 1]]
+        this = coords_all[spnodeslist[starts[bad + 1]]]
+        print("joWarn: nodes not linked in " + name + "! Wrong nodes: " +
+              str(ind_aft_sol[leg - 1]) + "   " + str(ind_aft_sol[leg]) +
+              "        x0: " + str(prev[0]) +
+              " y0: " + str(prev[1]) +
+              "    x1: " + str(this[0]) +
+              " y1: " + str(this[1]))
+
+    # spnodeslist[start + 1:end] of every leg, gathered at once
+    seg_lens = ends - starts - 1
+    pos = np.arange(seg_lens.sum()) + \
+        np.repeat(starts + 1 - (np.cumsum(seg_lens) - seg_lens), seg_lens)
+    nodes = np.concatenate(([first], spnodeslist[pos]))
+
+    return coords_all[nodes, :]
@@ -0,0 +1,388 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Append-only on-disk spool of records.
+
+Records are single line strings (e.g. JSON) appended to segment files,
+<sequence number>.ndjson, one record per line. A new segment is started
+when the current one exceeds segment_bytes and whenever the spool is
+opened, so a segment torn by a crash is never appended to. Appended
+records are fsynced in batches, every fsync_records records or
+fsync_interval seconds, and only fsynced records are handed to the
+reader. The reader position is kept in a cursor file, so records that
+were read but not committed are read again after a restart. Fully
+read segments are deleted, and when the spool holds more than
+max_bytes the oldest segments are deleted unread.
+
+Every process writes and reads its own spool, a subfolder of the spool
+folder named after its pid, which it holds an exclusive flock on. When
+a spool is opened it adopts the subfolders of processes that are gone:
+their unread records are moved into its own folder and sent by it.
+'''
+
+import fcntl
+import os
+import shutil
+import threading
+import time
+
+SEGMENT_SUFFIX = '.ndjson'
+CURSOR_FILE = 'cursor'
+LOCK_FILE = 'lock'
+
+# Bytes read from a segment at a time
+READ_BYTES = 1024 * 1024
+
+
+class Spool:
+    """
+    Segmented, durable record spool of one process, with one writer
+    and one reader.
+
+    :class: Spool
+    """
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, max_bytes=512 * 1024 * 1024,
+                 fsync_records=100, fsync_interval=1.0):
+        """
+        Opens the spool of this process, creating its folder if needed,
+        and adopts the spools of processes that are gone.
+
+        :param directory: Spool folder shared by the processes of a host,
+                          this process' segment files go in <directory>/<pid>.
+        :param segment_bytes: Size at which a new segment is started.
+        :param max_bytes: Disk cap, oldest segments are deleted above it.
+        :param fsync_records: Number of appended records that triggers an fsync.
+        :param fsync_interval: Maximum time in seconds between an append and its fsync.
+        """
+        self._directory = os.path.join(directory, str(os.getpid()))
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._fsync_records = fsync_records
+        self._fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        for _ in range(3):
+            # Another process may take the folder for an orphan and
+            # delete it between the two calls
+            os.makedirs(self._directory, exist_ok=True)
+            self._folder_lock = _lock_folder(self._directory)
+            if self._folder_lock is not None:
+                break
+        else:
+            raise IOError('Spool folder {} is in use'.format(self._directory))
+
+        # sequence number -> size in bytes of every segment on disk
+        self._segments = _list_segments(self._directory)
+        cursor = _read_cursor(self._directory, self._segments)
+
+        # Segments of other processes follow the own ones, then the
+        # writer always starts a new segment
+        self._writer_sequence = max(max(self._segments, default=0), cursor[0]) + 1
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if path != self._directory and os.path.isdir(path):
+                self._adopt(path)
+        # Spools written before there was one folder per process
+        self._adopt(directory)
+        self._writer = open(self._path(self._writer_sequence), 'ab')
+        self._segments[self._writer_sequence] = 0
+        if cursor[0] not in self._segments:
+            # Segment is gone, continue with the next one
+            cursor = (min(seq for seq in self._segments if seq > cursor[0]), 0)
+        self._cursor = cursor
+        self._durable = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._evicted_segments = 0
+        self._evicted_bytes = 0
+        self._evict()
+
+    def _path(self, sequence):
+        return _segment_path(self._directory, sequence)
+
+    def _adopt(self, directory):
+        """
+        Moves the unread records of the spool in directory to the end of
+        this spool, unless the process owning it still holds its lock.
+        Must be called from the constructor, before the writer is opened.
+        """
+        folder_lock = _lock_folder(directory)
+        if folder_lock is None:
+            return
+        try:
+            segments = _list_segments(directory)
+            sequence, offset = _read_cursor(directory, segments)
+            adopted = 0
+            for orphan in sorted(segments):
+                source = _segment_path(directory, orphan)
+                if orphan < sequence or segments[orphan] <= (offset if orphan == sequence else 0):
+                    os.remove(source)
+                    continue
+                target = self._path(self._writer_sequence)
+                if orphan == sequence and offset:
+                    # Only the unread part of the first segment
+                    with open(source, 'rb') as src, open(target, 'wb') as dst:
+                        src.seek(offset)
+                        shutil.copyfileobj(src, dst)
+                    os.remove(source)
+                else:
+                    os.rename(source, target)
+                self._segments[self._writer_sequence] = os.path.getsize(target)
+                self._writer_sequence += 1
+                adopted += 1
+            for file_name in (CURSOR_FILE, LOCK_FILE):
+                if os.path.exists(os.path.join(directory, file_name)):
+                    os.remove(os.path.join(directory, file_name))
+            if directory != os.path.dirname(self._directory):
+                os.rmdir(directory)
+            if adopted:
+                print('Spool: adopted {} segments from {}'.format(adopted, directory))
+        except OSError as exc:
+            print('Spool: could not adopt {}: {}'.format(directory, exc))
+        finally:
+            folder_lock.close()
+
+    def _write_cursor(self):
+        """
+        Stores the reader position. Must be called with the lock held.
+        """
+        cursor_file = os.path.join(self._directory, CURSOR_FILE)
+        with open(cursor_file + '.tmp', 'w') as handle:
+            handle.write('{} {}'.format(*self._cursor))
+        os.replace(cursor_file + '.tmp', cursor_file)
+
+    def append(self, record):
+        """
+        Appends a record. It is fsynced in a batch with other records,
+        call sync() to force it to disk.
+
+        :param record: The record, a string without line breaks.
+        """
+        data = record.encode('utf-8') + b'\n'
+        with self._lock:
+            if self._writer is None or \
+                    self._segments[self._writer_sequence] >= self._segment_bytes:
+                self._roll()
+            try:
+                self._writer.write(data)
+            except OSError:
+                # Part of the record may be in the segment, continue in a
+                # new one so no record is written after it
+                self._abandon()
+                raise
+            self._segments[self._writer_sequence] += len(data)
+            self._unsynced += 1
+            if self._unsynced >= self._fsync_records or \
+                    time.monotonic() - self._last_sync >= self._fsync_interval:
+                self._sync()
+            self._evict()
+
+    def sync(self):
+        """
+        Forces appended records to disk and makes them readable.
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        """
+        See sync(). Must be called with the lock held.
+        """
+        if self._writer is None:
+            return
+        if self._unsynced:
+            try:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+            except OSError:
+                self._abandon()
+                raise
+            self._unsynced = 0
+        self._durable = self._segments[self._writer_sequence]
+        self._last_sync = time.monotonic()
+
+    def _roll(self):
+        """
+        Closes the current segment and starts a new one. Must be called
+        with the lock held.
+        """
+        if self._writer is not None:
+            self._sync()
+            self._writer.close()
+            self._writer = None
+        writer = open(self._path(self._writer_sequence + 1), 'ab')
+        self._writer_sequence += 1
+        self._writer = writer
+        self._segments[self._writer_sequence] = 0
+        self._durable = 0
+
+    def _abandon(self):
+        """
+        Closes the current segment after a failed write, the next append
+        starts a new one. Records that were not synced may be lost, the
+        reader skips what is missing. Must be called with the lock held.
+        """
+        try:
+            self._writer.close()
+        except OSError:
+            pass
+        self._writer = None
+        self._unsynced = 0
+
+    def _evict(self):
+        """
+        Deletes the oldest segments while the spool is above its disk
+        cap. The segment being written is kept. Must be called with the
+        lock held.
+        """
+        total = sum(self._segments.values())
+        for sequence in sorted(self._segments):
+            if total <= self._max_bytes or sequence == self._writer_sequence:
+                break
+            size = self._segments.pop(sequence)
+            os.remove(self._path(sequence))
+            total -= size
+            if self._cursor[0] <= sequence:
+                self._evicted_bytes += size - (self._cursor[1] if self._cursor[0] == sequence else 0)
+                self._cursor = (min(self._segments), 0)
+            self._evicted_segments += 1
+            print('Spool: disk cap exceeded, deleted unsent segment {}'.format(sequence))
+
+    def read(self, max_records):
+        """
+        Reads fsynced records from the reader position on, without
+        moving it, see commit().
+
+        :param max_records: Maximum number of records to read.
+        :return: Tuple (records, positions), positions[k] is the
+                 position right after records[k]. Pass it to commit()
+                 once records[:k + 1] are handled.
+        """
+        with self._lock:
+            sequence, offset = self._cursor
+            records = []
+            positions = []
+            while len(records) < max_records and sequence in self._segments:
+                end = self._durable if sequence == self._writer_sequence \
+                    else self._segments[sequence]
+                with open(self._path(sequence), 'rb') as handle:
+                    while offset < end and len(records) < max_records:
+                        handle.seek(offset)
+                        data = handle.read(min(end - offset, READ_BYTES))
+                        if b'\n' not in data:
+                            data += handle.read(end - offset - len(data))
+                        lines = data.split(b'\n')[:-1]
+                        if not lines:
+                            # A torn last line of a crashed segment is skipped
+                            offset = end
+                        for line in lines[:max_records - len(records)]:
+                            offset += len(line) + 1
+                            records.append(line.decode('utf-8', 'replace'))
+                            positions.append((sequence, offset))
+                if len(records) >= max_records or sequence == self._writer_sequence:
+                    break
+                sequence, offset = sequence + 1, 0
+                while sequence not in self._segments and sequence < self._writer_sequence:
+                    sequence += 1
+            return records, positions
+
+    def commit(self, position, persist=True):
+        """
+        Moves the reader position past records returned by read(), and
+        deletes the segments that are fully read.
+
+        :param position: One of the positions returned by read().
+        :param persist: False to only move the position in memory, e.g.
+                        for every record of a batch but the last. The
+                        records are read again after a restart unless a
+                        later commit persists the position.
+        """
+        with self._lock:
+            if position < self._cursor:
+                # Segments were evicted since the read
+                return
+            self._cursor = position
+            for sequence in sorted(self._segments):
+                if sequence >= position[0]:
+                    break
+                self._segments.pop(sequence)
+                os.remove(self._path(sequence))
+            if persist:
+                self._write_cursor()
+
+    def backlog(self):
+        """
+        Returns the size of the unread part of the spool.
+
+        :return: Dictionary with 'bytes' and 'segments' not yet read,
+                 and 'evicted_bytes' and 'evicted_segments' deleted
+                 unread because of the disk cap.
+        """
+        with self._lock:
+            sequence, offset = self._cursor
+            unread = {seq: size for seq, size in self._segments.items() if seq >= sequence}
+            return {
+                'bytes': sum(unread.values()) - offset if unread else 0,
+                'segments': len(unread),
+                'evicted_bytes': self._evicted_bytes,
+                'evicted_segments': self._evicted_segments
+            }
+
+    def close(self):
+        """
+        Forces appended records to disk and closes the current segment.
+        The folder stays locked until the process exits.
+        """
+        with self._lock:
+            self._sync()
+            if self._writer is not None:
+                self._writer.close()
+
+
+def _segment_path(directory, sequence):
+    return os.path.join(directory, '{:020d}{}'.format(sequence, SEGMENT_SUFFIX))
+
+
+def _list_segments(directory):
+    """
+    Returns sequence number -> size in bytes of the segments in directory.
+    """
+    segments = {}
+    for file_name in os.listdir(directory):
+        if file_name.endswith(SEGMENT_SUFFIX):
+            sequence = int(file_name[:-len(SEGMENT_SUFFIX)])
+            segments[sequence] = os.path.getsize(_segment_path(directory, sequence))
+    return segments
+
+
+def _read_cursor(directory, segments):
+    """
+    Reads the reader position, (sequence, offset). Defaults to the
+    start of the oldest segment. The segment may have been deleted.
+    """
+    try:
+        with open(os.path.join(directory, CURSOR_FILE), 'r') as handle:
+            sequence, offset = (int(value) for value in handle.read().split())
+    except (IOError, ValueError):
+        return min(segments, default=0), 0
+    return sequence, offset
+
+
+def _lock_folder(directory):
+    """
+    Takes an exclusive lock on a spool folder.
+
+    :return: The open lock file, closing it releases the lock. None if
+             another process holds the lock or the folder is gone.
+    """
+    try:
+        handle = open(os.path.join(directory, LOCK_FILE), 'a')
+    except OSError:
+        return None
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
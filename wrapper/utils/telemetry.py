@@ -0,0 +1,324 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Telemetry sink.
+
+Rows are put on a bounded in-memory queue by the request path, which
+never waits: if the queue is full the row is dropped and counted. A
+background thread takes rows off the queue, groups them per URL and
+posts them when a batch is full or when its oldest row has waited
+flush_interval seconds. The worker accepts one row per post, so a batch
+is posted row by row, all through one pooled requests.Session. Posts
+are retried with exponential backoff.
+
+With a spool (see spool.py) the background thread appends the rows to
+the spool instead, and a drainer thread reads them back and posts
+them. Rows that cannot be posted stay in the spool, also over
+restarts, and the drainer retries them with a backoff of up to
+MAX_BACKOFF seconds. Delivery is at least once: the spool position is
+moved row by row and stored once per batch, so a row is posted again
+only if its own post failed or the process stopped before the batch
+was done. A row is dropped
+after max_spool_attempts failed drains.
+'''
+
+import queue
+import threading
+import time
+import requests
+from .codec import CODEC
+
+
+class TelemetrySink:
+    """
+    Bounded, batching, asynchronous poster of telemetry rows.
+
+    :class: TelemetrySink
+    """
+    # Responses worth retrying, other errors are not going to go away
+    RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+    # Maximum delay in seconds between drain attempts while the endpoint fails
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, encode_row, max_queue=10000, batch_size=100, flush_interval=2.0,
+                 max_retries=3, backoff=0.5, timeout=10.0, session=None, spool=None,
+                 max_spool_attempts=10):
+        """
+        Constructor. The flusher thread is started on the first enqueue.
+
+        :param encode_row: Function from a row to the JSON body of its post.
+        :param max_queue: Maximum number of rows waiting to be posted.
+        :param batch_size: Maximum number of rows per batch.
+        :param flush_interval: Maximum time in seconds a row waits for its batch to fill up.
+        :param max_retries: Number of retries of a failed post before its rows are dropped.
+        :param backoff: Delay in seconds before the first retry, doubled for every retry.
+        :param timeout: Timeout in seconds of a post.
+        :param session: requests.Session to post with, a new one if None.
+        :param spool: Spool to keep rows in until they are posted, None to
+                      keep them in memory only.
+        :param max_spool_attempts: Number of drains of a spooled row, each
+                                   with max_retries retries, before it is
+                                   dropped.
+        """
+        self._encode_row = encode_row
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._session = session or requests.Session()
+        self._spool = spool
+        self._max_spool_attempts = max_spool_attempts
+
+        self._lock = threading.Lock()
+        self._threads = None
+        self._stopping = threading.Event()
+        self._counters = {
+            'enqueued': 0,
+            'overflow': 0,
+            'sent': 0,
+            'dropped': 0,
+            'posts': 0,
+            'retries': 0
+        }
+
+    def enqueue(self, url, row):
+        """
+        Queues a row for posting. Never blocks.
+
+        :param url: URL to post the row to.
+        :param row: The row, as accepted by encode_row.
+        :return: True if the row was queued, False if it was dropped
+                 because the queue is full or the sink is stopped.
+        """
+        if self._threads is None:
+            self.start()
+        if self._stopping.is_set():
+            self._count('overflow')
+            return False
+        try:
+            self._queue.put_nowait((url, row))
+        except queue.Full:
+            self._count('overflow')
+            return False
+        self._count('enqueued')
+        return True
+
+    def start(self):
+        """
+        Starts the flusher thread, and the drainer thread if there is a
+        spool, unless they are already started.
+        """
+        with self._lock:
+            if self._threads is not None:
+                return
+            self._stopping.clear()
+            if self._spool is None:
+                self._threads = [threading.Thread(target=self._run, name='telemetry',
+                                                  daemon=True)]
+            else:
+                self._threads = [threading.Thread(target=self._run_spool, name='telemetry',
+                                                  daemon=True),
+                                 threading.Thread(target=self._drain, name='telemetry-drain',
+                                                  daemon=True)]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the background threads after the queued rows are posted,
+        or written to the spool if there is one.
+
+        :param timeout: Maximum time in seconds to wait for each thread.
+        :return: True if the threads have stopped.
+        """
+        with self._lock:
+            threads = self._threads
+            if threads is None:
+                return True
+            self._stopping.set()
+        for thread in threads:
+            thread.join(timeout)
+        with self._lock:
+            if any(thread.is_alive() for thread in threads):
+                return False
+            self._threads = None
+            return True
+
+    def stats(self):
+        """
+        Returns the counters and the current queue length.
+
+        :return: Dictionary with the counters 'enqueued', 'overflow'
+                 (rows refused because the queue was full or the
+                 sink was stopping), 'sent',
+                 'dropped' (rows given up after retries or rejected
+                 by the endpoint), 'posts',
+                 'retries' and 'queued'. With a spool also 'backlog',
+                 see Spool.backlog().
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queued'] = self._queue.qsize()
+        if self._spool is not None:
+            stats['backlog'] = self._spool.backlog()
+        return stats
+
+    def _count(self, counter, increment=1):
+        with self._lock:
+            self._counters[counter] += increment
+
+    def _run(self):
+        """
+        Flusher loop. Batches are kept per URL along with the time their
+        first row was taken off the queue.
+        """
+        batches = {}
+        while True:
+            now = time.monotonic()
+            deadline = min((started for started, _ in batches.values()), default=None)
+            wait = self._flush_interval if deadline is None \
+                else max(0.0, deadline + self._flush_interval - now)
+            if self._stopping.is_set():
+                wait = 0.0
+            try:
+                url, row = self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait()
+                _, rows = batches.setdefault(url, (time.monotonic(), []))
+                rows.append(row)
+                if len(rows) >= self._batch_size:
+                    del batches[url]
+                    self._post(url, rows)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for url in [url for url, (started, _) in batches.items()
+                        if self._stopping.is_set() or now - started >= self._flush_interval]:
+                self._post(url, batches.pop(url)[1])
+
+            if self._stopping.is_set() and not batches and self._queue.empty():
+                return
+
+    def _run_spool(self):
+        """
+        Flusher loop with a spool. Rows are appended to the spool, which
+        is synced whenever the queue runs empty. A row the spool cannot
+        take, e.g. because the disk is full, is dropped.
+        """
+        while True:
+            try:
+                url, row = self._queue.get(timeout=self._flush_interval)
+            except queue.Empty:
+                pass
+            else:
+                try:
+                    self._spool.append(CODEC.dumps([url, row]))
+                except OSError as exc:
+                    print('Telemetry: dropped a row for {}, spool failed: {}'.format(url, exc))
+                    self._count('dropped')
+            if self._queue.empty():
+                try:
+                    self._spool.sync()
+                except OSError as exc:
+                    print('Telemetry: spool sync failed: {}'.format(exc))
+                if self._stopping.is_set():
+                    return
+
+    def _drain(self):
+        """
+        Drainer loop. Reads rows from the spool and posts them in order.
+        The spool position is committed past every row that was posted
+        or dropped, so only the row that failed is posted again. A row
+        that still fails after max_spool_attempts drains is dropped, so
+        it cannot hold up the rows behind it.
+        """
+        delay = self._backoff
+        waited = False
+        # Failed drains of the row at the head of the spool
+        attempts = 0
+        while not self._stopping.is_set():
+            records, positions = self._spool.read(self._batch_size)
+            if not records or (len(records) < self._batch_size and not waited):
+                # Let the batch fill up
+                waited = True
+                self._stopping.wait(self._flush_interval)
+                continue
+            waited = False
+
+            failed = False
+            committed = None
+            for record, position in zip(records, positions):
+                try:
+                    url, row = CODEC.loads(record)
+                except ValueError:
+                    self._count('dropped')
+                    committed = position
+                    self._spool.commit(position, persist=False)
+                    continue
+                if not self._send(url, row):
+                    if self._stopping.is_set():
+                        break
+                    attempts += 1
+                    if attempts < self._max_spool_attempts:
+                        failed = True
+                        break
+                    print('Telemetry: dropped a row for {} after {} attempts'.format(
+                        url, attempts))
+                    self._count('dropped')
+                attempts = 0
+                committed = position
+                self._spool.commit(position, persist=False)
+            if committed is not None:
+                # The cursor file is written once per batch
+                self._spool.commit(committed)
+
+            if failed:
+                self._stopping.wait(delay)
+                delay = min(delay * 2, TelemetrySink.MAX_BACKOFF)
+            else:
+                delay = self._backoff
+
+    def _post(self, url, rows):
+        """
+        Posts a batch of rows, rows that cannot be posted are dropped.
+        """
+        for row in rows:
+            if not self._send(url, row):
+                self._count('dropped')
+
+    def _send(self, url, row):
+        """
+        Posts a row, retrying with exponential backoff. A row the
+        endpoint rejects with an error that is not worth retrying is
+        dropped, retrying it later would not help either.
+
+        :return: True if the row was posted or dropped, False if
+                 posting it failed and may succeed later.
+        """
+        body = self._encode_row(row)
+        delay = self._backoff
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                self._count('retries')
+                if self._stopping.wait(delay):
+                    # Shutting down, do not keep retrying for long
+                    delay = 0.0
+                delay *= 2
+            self._count('posts')
+            try:
+                response = self._session.post(url, json=body, timeout=self._timeout)
+            except requests.RequestException as exc:
+                print('Telemetry: post to {} failed: {}'.format(url, exc))
+                continue
+            if response.status_code < 400:
+                self._count('sent')
+                return True
+            print('Telemetry: post to {} failed with status {}'.format(url, response.status_code))
+            if response.status_code not in TelemetrySink.RETRY_STATUSES:
+                self._count('dropped')
+                return True
+        return False
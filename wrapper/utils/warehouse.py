@@ -0,0 +1,201 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+WarehouseContext and SolveState.
+
+WarehouseContext holds everything about a warehouse that is the same
+for every request (arrays, keydict and its location index, metric,
+depots). It is built once
+when the warehouse data is loaded and shared, read only, by all
+requests. SolveState is the per-request solve_dict: it only holds the
+request fields and looks warehouse fields up in the context, so setting
+up a request costs the same however many warehouse files there are.
+'''
+
+import importlib
+import numpy as np
+from .wh_store import has_store, read_manifest
+
+
+class WarehouseContext:
+    """
+    Immutable, shared warehouse data.
+
+    :class: WarehouseContext
+    """
+    __slots__ = (
+        'name',
+        'metric',
+        'start_depot_idx',
+        'end_depot_idx',
+        'funcs',
+        'allcoords',
+        'keydict',
+        'distmat',
+        'spnodeslist',
+        'startendndarray',
+        'predecessors',
+        'location_index',
+        'coords_uint32',
+        'data_path',
+        'data_version',
+        'extras'
+    )
+    _FIELDS = frozenset(__slots__)
+
+    # Fields that come from the warehouse files. Stores have either
+    # predecessors or spnodeslist and startendndarray, see route_geometry.py.
+    # distmat is a DistanceMatrix unless it could not be packed, see
+    # wh_store.pack_distmat
+    DATA_FIELDS = ('allcoords', 'keydict', 'distmat', 'spnodeslist', 'startendndarray',
+                   'predecessors')
+
+    def __init__(self, spec, wh_dict):
+        """
+        Builds the context from a registry spec and a loaded warehouse
+        dictionary (see client_storage.get_wh_dict).
+
+        :param spec: Warehouse specification from the registry manifest.
+        :param wh_dict: Warehouse files keyed by '<path>/<name>'.
+        """
+        files = {}
+        data_path = None
+        for wh_data_key, value in wh_dict.items():
+            data_path = wh_data_key.rsplit('/', 1)[0]
+            if isinstance(value, np.ndarray):
+                value = WarehouseContext._read_only(value)
+            files[wh_data_key.rsplit('/', 1)[-1]] = value
+        if 'allcoords' in files and not isinstance(files['allcoords'], np.ndarray):
+            files['allcoords'] = WarehouseContext._read_only(np.asarray(files['allcoords']))
+
+        funcs_module = spec.get('funcs_module')
+        set_field = object.__setattr__
+        set_field(self, 'name', spec['name'])
+        # possible values for metric are: 'mm','cm','dm'
+        # i.e. what measurement unit was used during map measurements
+        set_field(self, 'metric', spec['metric'])
+        set_field(self, 'start_depot_idx', spec['start_depot_idx'])
+        set_field(self, 'end_depot_idx', spec['end_depot_idx'])
+        # Folder the files were loaded from, see wh_store.has_store
+        set_field(self, 'data_path', data_path)
+        # Version of the store, None for pickled files
+        set_field(self, 'data_version', read_manifest(data_path).get('version')
+                  if data_path is not None and has_store(data_path) else None)
+        set_field(self, 'funcs', None if funcs_module is None
+                  else importlib.import_module(funcs_module))
+        for field in WarehouseContext.DATA_FIELDS:
+            set_field(self, field, files.pop(field, None))
+        set_field(self, 'extras', files)
+
+        # Batch location lookups, if the key lookup module supports them
+        location_index = None
+        if self.keydict is not None and hasattr(self.funcs, 'build_location_index'):
+            location_index = self.funcs.build_location_index(self.keydict)
+        set_field(self, 'location_index', location_index)
+
+        # allcoords cast once for full path generation, see sol_to_xy
+        set_field(self, 'coords_uint32', None if self.allcoords is None
+                  else WarehouseContext._read_only(np.asarray(self.allcoords, dtype=np.uint32)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('WarehouseContext is read only')
+
+    def __getitem__(self, key):
+        """
+        Dictionary style access to warehouse fields.
+
+        :raises: KeyError if the context has no such field.
+        """
+        if key in WarehouseContext._FIELDS:
+            return getattr(self, key)
+        return self.extras[key]
+
+    def __contains__(self, key):
+        return key in WarehouseContext._FIELDS or key in self.extras
+
+    @staticmethod
+    def _read_only(array):
+        """
+        Returns a read only view of an array.
+        """
+        view = array.view()
+        view.setflags(write=False)
+        return view
+
+
+class SolveState:
+    """
+    Per-request solve_dict. Supports the dictionary style access the
+    handler and solvers use. Warehouse fields are read from the shared
+    WarehouseContext and cannot be set.
+
+    :class: SolveState
+    """
+    __slots__ = (
+        'context',
+        'warehouse_funcs',
+        'request_source',
+        'uuid',
+        'jobId',
+        'is_reroute_req',
+        'is_clockwise_req',
+        'node_seq_bef_sol',
+        'coords_path_bef_sol',
+        'coords_path_aft_sol',
+        'lg_sol_fitness',
+        'solver_sol',
+        'solver_sol_fitness',
+        'node_seq_aft_sol',
+        'time_to_optimize',
+        'time_of_req',
+        'isSingleBatchReq',
+        'isPickRoundOptimRequest',
+        'boxqueuedict',
+        'forced_boxesToRestore',
+        'batchSize',
+        'BatchSize',
+        'ForceBatchBoxes',
+        'SingleBatchOutput',
+        'extras'
+    )
+    _FIELDS = frozenset(__slots__)
+
+    def __init__(self, context):
+        """
+        Creates an empty state for a request on a warehouse.
+
+        :param context: The WarehouseContext of the warehouse.
+        """
+        for field in SolveState.__slots__:
+            setattr(self, field, None)
+        self.context = context
+        self.extras = {}
+
+    def __getitem__(self, key):
+        if key in SolveState._FIELDS:
+            return getattr(self, key)
+        if key in self.extras:
+            return self.extras[key]
+        return self.context[key]
+
+    def __setitem__(self, key, value):
+        if key in SolveState._FIELDS:
+            setattr(self, key, value)
+        elif key in self.context:
+            raise KeyError('Warehouse field is read only: ' + key)
+        else:
+            self.extras[key] = value
+
+    def __contains__(self, key):
+        return key in SolveState._FIELDS or key in self.extras or key in self.context
+
+    def get(self, key, default=None):
+        """
+        Dictionary style get.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
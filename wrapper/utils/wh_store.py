@@ -0,0 +1,256 @@
+#
+# Licensed under the LICENSE.
+# Copyright 2017, Sony Mobile Communications Inc.
+#
+'''
+Memory-mapped warehouse data store.
+
+Arrays are stored as raw .npy files next to a small manifest.json and
+opened with np.load(mmap_mode='r'), so all worker processes on a host
+share the same pages through the OS page cache instead of holding
+their own unpickled copies. Anything that is not an array (keydict) is
+kept pickled. Use convert_pickles() to build a store from the legacy
+pickled warm-up files:
+
+    python -m utils.wh_store <pickle dir> <store dir> [--predecessors]
+
+distmat is stored as its packed upper triangle, see
+model/distance_matrix.py. With --predecessors the shortest paths are
+stored as their predecessor matrix, see route_geometry.py.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+import numpy as np
+from model.distance_matrix import DistanceMatrix
+from .route_geometry import NO_PREDECESSOR, compact_dtype
+
+MANIFEST = 'manifest.json'
+
+# Warehouse files needed for optimization
+DATA_FILES = [
+    'allcoords',
+    'keydict',
+    'distmat',
+    'spnodeslist',
+    'startendndarray'
+]
+
+# Files that are stored as arrays, everything else is pickled
+ARRAY_FILES = [
+    'allcoords',
+    'distmat',
+    'spnodeslist',
+    'startendndarray',
+    'predecessors'
+]
+
+# Files listing the shortest paths, a store may hold their predecessor
+# matrix instead
+PATH_FILES = [
+    'spnodeslist',
+    'startendndarray'
+]
+
+
+def has_store(data_path):
+    """
+    Checks if a data folder contains a memory-mapped store.
+
+    :param data_path: Folder to check.
+    :return: True if the folder has a manifest, false otherwise.
+    """
+    return os.path.isfile('{}/{}'.format(data_path, MANIFEST))
+
+
+def read_manifest(data_path):
+    """
+    Reads the manifest of a store.
+
+    :param data_path: Folder containing the store.
+    :return: The manifest as a dictionary.
+    """
+    with open('{}/{}'.format(data_path, MANIFEST), 'r') as handle:
+        return json.load(handle)
+
+
+def load_wh_dict(data_path, progress=None):
+    """
+    Opens all files of a store. Arrays are memory-mapped read only,
+    nothing is read from disk until it is used. Keys follow the same
+    '<data_path>/<name>' convention as the pickled warm-up files.
+
+    :param data_path: Folder containing the store.
+    :param progress: Optional callback, called as progress(file_name, status)
+                     with status 'loading' and 'loaded'.
+    :return: Dictionary with one entry per file in the manifest.
+    """
+    manifest = read_manifest(data_path)
+    file_map = {}
+    for name, entry in manifest['files'].items():
+        file = '{}/{}'.format(data_path, name)
+        target = '{}/{}'.format(data_path, entry['file'])
+        if progress is not None:
+            progress(entry['file'], 'loading')
+        if entry['format'] == 'npy':
+            file_map[file] = load_array(target, entry)
+            print('Mapped {} : {} {}'.format(file, file_map[file].dtype, file_map[file].shape))
+        else:
+            with open(target, 'rb') as handle:
+                file_map[file] = pickle.load(handle, encoding='latin1')
+            print('Loaded {}'.format(file))
+        if progress is not None:
+            progress(entry['file'], 'loaded')
+    return file_map
+
+
+def file_size(key):
+    """
+    Size on disk of the file a warehouse dictionary entry was loaded
+    from, pickled warm-up file or store file alike.
+
+    :param key: '<data_path>/<name>' key of the entry.
+    :return: Size in bytes, 0 if the file is not known.
+    """
+    if os.path.isfile(key):
+        return os.path.getsize(key)
+    data_path, name = key.rsplit('/', 1)
+    if not has_store(data_path):
+        return 0
+    entry = read_manifest(data_path)['files'].get(name)
+    target = '{}/{}'.format(data_path, entry['file']) if entry else None
+    return os.path.getsize(target) if target and os.path.isfile(target) else 0
+
+
+def load_array(target, entry):
+    """
+    Memory-maps an array file of a store. A packed distance matrix
+    (layout 'upper' in the manifest) is returned as a DistanceMatrix.
+
+    :param target: The .npy file.
+    :param entry: Manifest entry of the file.
+    :return:
+    """
+    array = np.load(target, mmap_mode='r')
+    if entry.get('layout') == 'upper':
+        return DistanceMatrix(array, entry['nodes'])
+    return array
+
+
+def pack_distmat(wh_dict):
+    """
+    Replaces a dense distmat in a warehouse dictionary by a
+    DistanceMatrix. It is kept dense if it cannot be packed.
+
+    :param wh_dict: Warehouse files keyed by '<path>/<name>'.
+    :return: wh_dict.
+    """
+    for key, value in wh_dict.items():
+        if key.rsplit('/', 1)[-1] != 'distmat' or isinstance(value, DistanceMatrix):
+            continue
+        try:
+            wh_dict[key] = DistanceMatrix.from_dense(np.asarray(value))
+            print('Packed {} : {} {}'.format(key, wh_dict[key].dtype, wh_dict[key].shape))
+        except ValueError as exc:
+            print('Kept {} dense: {}'.format(key, exc))
+    return wh_dict
+
+
+def convert_pickles(src_path, dst_path, data_files, predecessors=False):
+    """
+    Converts pickled warm-up files to a memory-mapped store.
+
+    :param src_path: Folder containing the pickled files.
+    :param dst_path: Folder to write the store to, created if missing.
+    :param data_files: Names of the files to convert.
+    :param predecessors: If True spnodeslist and startendndarray are
+                         replaced by their predecessor matrix, see
+                         route_geometry.py.
+    :return: The written manifest.
+    """
+    os.makedirs(dst_path, exist_ok=True)
+    digest = hashlib.sha1()
+    files = {}
+    paths = {}
+    for name in data_files:
+        with open('{}/{}'.format(src_path, name), 'rb') as handle:
+            data = pickle.load(handle, encoding='latin1')
+        if predecessors and name in PATH_FILES:
+            paths[name] = data
+            continue
+        if name == 'distmat':
+            data = pack_distmat({name: data})[name]
+        files[name] = _write_file(dst_path, name, data, digest)
+        print('Converted {}'.format(name))
+
+    if predecessors:
+        files['predecessors'] = _write_file(
+            dst_path, 'predecessors',
+            predecessors_from_paths(paths['spnodeslist'], paths['startendndarray']), digest)
+        print('Converted {} to predecessors'.format(' and '.join(PATH_FILES)))
+
+    manifest = {
+        'version': digest.hexdigest(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'files': files
+    }
+    with open('{}/{}'.format(dst_path, MANIFEST), 'w') as handle:
+        json.dump(manifest, handle, indent=2)
+    return manifest
+
+
+def _write_file(dst_path, name, data, digest):
+    """
+    Writes one file of a store and adds it to the version digest.
+
+    :return: The manifest entry of the file.
+    """
+    if isinstance(data, DistanceMatrix):
+        entry = {'file': name + '.npy', 'format': 'npy', 'layout': 'upper',
+                 'nodes': data.num_nodes, 'dtype': data.dtype.str,
+                 'shape': list(data.packed.shape)}
+        np.save('{}/{}'.format(dst_path, entry['file']), data.packed)
+        digest.update(data.packed.tobytes())
+    elif name in ARRAY_FILES:
+        data = np.ascontiguousarray(np.asarray(data))
+        entry = {'file': name + '.npy', 'format': 'npy',
+                 'dtype': data.dtype.str, 'shape': list(data.shape)}
+        np.save('{}/{}'.format(dst_path, entry['file']), data)
+        digest.update(data.tobytes())
+    else:
+        entry = {'file': name + '.pickle', 'format': 'pickle'}
+        with open('{}/{}'.format(dst_path, entry['file']), 'wb') as handle:
+            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        digest.update(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    return entry
+
+
+def predecessors_from_paths(spnodeslist, startendndarray):
+    """
+    Builds the predecessor matrix of the paths in spnodeslist: the node
+    before j on the path from i to j. Legs expanded from it are the
+    listed paths as long as, like the paths of the mapping tool, every
+    path from i runs along the paths from i to its nodes. Otherwise a
+    leg may come back as another path of the same length.
+
+    :param spnodeslist:
+    :param startendndarray: Array of shape (nodes, nodes, 2).
+    :return: Array of shape (nodes, nodes), see route_geometry.compact_dtype.
+    """
+    spnodeslist = np.asarray(spnodeslist).flatten()
+    startendndarray = np.asarray(startendndarray)
+    ends = startendndarray[:, :, 1].astype(np.int64)
+    has_predecessor = ends - startendndarray[:, :, 0] >= 2
+    predecessors = np.full(ends.shape, NO_PREDECESSOR,
+                           dtype=compact_dtype(len(startendndarray)))
+    predecessors[has_predecessor] = spnodeslist[ends[has_predecessor] - 2]
+    return predecessors
+
+
+if __name__ == '__main__':
+    convert_pickles(sys.argv[1], sys.argv[2], DATA_FILES,
+                    predecessors='--predecessors' in sys.argv[3:])